@@ -0,0 +1,54 @@
+# Micro-benchmark of the QuoteSummaryStore extraction in get_etf_holdings against saved holdings pages.
+# Run from the repo root: python benchmarks/bench_get_json.py
+import argparse
+import glob
+import gzip
+import json
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from get_etf_holdings import extract_top_holdings
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def legacy_top_holdings(html):
+    # the previous get_json parsing, kept here as the baseline
+    json_str = html.split('root.App.main =')[1].split(
+        '(this)')[0].split(';\n}')[0].strip()
+    data = json.loads(json_str)[
+        'context']['dispatcher']['stores']['QuoteSummaryStore']
+    new_data = json.dumps(data).replace('{}', 'null')
+    new_data = re.sub(
+        r'\{[\'|\"]raw[\'|\"]:(.*?),(.*?)\}', r'\1', new_data)
+    return json.loads(new_data)['topHoldings']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the holdings page extractor")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timing repeats per page")
+    parser.add_argument("--number", type=int, default=10, help="Number of parses per timing repeat")
+    args = parser.parse_args()
+
+    pages = sorted(glob.glob(os.path.join(FIXTURES_DIR, '*_holdings_page.html.gz')))
+    if not pages:
+        print(f'No fixtures found, run python {os.path.join(FIXTURES_DIR, "make_holdings_pages.py")} first')
+        return
+
+    print(f'{"page":<30}{"size (MB)":>10}{"legacy (ms)":>14}{"extractor (ms)":>16}{"speedup":>10}')
+    for page in pages:
+        with gzip.open(page, 'rt') as f:
+            html = f.read()
+        assert extract_top_holdings(html)['holdings'] == legacy_top_holdings(html)['holdings'], page
+
+        legacy = min(timeit.repeat(lambda: legacy_top_holdings(html), repeat=args.repeat, number=args.number))
+        extractor = min(timeit.repeat(lambda: extract_top_holdings(html), repeat=args.repeat, number=args.number))
+        print(f'{os.path.basename(page):<30}{len(html) / 1e6:>10.2f}{legacy / args.number * 1e3:>14.2f}'
+              f'{extractor / args.number * 1e3:>16.3f}{legacy / extractor:>9.0f}x')
+
+
+if __name__ == "__main__":
+    main()
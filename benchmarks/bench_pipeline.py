@@ -0,0 +1,211 @@
+# Benchmark of the dashboard pipeline stage by stage on synthetic portfolios, fully offline: the sheet and the holdings
+# pages are served by a local stand-in, prices come from a seeded random walk and the emails go to a local SMTP
+# stand-in (see stand_ins.py).
+# Run from the repo root: python benchmarks/bench_pipeline.py --sizes dummy small medium
+# Every run saves its timings to benchmarks/results/<commit>.json, pass an older one with --compare to see the change.
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+import yaml
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..', 'src'))
+import get_etf_holdings
+import get_portfolio_df
+import price_cache
+from dashboard import preprocess_portfolio_dataframe, get_fund_holdings, get_price_panel, get_portfolio_prices, \
+    calculate_kpis_asset_level, calculate_kpis_portfolio_level, get_indirect_positions, get_priced_holdings
+from run_dashboard import render_html_tables
+from risk import get_daily_returns, get_volatilities
+from send_email import create_email_message, send_email_messages_oauth
+from instrumentation import stage, start_run, get_stages
+from stand_ins import PORTFOLIO_SIZES, make_portfolio_values, download_adj_close, start_stand_in_server, \
+    start_smtp_stand_in
+
+RESULTS_DIR = os.path.join(BENCHMARKS_DIR, 'results')
+TESTING_DATE = '2021-02-26'
+
+
+def get_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=BENCHMARKS_DIR, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True,
+                               text=True, cwd=BENCHMARKS_DIR).stdout.strip() != ''
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty else '')
+
+
+def run_pipeline(config, sheet_id, output_dir, smtp_port, n_recipients=1):
+    csv_schema = config['portfolio_file']['schema_fields']
+    tickers_to_replace = config['tickers_to_replace']
+    look_through_config = config.get('look_through')
+
+    # caches are off, so every repeat does the same work
+    holdings_scraping_config = dict(config.get('holdings_scraping') or {}, retries=1)
+    holdings_cache_config = {'enabled': False}
+    # the stand-in prices don't throttle, the downloads are chunked as configured but not rate limited
+    price_cache_config = {'enabled': False, 'download': dict((config.get('price_cache') or {}).get('download') or {},
+                                                             requests_per_second=1e6)}
+
+    with stage('sheet_load'):
+        df = get_portfolio_df.get_google_sheet_df('token', sheet_id)
+    with stage('preprocess'):
+        df = preprocess_portfolio_dataframe(df, csv_schema)
+    with stage('holdings_scraping'):
+        etfs = df[df['asset_type'] == 'etf']['ticker'].unique().tolist()
+        fund_holdings = get_fund_holdings(etfs, tickers_to_replace,
+                                          max_depth=(look_through_config or {}).get('max_depth', 1),
+                                          holdings_scraping_config=holdings_scraping_config,
+                                          holdings_cache_config=holdings_cache_config)
+    with stage('price_panel'):
+        tickers = list(dict.fromkeys(df[df['asset_type'] != 'cash']['ticker'].tolist()
+                                     + get_priced_holdings(fund_holdings)))
+        panel = get_price_panel(tickers, True, TESTING_DATE, price_cache_config)
+    with stage('portfolio_prices'):
+        portfolio_with_prices = get_portfolio_prices(df, csv_schema, testing=True, testing_date=TESTING_DATE,
+                                                     price_cache_config=price_cache_config, panel=panel)
+    with stage('kpis_asset_level'):
+        portfolio_with_kpis = calculate_kpis_asset_level(portfolio_with_prices, config['parameters']['tax_rate'],
+                                                         testing=True, testing_date=TESTING_DATE,
+                                                         kpis_config=config.get('kpis'))
+    with stage('risk'):
+        returns = get_daily_returns(panel.reindex(columns=df[df['asset_type'] != 'cash']['ticker'].unique()))
+        portfolio_with_kpis['volatility_per_annum'] = portfolio_with_kpis['ticker'].map(
+            get_volatilities(returns)).where(portfolio_with_kpis['asset_type'] != 'cash', 0.0)
+    with stage('kpis_portfolio_level'):
+        portfolio_global_kpis = calculate_kpis_portfolio_level(portfolio_with_kpis, config.get('kpis'), returns,
+                                                               config.get('risk'))
+    with stage('indirect_positions'):
+        portfolio_indirect_positions = get_indirect_positions(portfolio_with_kpis, tickers_to_replace, testing=True,
+                                                              testing_date=TESTING_DATE,
+                                                              price_cache_config=price_cache_config,
+                                                              look_through_config=look_through_config,
+                                                              panel=panel, fund_holdings=fund_holdings)
+    with stage('render'):
+        reports = render_html_tables(portfolio_with_kpis, portfolio_global_kpis, portfolio_indirect_positions,
+                                     TESTING_DATE, output_dir)
+    with stage('smtp_send'):
+        compress_attachments_over_kb = (config.get('report') or {}).get('compress_attachments_over_kb', 100)
+        receiver_emails = [f'receiver{i}@example.com' for i in range(n_recipients)]
+        messages = [(create_email_message('sender@example.com', x, TESTING_DATE, reports=reports,
+                                          compress_attachments_over_kb=compress_attachments_over_kb), x)
+                    for x in receiver_emails]
+        send_email_messages_oauth(messages, 'sender@example.com', 'bench', 'token', smtp_port, '127.0.0.1',
+                                  starttls=False)
+
+
+def summarize(runs):
+    # per stage, the min and median wall time over the repeats plus the numbers of the fastest repeat
+    summary = {}
+    for name in dict.fromkeys(x['stage'] for run in runs for x in run):
+        repeats = [x for run in runs for x in run if x['stage'] == name]
+        fastest = min(repeats, key=lambda x: x['wall_time_s'])
+        summary[name] = {
+            'min_s': fastest['wall_time_s'],
+            'median_s': round(statistics.median(x['wall_time_s'] for x in repeats), 4),
+            'cpu_s': fastest['cpu_time_s'],
+            'peak_traced_mb': max((x['peak_traced_mb'] or 0) for x in repeats) if fastest['peak_traced_mb'] is not None
+            else None,
+            'http_requests': fastest['http_requests'],
+            'http_bytes_received': fastest['http_bytes_received'],
+        }
+    return summary
+
+
+def print_results(results, baseline=None):
+    print(f'\n{"size":<8}{"stage":<44}{"min (ms)":>10}{"median (ms)":>13}{"cpu (ms)":>10}{"requests":>10}'
+          + (f'{"baseline (ms)":>15}{"change":>9}' if baseline else ''))
+    for size, result in results['sizes'].items():
+        baseline_stages = ((baseline or {}).get('sizes', {}).get(size) or {}).get('stages', {})
+        for name, timing in result['stages'].items():
+            line = (f'{size:<8}{name:<44}{timing["min_s"] * 1e3:>10.1f}{timing["median_s"] * 1e3:>13.1f}'
+                    f'{timing["cpu_s"] * 1e3:>10.1f}{timing["http_requests"]:>10}')
+            if name in baseline_stages:
+                before = baseline_stages[name]['min_s']
+                line += f'{before * 1e3:>15.1f}{(timing["min_s"] / before - 1) if before else 0:>+9.0%}'
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the dashboard pipeline offline on synthetic portfolios")
+    parser.add_argument("--config", type=str, default=os.path.join(BENCHMARKS_DIR, '..', 'configs', 'config.yaml'),
+                        help="Config yaml with the portfolio schema and the parameters")
+    parser.add_argument("--sizes", nargs='+', default=['dummy', 'small', 'medium'], choices=list(PORTFOLIO_SIZES),
+                        help="Portfolio sizes to run, large is 10k positions and 500 etfs")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs per size")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic portfolios")
+    parser.add_argument("--recipients", type=int, default=1, help="Number of emails sent per run, over one session")
+    parser.add_argument("--memory", action='store_true', help="Trace the peak memory of every stage (slower)")
+    parser.add_argument("--compare", type=str, help="Results json of an earlier run to compare against")
+    parser.add_argument("--output", type=str, help="Where to save the results, defaults to results/<commit>.json")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    csv_schema = config['portfolio_file']['schema_fields']
+
+    # the yahoo price download is swapped for the random walk, sheets and holdings pages go to the local server
+    price_cache.download_adj_close = download_adj_close
+    sheets = {}
+    universes = {}
+    for size in args.sizes:
+        n_positions, n_etfs = PORTFOLIO_SIZES[size]
+        sheets[size], universes[size] = make_portfolio_values(n_positions, n_etfs, csv_schema, args.seed)
+    server, server_url = start_stand_in_server(
+        {etf: holdings for universe in universes.values() for etf, holdings in universe.items()}, sheets)
+    get_portfolio_df.SHEETS_URL = server_url + '/sheets/{google_sheet_id}/values/{sheet_name}!{_range}'
+    get_etf_holdings.HOLDINGS_URL = server_url + '/quote/{etf}/holdings?p={etf}'
+    smtp_server, smtp_port = start_smtp_stand_in()
+
+    results = {
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'sizes': {}
+    }
+    try:
+        for size in args.sizes:
+            n_positions, n_etfs = PORTFOLIO_SIZES[size]
+            print(f'Running {size} ({n_positions} positions, {n_etfs} etfs)...')
+            runs = []
+            for _ in range(args.repeat):
+                start_run(trace_memory=args.memory)
+                with tempfile.TemporaryDirectory() as output_dir, contextlib.redirect_stdout(io.StringIO()):
+                    run_pipeline(config, size, output_dir, smtp_port, args.recipients)
+                runs.append(get_stages())
+            results['sizes'][size] = {'positions': n_positions, 'etfs': n_etfs, 'stages': summarize(runs)}
+    finally:
+        server.terminate()
+        smtp_server.shutdown()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f'Comparing {results["commit"]} against {baseline["commit"]}')
+    print_results(results, baseline)
+
+    output = args.output or os.path.join(RESULTS_DIR, f'{results["commit"]}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'\nResults saved to {output}')
+
+
+if __name__ == "__main__":
+    main()
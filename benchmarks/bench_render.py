@@ -0,0 +1,83 @@
+# Micro-benchmark of the template renderer in styles against the pandas Styler it replaces, on synthetic tables.
+# Run from the repo root: python benchmarks/bench_render.py
+import argparse
+import io
+import os
+import sys
+import timeit
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from styles import style_df, style_indirect_holdings_df, render_df, render_indirect_holdings_df
+
+
+def make_indirect_positions(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    value = rng.lognormal(7, 2, n_rows)
+    return pd.DataFrame({
+        'Ticker': [f'T{i:05d}' for i in range(n_rows)],
+        'Name': [f'Synthetic holding number {i}' for i in range(n_rows)],
+        'Value': value,
+        'Pct': value / value.sum(),
+        '∆ daily': rng.normal(0, 0.02, n_rows),
+        '∆ annual': rng.normal(0.05, 0.3, n_rows),
+    }).sort_values('Pct', ascending=False)
+
+
+def make_positions(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'ticker': [f'T{i:05d}' for i in range(n_rows)],
+        'transaction_date': pd.Timestamp('2020-01-01') + pd.to_timedelta(rng.integers(0, 1000, n_rows), 'D'),
+        'quantity': rng.integers(1, 500, n_rows).astype(float),
+        'years_held': rng.uniform(0, 3, n_rows),
+        'price': rng.uniform(10, 500, n_rows),
+        'todays_price': rng.uniform(10, 500, n_rows),
+        'value': rng.uniform(1e3, 1e5, n_rows),
+        'return': rng.normal(0.05, 0.3, n_rows),
+    }).set_index('ticker')
+
+
+def styler_render(render):
+    try:
+        return render()
+    except Exception as e:
+        # Styler needs the pandas version pinned in requirements.txt
+        print(f'   Styler unavailable ({type(e).__name__}: {e})')
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the HTML table renderers")
+    parser.add_argument("--sizes", type=int, nargs='+', default=[100, 1000, 5000], help="Table sizes in rows")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of timing repeats per table")
+    args = parser.parse_args()
+
+    indirect_kwargs = dict(amount_cols=['Value'], pct_cols=['Pct', '∆ daily', '∆ annual'],
+                           bar_cols=['∆ daily', '∆ annual'], str_cols=['Name'])
+    positions_kwargs = dict(amount_cols=['price', 'todays_price', 'value'], pct_cols=['return'],
+                            date_cols=['transaction_date'], float_cols=['years_held', 'quantity'], row_wise_style=True)
+
+    print(f'{"table":<30}{"rows":>8}{"Styler (ms)":>14}{"template (ms)":>16}{"speedup":>10}')
+    for n_rows in args.sizes:
+        cases = [
+            ('portfolio_indirect_positions', make_indirect_positions(n_rows),
+             lambda df: style_indirect_holdings_df(df.copy(), **indirect_kwargs).render(),
+             lambda df: render_indirect_holdings_df(df.copy(), file=io.StringIO(), **indirect_kwargs)),
+            ('portfolio_with_kpis', make_positions(n_rows),
+             lambda df: style_df(df.T, **positions_kwargs).render(),
+             lambda df: render_df(df.T, file=io.StringIO(), **positions_kwargs)),
+        ]
+        for name, df, styler, template in cases:
+            template_time = min(timeit.repeat(lambda: template(df), repeat=args.repeat, number=1))
+            if styler_render(lambda: styler(df)) is None:
+                print(f'{name:<30}{n_rows:>8}{"-":>14}{template_time * 1e3:>16.1f}{"-":>10}')
+                continue
+            styler_time = min(timeit.repeat(lambda: styler(df), repeat=args.repeat, number=1))
+            print(f'{name:<30}{n_rows:>8}{styler_time * 1e3:>14.1f}{template_time * 1e3:>16.1f}'
+                  f'{styler_time / template_time:>9.1f}x')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+# Writes gzipped Yahoo Finance holdings pages in the root.App.main / QuoteSummaryStore layout that
+# get_etf_holdings parses. The pages are synthetic but keep the size and nesting of the real ones.
+import gzip
+import json
+import os
+import random
+
+FIXTURES_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def formatted(value, fmt):
+    return {'raw': value, 'fmt': fmt.format(value)}
+
+
+def make_store(rng, n_items):
+    return {f'item{i}': {'id': rng.getrandbits(64), 'title': 'x' * rng.randint(10, 200),
+                         'value': formatted(rng.random(), '{:.2f}'), 'empty': {}} for i in range(n_items)}
+
+
+def make_quote_summary_store(rng, etf, n_holdings, holdings=None):
+    # holdings, if given, is a list of (symbol, weight) pairs to use instead of random ones
+    if holdings is None:
+        holdings = [(f'{etf}{i:03d}', rng.random() / n_holdings) for i in range(n_holdings)]
+    holdings = [{'symbol': symbol, 'holdingName': f'Holding {i} of {etf}',
+                 'holdingPercent': formatted(weight, '{:.2%}')} for i, (symbol, weight) in enumerate(holdings)]
+    return {
+        'price': {'symbol': etf, 'regularMarketPrice': formatted(rng.uniform(10, 500), '{:.2f}'),
+                  'marketCap': {'raw': rng.getrandbits(40), 'fmt': '1.2T', 'longFmt': '1,200,000,000,000'}},
+        'summaryDetail': make_store(rng, 200),
+        'topHoldings': {
+            'maxAge': 1,
+            'stockPosition': formatted(0.99, '{:.2%}'),
+            'bondPosition': formatted(0.0, '{:.2%}'),
+            'holdings': holdings,
+            'equityHoldings': {'priceToEarnings': formatted(21.3, '{:.2f}'), 'priceToBook': {}},
+            'bondRatings': [],
+            'sectorWeightings': [{'technology': formatted(0.27, '{:.2%}')}, {'realestate': formatted(0.02, '{:.2%}')}]
+        },
+        'fundProfile': make_store(rng, 100),
+    }
+
+
+def make_page(etf, seed, n_holdings=10, n_filler_stores=40, n_filler_words=50000, n_plugins=500, holdings=None):
+    rng = random.Random(seed)
+    stores = {f'Filler{i}Store': make_store(rng, 100) for i in range(n_filler_stores // 2)}
+    stores['QuoteSummaryStore'] = make_quote_summary_store(rng, etf, n_holdings, holdings)
+    stores.update({f'Other{i}Store': make_store(rng, 100) for i in range(n_filler_stores // 2)})
+    app_main = {'context': {'dispatcher': {'stores': stores}, 'plugins': make_store(rng, n_plugins)}}
+
+    return ('<!DOCTYPE html><html><head><title>' + etf + ' holdings</title></head><body>'
+            + '<div class="filler">' + 'lorem ipsum ' * n_filler_words + '</div>'
+            + '<script>(function (root) {\nroot.App || (root.App = {});\nroot.App.main = '
+            + json.dumps(app_main) + ';\n}(this));\n</script></body></html>')
+
+
+if __name__ == '__main__':
+    for seed, (etf, n_holdings) in enumerate([('SPY', 10), ('QQQ', 10), ('XLF', 25)]):
+        with gzip.open(os.path.join(FIXTURES_DIR, f'{etf.lower()}_holdings_page.html.gz'), 'wt') as f:
+            f.write(make_page(etf, seed, n_holdings))
@@ -0,0 +1,240 @@
+# Synthetic portfolios and local stand-ins for the services the dashboard talks to: a Google Sheets values endpoint
+# and Yahoo holdings pages served over HTTP on localhost, an SMTP server taking the emails, and a deterministic random
+# walk in place of the Yahoo price download. Used by bench_pipeline.py, everything here is seeded so two runs see the
+# same data.
+import json
+import multiprocessing
+import os
+import socketserver
+import sys
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures'))
+from make_holdings_pages import make_page
+
+# the day the random walks of the prices start from
+WALK_START = pd.Timestamp('2015-01-01')
+# preset sizes as (positions, etfs), dummy matches the rows of dummy_portfolio.csv
+PORTFOLIO_SIZES = {
+    'dummy': (5, 2),
+    'small': (100, 10),
+    'medium': (1000, 100),
+    'large': (10000, 500),
+}
+
+
+def make_universe(n_etfs, seed=0, holdings_per_etf=(10, 50), fund_of_funds_share=0.05):
+    # maps every etf to its (symbol, weight) holdings. Stocks are drawn with a Zipf-like popularity, so the largest
+    # ones are held by most etfs as in real look-through universes, and a few etfs also hold other etfs.
+    rng = np.random.default_rng(seed)
+    etfs = [f'E{i:04d}' for i in range(n_etfs)]
+    n_stocks = max(100, 20 * n_etfs)
+    stocks = np.array([f'S{i:05d}' for i in range(n_stocks)])
+    popularity = 1 / np.arange(1, n_stocks + 1)
+    popularity /= popularity.sum()
+
+    universe = {}
+    for i, etf in enumerate(etfs):
+        n_holdings = rng.integers(*holdings_per_etf, endpoint=True)
+        symbols = list(rng.choice(stocks, n_holdings, replace=False, p=popularity))
+        if i > 0 and rng.random() < fund_of_funds_share:
+            symbols[-1] = etfs[rng.integers(0, i)]
+        weights = np.sort(rng.dirichlet(np.ones(n_holdings)) * rng.uniform(0.3, 1.0))[::-1]
+        universe[etf] = list(zip(symbols, weights.round(6).tolist()))
+
+    return universe, stocks
+
+
+def make_portfolio_values(n_positions, n_etfs, csv_schema, seed=0):
+    # the sheet values of a portfolio (header row first, every cell a string) following the config schema. Positions
+    # are lots, so the same ticker shows up several times with different entry dates.
+    rng = np.random.default_rng(seed)
+    universe, stocks = make_universe(n_etfs, seed)
+    n_cash = max(1, n_positions // 500)
+    n_etf_lots = min(n_positions - n_cash, max(n_etfs, (n_positions - n_cash) // 2))
+    n_stock_lots = n_positions - n_cash - n_etf_lots
+
+    etfs = list(universe)
+    tickers = (['cash'] * n_cash + [etfs[i % n_etfs] for i in rng.permutation(n_etf_lots)]
+               + list(rng.choice(stocks[:5 * max(n_etfs, 20)], n_stock_lots)))
+    asset_types = ['cash'] * n_cash + ['etf'] * n_etf_lots + ['stock'] * n_stock_lots
+    is_cash = np.array(asset_types) == 'cash'
+
+    entry_dates = pd.Timestamp('2021-02-26') - pd.to_timedelta(rng.integers(30, 1500, n_positions), 'D')
+    columns = {
+        'ticker': tickers,
+        'asset_type': asset_types,
+        'broker': rng.choice(['banco_best', 'degiro', 'ibkr'], n_positions),
+        'entry_date': entry_dates.strftime('%m/%d/%Y'),
+        'entry_price': np.where(is_cash, 1, rng.uniform(5, 500, n_positions).round(2)),
+        'holdings': np.where(is_cash, rng.uniform(1e3, 2e4, n_positions), rng.integers(1, 200, n_positions))
+        .round(2),
+        'entry_cost': rng.uniform(0, 25, n_positions).round(2),
+        'annual_cost': rng.uniform(0, 10, n_positions).round(2),
+        'exit_cost_pct': rng.choice([0, 0.0026], n_positions),
+        'exit_cost_fixed_fee': rng.choice([0, 5], n_positions),
+        'dividends_received': rng.uniform(0, 200, n_positions).round(2),
+        'dividends_costs': rng.uniform(0, 60, n_positions).round(2),
+    }
+    header = [x for x in csv_schema if x in columns]
+    rows = [[str(x) for x in row] for row in zip(*[columns[x] for x in header])]
+
+    return [header] + rows, universe
+
+
+def download_adj_close(tickers, start, end):
+    # stand-in for price_cache.download_adj_close: a business day random walk per ticker, seeded by the ticker and
+    # walked from a fixed day so a ticker always gets the same close on a date, whatever the other tickers and the
+    # range of the request are (the price cache checks the closes it has against the ones downloaded again)
+    walk_dates = pd.bdate_range(min(pd.Timestamp(start), WALK_START), pd.Timestamp(end) - pd.Timedelta(days=1),
+                                name='Date')
+    walk_start = walk_dates.searchsorted(WALK_START)
+    prices = np.empty((len(walk_dates), len(tickers)))
+    for i, ticker in enumerate(tickers):
+        rng = np.random.default_rng(zlib.crc32(ticker.encode()))
+        level = rng.uniform(10, 500)
+        steps = rng.normal(0, 0.01, len(walk_dates) - walk_start)
+        # the walk goes backwards from WALK_START for the dates before it
+        backwards = np.random.default_rng(zlib.crc32(ticker.encode()) + 1).normal(0, 0.01, walk_start)
+        prices[walk_start:, i] = level * np.exp(np.cumsum(steps))
+        prices[:walk_start, i] = level * np.exp(-np.cumsum(backwards)[::-1])
+
+    in_range = walk_dates >= pd.Timestamp(start)
+    return pd.DataFrame(prices[in_range], index=walk_dates[in_range], columns=[str(x) for x in tickers])
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    # GET /sheets/<sheet id>/values/<range> returns the values of a sheet, GET /quote/<etf>/holdings a holdings page
+    def do_GET(self):
+        parts = unquote(urlparse(self.path).path).strip('/').split('/')
+        if parts[0] == 'sheets' and parts[1] in self.server.sheets:
+            body = json.dumps({'range': parts[-1], 'majorDimension': 'ROWS',
+                               'values': self.server.sheets[parts[1]]}).encode()
+            content_type = 'application/json'
+        elif parts[0] == 'quote':
+            body = self.server.get_holdings_page(parts[1]).encode()
+            content_type = 'text/html'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, universe, sheets):
+        super().__init__(('127.0.0.1', 0), _StandInHandler)
+        self.universe = universe
+        self.sheets = sheets
+        self._pages = {}
+        self._pages_lock = threading.Lock()
+
+    def get_holdings_page(self, etf):
+        # lighter than the saved fixtures, a real page is 1-2 MB but only the store matters for the parsing
+        with self._pages_lock:
+            if etf not in self._pages:
+                holdings = self.universe.get(etf.upper(), [])
+                self._pages[etf] = make_page(etf.upper(), zlib.crc32(etf.encode()), len(holdings), n_filler_stores=4,
+                                             n_filler_words=5000, n_plugins=50, holdings=holdings)
+            return self._pages[etf]
+
+
+def _serve(universe, sheets, ports):
+    server = StandInServer(universe, sheets)
+    # pages are built before serving, so the first repeat is not slower than the others
+    for etf in universe:
+        server.get_holdings_page(etf)
+    ports.put(server.server_port)
+    server.serve_forever()
+
+
+def start_stand_in_server(universe, sheets):
+    # the server runs in its own process, so the time spent serving does not count in the stages being measured.
+    # Returns the process and the base url of the server.
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(universe, sheets, ports), daemon=True)
+    process.start()
+    return process, f'http://127.0.0.1:{ports.get(timeout=300)}'
+
+
+class _SMTPStandInHandler(socketserver.StreamRequestHandler):
+    # just enough ESMTP for send_email: EHLO (with PIPELINING and AUTH XOAUTH2, no STARTTLS), AUTH, MAIL, RCPT, DATA,
+    # RSET, NOOP and QUIT. Commands are read from a buffered stream, so pipelined ones are answered in order.
+    disable_nagle_algorithm = True
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        with self.server.lock:
+            self.server.sessions += 1
+        self.reply('220 stand-in ESMTP')
+        envelope = None
+        for line in self.rfile:
+            verb = line[:4].decode().upper()
+            if verb in ('EHLO', 'HELO'):
+                self.wfile.write(b'250-stand-in\r\n250-PIPELINING\r\n250-AUTH XOAUTH2\r\n250 8BITMIME\r\n')
+            elif verb == 'AUTH':
+                self.reply('235 2.7.0 Accepted')
+            elif verb == 'MAIL':
+                envelope = {'sender': line[10:].decode().strip(), 'recipients': []}
+                self.reply('250 2.1.0 OK')
+            elif verb == 'RCPT' and envelope is not None:
+                recipient = line[8:].decode().strip()
+                if recipient.strip('<>') in self.server.refused_recipients:
+                    self.reply('550 5.1.1 No such user')
+                else:
+                    envelope['recipients'].append(recipient)
+                    self.reply('250 2.1.5 OK')
+            elif verb == 'DATA' and envelope is not None and envelope['recipients']:
+                self.reply('354 Go ahead')
+                data = []
+                for data_line in self.rfile:
+                    if data_line == b'.\r\n':
+                        break
+                    data.append(data_line[1:] if data_line.startswith(b'.') else data_line)
+                with self.server.lock:
+                    self.server.messages.append(dict(envelope, data=b''.join(data)))
+                envelope = None
+                self.reply('250 2.0.0 OK')
+            elif verb in ('RSET', 'NOOP'):
+                envelope = None if verb == 'RSET' else envelope
+                self.reply('250 2.0.0 OK')
+            elif verb == 'QUIT':
+                self.reply('221 2.0.0 Bye')
+                return
+            else:
+                self.reply('503 5.5.1 Bad sequence of commands')
+
+
+class SMTPStandInServer(socketserver.ThreadingTCPServer):
+    # the messages taken, with their envelope, and the number of sessions opened. The recipients in
+    # refused_recipients are refused at RCPT.
+    daemon_threads = True
+
+    def __init__(self, refused_recipients=()):
+        super().__init__(('127.0.0.1', 0), _SMTPStandInHandler)
+        self.lock = threading.Lock()
+        self.messages = []
+        self.sessions = 0
+        self.refused_recipients = set(refused_recipients)
+
+
+def start_smtp_stand_in(refused_recipients=()):
+    # served from a thread of this process, returns the server and its port
+    server = SMTPStandInServer(refused_recipients)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.server_address[1]
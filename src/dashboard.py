@@ -1,7 +1,16 @@
+import json
+import numpy as np
 import pandas as pd
-import yfinance as yf
 from datetime import datetime, timedelta
-from get_etf_holdings import get_json_and_replace_tickers
+from get_etf_holdings import holdings_records_to_df, HOLDINGS_COLUMNS
+from holdings_cache import get_cached_holdings
+from price_cache import get_adj_close_prices
+from look_through import build_weight_matrix, resolve_look_through, get_exposures
+from kpi_engine import compile_kpis, get_input_arrays, evaluate_asset_kpis, evaluate_portfolio_kpis
+from money_weighted import calculate_money_weighted_returns
+from symbol_index import resolve_symbols
+from risk import get_daily_returns, get_portfolio_risk, get_portfolio_risk_over_dates, TRADING_DAYS_PER_YEAR
+from instrumentation import stage
 
 def setup_datetime_parameters(
         testing: bool = False,
@@ -19,116 +28,261 @@ def setup_datetime_parameters(
     today = today_dt.strftime('%Y-%m-%d')
     tomorrow = (today_dt + timedelta(1)).strftime('%Y-%m-%d')
     yesterday = (today_dt - timedelta(1)).strftime('%Y-%m-%d')
+    one_week_ago = (today_dt - timedelta(7)).strftime('%Y-%m-%d')
+    one_month_ago = (today_dt - timedelta(30)).strftime('%Y-%m-%d')
+    last_year_end = datetime(today_dt.year - 1, 12, 31).strftime('%Y-%m-%d')
     one_yr_ago = (today_dt - timedelta(365)).strftime('%Y-%m-%d')
-    one_yr_ago_plus1 = (today_dt - timedelta(364)).strftime('%Y-%m-%d')
 
     strings_to_datetime = {
         'today': today,
         'yesterday': yesterday,
+        'one_week_ago': one_week_ago,
+        'one_month_ago': one_month_ago,
+        'last_year_end': last_year_end,
         'one_yr_ago': one_yr_ago,
-        'tomorrow': tomorrow,
-        'one_yr_ago_plus1': one_yr_ago_plus1
+        'tomorrow': tomorrow
     }
 
-    datetime_to_strings = {
-        today: 'todays_price',
-        yesterday: 'yesterdays_price',
-        one_yr_ago: 'lastyears_price',
-        tomorrow: 'tomorrow',
-        one_yr_ago_plus1: 'one_yr_ago_plus1'
+    # price columns and the date whose close (or the last close before it) they hold, yesterdays_price holding the
+    # close before that one (see get_prices_as_of)
+    price_dates = {
+        'lastyears_price': one_yr_ago,
+        'last_year_end_price': last_year_end,
+        'lastmonths_price': one_month_ago,
+        'lastweeks_price': one_week_ago,
+        'yesterdays_price': today,
+        'todays_price': today
     }
 
-    return strings_to_datetime, datetime_to_strings
+    return strings_to_datetime, price_dates
+
+
+MONEY_WEIGHTED_RETURN_KPI = 'MWR per annum post-tax'
+# price columns holding the close before the one of their date rather than that one
+PREVIOUS_CLOSE_COLUMNS = ['yesterdays_price']
+
+SCHEMA_DEFAULTS = {
+    'string': 'na',
+    'datetime': pd.Timestamp('1900-01-01'),
+    'float': 0.0,
+    'integer': 0
+}
+
+_compiled_schemas = {}
+
+
+def compile_schema(
+        csv_schema: dict
+) -> dict:
+    # the fields of the schema grouped by type, with their defaults and date formats, worked out once per schema
+    key = json.dumps(csv_schema, sort_keys=True, default=str)
+    if key not in _compiled_schemas:
+        fields_by_type = {field_type: [] for field_type in SCHEMA_DEFAULTS}
+        for field, spec in csv_schema.items():
+            fields_by_type[spec['type']].append(field)
+        _compiled_schemas[key] = {
+            'required': [x for x in csv_schema if csv_schema[x]['required'] == True],
+            'optional': [x for x in csv_schema if csv_schema[x]['required'] == False],
+            'fields_by_type': fields_by_type,
+            'date_formats': {x: csv_schema[x].get('format') for x in fields_by_type['datetime']},
+            'defaults': {x: SCHEMA_DEFAULTS[csv_schema[x]['type']] for x in csv_schema}
+        }
+    return _compiled_schemas[key]
+
+
+def _get_invalid_rows(
+        raw: pd.DataFrame,
+        parsed: np.ndarray
+) -> dict:
+    # sheet rows (the header is row 1) of every column holding a value that could not be parsed
+    invalid = pd.isna(parsed) & pd.notna(raw).to_numpy()
+    return {column: (np.flatnonzero(invalid[:, i]) + 2).tolist() for i, column in enumerate(raw.columns)
+            if invalid[:, i].any()}
+
+
+def _to_numbers(
+        raw: pd.DataFrame
+) -> tuple:
+    # all the cells of the block are parsed in one pass, frames that are already numeric are only cast
+    if all(pd.api.types.is_numeric_dtype(x) for x in raw.dtypes):
+        return raw.to_numpy(dtype='float64'), {}
+    cells = raw.to_numpy(dtype=object)
+    missing = pd.isna(cells)
+    try:
+        cells[missing] = 'nan'
+        return cells.astype('float64'), {}
+    except (ValueError, TypeError):
+        # some cell is not a number, they are parsed again one by one to find out which
+        cells[missing] = None
+        parsed = pd.to_numeric(pd.Series(cells.ravel(), dtype=object), errors='coerce').to_numpy(dtype='float64')
+        parsed = parsed.reshape(raw.shape)
+        return parsed, _get_invalid_rows(raw, parsed)
 
 
 def preprocess_portfolio_dataframe(
         df: pd.DataFrame,
         csv_schema: dict
 ) -> pd.DataFrame:
-    schema_fields = list(csv_schema.keys())
-    required_schema_fields = [x for x in schema_fields if csv_schema[x]['required'] == True]
-    optional_schema_fields = [x for x in schema_fields if csv_schema[x]['required'] == False]
-    required_schema_fields_available_in_df = [x for x in required_schema_fields if x in df.columns]
-    assert len(required_schema_fields_available_in_df) == len(required_schema_fields), \
-        f"Some required fields are not available in the portfolio table: \n" \
-        f"{[x for x in required_schema_fields if x not in df.columns]}"
-    for optional_field in optional_schema_fields:
+    # typed portfolio frame: strings are lower case categories (tickers upper case), floats are float64, integers
+    # int64 (Int64 if some are missing) and dates datetime64. All the problems found are reported together.
+    schema = compile_schema(csv_schema)
+    fields_by_type = schema['fields_by_type']
+    df = df.rename(columns=str.lower)
+
+    errors = []
+    missing_required_fields = [x for x in schema['required'] if x not in df.columns]
+    if missing_required_fields:
+        errors.append(f"Some required fields are not available in the portfolio table: {missing_required_fields}")
+    for optional_field in schema['optional']:
         if optional_field not in df.columns:
             print(
                 f" - The optional field {optional_field} is not available in the portfolio table. Field description: {csv_schema[optional_field]['description']}")
+    df = df.assign(**{x: schema['defaults'][x] for x in schema['optional'] if x not in df.columns})
+    if missing_required_fields:
+        raise ValueError('The portfolio table does not match the schema:\n - ' + '\n - '.join(errors))
+
+    # strings and dates repeat a lot across positions, so only their distinct values are transformed
+    converted = {}
+    for field in fields_by_type['string']:
+        codes, uniques = pd.factorize(df[field].astype(object))
+        uniques = pd.Series(uniques, dtype='string').str.lower()
+        if field == 'ticker':
+            uniques = uniques.str.upper()
+        # values that only differ in case collapse into the same category
+        unique_codes, categories = pd.factorize(uniques)
+        converted[field] = pd.Categorical.from_codes(np.where(codes >= 0, unique_codes[codes], -1),
+                                                     categories.astype(object))
+
+    for field in fields_by_type['datetime']:
+        if pd.api.types.is_datetime64_dtype(df[field]):
+            converted[field] = df[field]
+            continue
+        codes, uniques = pd.factorize(df[field])
+        dates = pd.to_datetime(pd.Series(uniques, dtype=object), format=schema['date_formats'][field], errors='coerce')
+        converted[field] = np.where(codes >= 0, dates.to_numpy()[codes], np.datetime64('NaT'))
+        for column, rows in _get_invalid_rows(df[[field]], converted[field][:, None]).items():
+            errors.append(f"{column} is not a date in the format {schema['date_formats'][field]} in rows {rows}")
+
+    for field_type in ['float', 'integer']:
+        fields = fields_by_type[field_type]
+        if not fields:
+            continue
+        parsed, invalid_rows = _to_numbers(df[fields])
+        for column, rows in invalid_rows.items():
+            errors.append(f"{column} is not a number in rows {rows}")
+        for i, field in enumerate(fields):
+            if field_type == 'float':
+                converted[field] = parsed[:, i]
+                continue
+            values = parsed[:, i]
+            fractional = np.flatnonzero(~np.isnan(values) & (values != np.round(values)))
+            if len(fractional):
+                errors.append(f"{field} is not a whole number in rows {(fractional + 2).tolist()}")
+                continue
+            converted[field] = pd.array(values, dtype='Int64') if np.isnan(values).any() else values.astype('int64')
+
+    if errors:
+        raise ValueError('The portfolio table does not match the schema:\n - ' + '\n - '.join(errors))
+
+    return df.assign(**converted)
+
+
+def get_price_panel(
+        tickers: list,
+        testing: bool = False,
+        testing_date: str = '2021-02-26',
+        price_cache_config: dict = None,
+        lookback_buffer_days: int = 10
+) -> pd.DataFrame:
+    strings_to_datetime, price_dates = setup_datetime_parameters(testing, testing_date)
 
-    df.columns = map(str.lower, df.columns)
-
-    for field in csv_schema.keys():
-        if csv_schema[field]['type'] == "string":
-            if field not in df.columns:
-                df[field] = "na"
-            df[field] = df[field].astype("string").str.lower()
-        elif csv_schema[field]['type'] == "datetime":
-            if field not in df.columns:
-                df[field] = pd.Timestamp("1900-01-01")
-            df[field] = pd.to_datetime(df[field], format=csv_schema[field]['format'])
-        elif csv_schema[field]['type'] == "float":
-            if field not in df.columns:
-                df[field] = 0.0
-            df[field] = df[field].astype("float16")
-        elif csv_schema[field]['type'] == "integer":
-            if field not in df.columns:
-                df[field] = 0
-            df[field] = df[field].astype("int16")
-
-    df['ticker'] = df['ticker'].str.upper()
+    # one download covering every lookback, with a buffer so the oldest date still has an earlier close when it
+    # falls on a weekend or holiday
+    start = (datetime.strptime(min(price_dates.values()), '%Y-%m-%d')
+             - timedelta(lookback_buffer_days)).strftime('%Y-%m-%d')
 
-    return df
+    return get_adj_close_prices(tickers, start, strings_to_datetime['tomorrow'], price_cache_config)
+
+
+def get_previous_closes(
+        panel: pd.DataFrame
+) -> pd.DataFrame:
+    # at every date of the (sorted) panel, the close of each ticker before its last close on or before that date
+    closes = panel.to_numpy(dtype=float)
+    rows = np.arange(len(closes))[:, None]
+    last_rows = np.maximum.accumulate(np.where(np.isnan(closes), -1, rows), axis=0)
+    rows_before = np.vstack([np.full((1, closes.shape[1]), -1), last_rows[:-1]])
+    columns = np.arange(closes.shape[1])
+    previous_rows = np.where(last_rows >= 0, rows_before[np.maximum(last_rows, 0), columns], -1)
+    previous = np.where(previous_rows >= 0, closes[np.maximum(previous_rows, 0), columns], np.nan)
+    return pd.DataFrame(previous, index=panel.index, columns=panel.columns)
+
+
+def get_prices_as_of(
+        panel: pd.DataFrame,
+        price_dates: dict,
+        live_session: bool = False
+) -> pd.DataFrame:
+    # last available close on or before each requested date, for every ticker at once. The previous close columns
+    # hold the close before that one instead, so that on a weekend or before the close yesterday's and today's prices
+    # are not the same close. In a live session today's close is still to come, the close before it is then the last
+    # one before the date.
+    as_of_dates = pd.to_datetime(pd.Series(price_dates))
+    panel = panel.sort_index()
+    prices = panel.ffill().reindex(as_of_dates.values, method='ffill')
+    prices.index = as_of_dates.index
+    previous = as_of_dates[as_of_dates.index.isin(PREVIOUS_CLOSE_COLUMNS)]
+    if len(previous):
+        if live_session:
+            previous_dates = pd.DatetimeIndex(previous.values) - timedelta(1)
+            previous_closes = panel.ffill().reindex(previous_dates, method='ffill')
+        else:
+            previous_closes = get_previous_closes(panel).reindex(previous.values, method='ffill')
+        prices.loc[previous.index] = previous_closes.to_numpy()
+    prices['CASH'] = 1.0
+
+    return prices.T.reset_index().rename(columns={'index': 'ticker'})
 
 
 def get_ticker_prices(
         df: pd.DataFrame,
         testing: bool = False,
-        testing_date: str = '2021-02-26'
-) -> tuple:
+        testing_date: str = '2021-02-26',
+        price_cache_config: dict = None,
+        price_columns: list = ['lastyears_price', 'yesterdays_price', 'todays_price'],
+        panel: pd.DataFrame = None,
+        live_session: bool = False
+) -> pd.DataFrame:
 
     if 'asset_type' in df.columns:
         tickers = list(df[df['asset_type'] != 'cash']['ticker'].unique())
     else:
         tickers = list(df['ticker'].unique())
 
-    strings_to_datetime, datetime_to_strings = setup_datetime_parameters(testing, testing_date)
-
-    yesterday = strings_to_datetime['yesterday']
-    tomorrow = strings_to_datetime['tomorrow']
-    one_yr_ago = strings_to_datetime['one_yr_ago']
-    one_yr_ago_plus1 = strings_to_datetime['one_yr_ago_plus1']
-
-    prices_since_yday = yf.download(tickers, start=yesterday, end=tomorrow)
-    prices_last_year = yf.download(tickers, start=one_yr_ago, end=one_yr_ago_plus1)
-
-    adj_close_since_yday = prices_since_yday['Adj Close'].reset_index()
-    adj_close_one_yr_ago = prices_last_year['Adj Close'].reset_index()
-
-    adj_close_since_yday['Date'] = adj_close_since_yday['Date'].astype("string").str[:10].map(datetime_to_strings)
-    adj_close_one_yr_ago['Date'] = adj_close_one_yr_ago['Date'].astype("string").str[:10].map(datetime_to_strings)
-
-    adj_close_since_yday['CASH'] = 1.0
-    adj_close_one_yr_ago['CASH'] = 1.0
-
-    adj_close_since_yday = adj_close_since_yday.set_index('Date').T.reset_index().rename(columns={'index': 'ticker'})
-    adj_close_one_yr_ago = adj_close_one_yr_ago.set_index('Date').T.reset_index().rename(columns={'index': 'ticker'})
+    # a panel fetched beforehand (e.g. for several portfolios at once) saves the download
+    strings_to_datetime, price_dates = setup_datetime_parameters(testing, testing_date)
+    if panel is None:
+        panel = get_price_panel(tickers, testing, testing_date, price_cache_config)
+    else:
+        panel = panel.reindex(columns=tickers)
 
-    return adj_close_since_yday, adj_close_one_yr_ago
+    return get_prices_as_of(panel, {x: price_dates[x] for x in price_columns}, live_session)
 
 
 def get_portfolio_prices(
         df: pd.DataFrame,
         csv_schema: dict,
         testing: bool = False,
-        testing_date: str = '2021-02-26'
+        testing_date: str = '2021-02-26',
+        price_cache_config: dict = None,
+        panel: pd.DataFrame = None,
+        live_session: bool = False
 ) -> pd.DataFrame:
     preprocessed_portfolio = preprocess_portfolio_dataframe(df, csv_schema)
-    yesterdays_prices, lastyears_prices = get_ticker_prices(preprocessed_portfolio, testing, testing_date)
+    prices = get_ticker_prices(preprocessed_portfolio, testing, testing_date, price_cache_config, panel=panel,
+                               live_session=live_session)
 
-    df = preprocessed_portfolio.merge(lastyears_prices, on='ticker', how='left') \
-        .merge(yesterdays_prices, on='ticker', how='left')
+    df = preprocessed_portfolio.merge(prices, on='ticker', how='left')
 
     return df
 
@@ -137,137 +291,274 @@ def calculate_kpis_asset_level(
         portfolio_updated: pd.DataFrame,
         tax_rate: 'float' = 0.28,
         testing: bool = False,
-        testing_date: str = '2021-02-26'
+        testing_date: str = '2021-02-26',
+        today_dt: pd.Series = None,
+        kpis_config: dict = None
 ) -> pd.DataFrame:
-    strings_to_datetime, datetime_to_strings = setup_datetime_parameters(testing, testing_date)
-
-    portfolio_updated['today_dt'] = pd.to_datetime(strings_to_datetime['today'])
-    portfolio_updated['years_since_entry'] = ((portfolio_updated['today_dt'] - portfolio_updated['entry_date']).astype(
-        'timedelta64[D]')) / 365
-    portfolio_updated['entry_value'] = portfolio_updated['holdings'] * portfolio_updated['entry_price']
-    portfolio_updated['current_value'] = portfolio_updated['holdings'] * portfolio_updated['todays_price']
-    portfolio_updated['exit_cost_total'] = portfolio_updated['exit_cost_fixed_fee'] + portfolio_updated[
-        'exit_cost_pct'] * portfolio_updated['current_value']
-    portfolio_updated['net_gain_ex_dividend_pre_tax'] = portfolio_updated['current_value'] - portfolio_updated[
-        'entry_value'] - portfolio_updated['entry_cost'] - portfolio_updated['exit_cost_total']
-    portfolio_updated['tax_on_gain'] = portfolio_updated['net_gain_ex_dividend_pre_tax'] * tax_rate
-    portfolio_updated['annual_costs_paid'] = portfolio_updated['annual_cost'] * portfolio_updated['years_since_entry']
-    portfolio_updated['net_gain_ex_dividend'] = portfolio_updated['net_gain_ex_dividend_pre_tax'] - portfolio_updated[
-        'tax_on_gain'] - portfolio_updated['annual_costs_paid']
-    portfolio_updated['net_gain'] = portfolio_updated['net_gain_ex_dividend'] + portfolio_updated[
-        'dividends_received'] - portfolio_updated['dividends_costs']
-
-    portfolio_updated['1_day_roa'] = portfolio_updated['todays_price'] / portfolio_updated['yesterdays_price'] - 1
-    portfolio_updated['per_annum_roa_ex_dividends'] = ((portfolio_updated['net_gain_ex_dividend']
-                                                        + portfolio_updated['entry_value'])
-                                                       / portfolio_updated['entry_value']) \
-                                                      ** (1 / portfolio_updated['years_since_entry']) - 1
-    portfolio_updated['per_annum_roa'] = ((portfolio_updated['net_gain']
-                                           + portfolio_updated['entry_value'])
-                                          / portfolio_updated['entry_value']) \
-                                         ** (1 / portfolio_updated['years_since_entry']) - 1
+    # today_dt can hold one date per row, to evaluate a whole (date x position) grid at once. The kpis are the
+    # asset_level expressions of kpis_config (the kpis of the config), evaluated over numpy arrays of the columns.
+    if today_dt is None:
+        strings_to_datetime, price_dates = setup_datetime_parameters(testing, testing_date)
+        today_dt = pd.to_datetime(strings_to_datetime['today'])
+
+    portfolio_updated['today_dt'] = today_dt
+    kpi_plans = compile_kpis(kpis_config)
+    inputs = get_input_arrays(portfolio_updated, kpi_plans['asset_plan'].get_inputs())
+    for kpi, values in evaluate_asset_kpis(kpi_plans, inputs, {'tax_rate': tax_rate}).items():
+        portfolio_updated[kpi] = values
+
+    # the money-weighted return of every row is solved for in one batch
+    money_weighted_returns = calculate_money_weighted_returns(portfolio_updated)
+    if money_weighted_returns is not None:
+        portfolio_updated['per_annum_mwr'] = money_weighted_returns
 
     return portfolio_updated
 
 
+def get_pooled_tickers(
+        portfolio: pd.DataFrame
+) -> np.ndarray:
+    # the ticker of every position, with cash pooled into a single CASH ticker whatever the one used for it
+    return np.where(portfolio['asset_type'] == 'cash', 'CASH', portfolio['ticker'].astype(str).to_numpy())
+
+
 def calculate_kpis_portfolio_level(
-        portfolio_with_kpis: pd.DataFrame
+        portfolio_with_kpis: pd.DataFrame,
+        kpis_config: dict = None,
+        returns: pd.DataFrame = None,
+        risk_config: dict = None
 ) -> dict:
-    portfolio_kpis = {}
-    portfolio_kpis['Starting capital'] = portfolio_with_kpis['entry_value'].sum()
-    portfolio_kpis['Costs paid so far'] = portfolio_with_kpis['annual_costs_paid'].sum() \
-                                          + portfolio_with_kpis['entry_cost'].sum()
-
-    portfolio_kpis['Capital after liquidating pre-tax'] = portfolio_with_kpis['current_value'].sum() \
-                                                          - portfolio_with_kpis['exit_cost_total'].sum()
-    portfolio_kpis['Capital after liquidating post-tax'] = portfolio_with_kpis['current_value'].sum() \
-                                                           - portfolio_with_kpis['exit_cost_total'].sum() \
-                                                           - portfolio_with_kpis['tax_on_gain'].sum()
-    portfolio_kpis['ROC per annum post-tax'] = portfolio_with_kpis['per_annum_roa'].dot(
-        portfolio_with_kpis['current_value']) / portfolio_with_kpis['current_value'].sum()
-
+    kpi_plans = compile_kpis(kpis_config)
+    inputs = get_input_arrays(portfolio_with_kpis, kpi_plans['summed_plan'].get_inputs())
+    portfolio_kpis = evaluate_portfolio_kpis(kpi_plans, inputs)
+
+    # the cash flows of all the positions together
+    single_group = np.zeros(len(portfolio_with_kpis), dtype=int)
+    money_weighted_return = calculate_money_weighted_returns(portfolio_with_kpis, single_group, 1)
+    if money_weighted_return is not None:
+        portfolio_kpis[MONEY_WEIGHTED_RETURN_KPI] = money_weighted_return[0]
+
+    # the risk of the positions held today over the last window of daily returns (by ticker, cash doesn't move)
+    if returns is not None:
+        risk_config = risk_config or {}
+        values = portfolio_with_kpis['current_value'].groupby(get_pooled_tickers(portfolio_with_kpis)).sum()
+        window_returns = returns.iloc[-risk_config.get('window_days', TRADING_DAYS_PER_YEAR):]
+        window_returns = window_returns.reindex(columns=values.index, fill_value=0.0)
+        portfolio_kpis.update(get_portfolio_risk(values.to_numpy(), window_returns.to_numpy(),
+                                                 confidence=risk_config.get('confidence', 0.95)))
     return portfolio_kpis
 
 
-def get_indirect_positions(
-        portfolio_with_kpis: pd.DataFrame,
-        tickers_to_replace: dict,
-        testing: bool = False,
-        testing_date: str = '2021-02-26'
+def calculate_kpis_portfolio_level_over_dates(
+        grid_with_kpis: pd.DataFrame,
+        kpis_config: dict = None,
+        returns: pd.DataFrame = None,
+        risk_config: dict = None
+) -> pd.DataFrame:
+    # same kpis as calculate_kpis_portfolio_level, one row per today_dt of the grid
+    kpi_plans = compile_kpis(kpis_config)
+    groups, dates = pd.factorize(grid_with_kpis['today_dt'], sort=True)
+    inputs = get_input_arrays(grid_with_kpis, kpi_plans['summed_plan'].get_inputs())
+    portfolio_kpis = evaluate_portfolio_kpis(kpi_plans, inputs, groups=groups, n_groups=len(dates))
+    money_weighted_returns = calculate_money_weighted_returns(grid_with_kpis, groups, len(dates))
+    if money_weighted_returns is not None:
+        portfolio_kpis[MONEY_WEIGHTED_RETURN_KPI] = money_weighted_returns
+
+    # the risk of the positions held at each date, with the covariance rolled forward from one date to the next
+    if returns is not None:
+        risk_config = risk_config or {}
+        tickers, pooled_tickers = pd.factorize(get_pooled_tickers(grid_with_kpis))
+        values = np.zeros((len(dates), len(pooled_tickers)))
+        np.add.at(values, (groups, tickers), np.nan_to_num(grid_with_kpis['current_value'].to_numpy(dtype=float)))
+        risk = get_portfolio_risk_over_dates(values, returns.reindex(columns=pooled_tickers, fill_value=0.0),
+                                             pd.DatetimeIndex(dates),
+                                             risk_config.get('window_days', TRADING_DAYS_PER_YEAR),
+                                             risk_config.get('confidence', 0.95))
+        portfolio_kpis.update({x: risk[x].to_numpy() for x in risk.columns})
+
+    return pd.DataFrame(portfolio_kpis, index=pd.DatetimeIndex(dates, name='Date'))
+
+
+def get_price_panel_over_dates(
+        tickers: list,
+        dates: pd.DatetimeIndex,
+        price_cache_config: dict = None,
+        lookback_buffer_days: int = 10
+) -> pd.DataFrame:
+    # closes from a year before the first date, with a buffer, to the last one
+    start = (dates.min() - timedelta(365 + lookback_buffer_days)).strftime('%Y-%m-%d')
+    end = (dates.max() + timedelta(1)).strftime('%Y-%m-%d')
+    return get_adj_close_prices(tickers, start, end, price_cache_config)
+
+
+def get_portfolio_prices_over_dates(
+        df: pd.DataFrame,
+        dates: pd.DatetimeIndex,
+        price_cache_config: dict = None,
+        lookback_buffer_days: int = 10,
+        panel: pd.DataFrame = None
 ) -> pd.DataFrame:
+    # one row per (date, position) held on that date, with prices looked up as-of from a single panel download
+    if panel is None:
+        tickers = list(df[df['asset_type'] != 'cash']['ticker'].unique())
+        panel = get_price_panel_over_dates(tickers, dates, price_cache_config, lookback_buffer_days)
+    panel = panel.sort_index()
+    previous_closes = get_previous_closes(panel)
+    panel = panel.ffill()
+    panel['CASH'] = 1.0
+    previous_closes['CASH'] = 1.0
+
+    n_positions = len(df)
+    grid = df.iloc[np.tile(np.arange(n_positions), len(dates))].reset_index(drop=True)
+    grid['today_dt'] = np.repeat(dates.values, n_positions)
+
+    date_positions = np.repeat(np.arange(len(dates)), n_positions)
+    ticker_positions = panel.columns.get_indexer(grid['ticker'])
+    # yesterday is the close before the one of the date, as in get_prices_as_of
+    for column, closes, days_before in [('lastyears_price', panel, 365), ('yesterdays_price', previous_closes, 0),
+                                        ('todays_price', panel, 0)]:
+        prices = closes.reindex(dates - timedelta(days_before), method='ffill').to_numpy()[date_positions,
+                                                                                           ticker_positions]
+        prices[ticker_positions == -1] = np.nan
+        grid[column] = prices
+
+    return grid[grid['entry_date'] <= grid['today_dt']].reset_index(drop=True)
+
+
+def calculate_kpis_over_dates(
+        df: pd.DataFrame,
+        csv_schema: dict,
+        from_date: str,
+        to_date: str,
+        tax_rate: float = 0.28,
+        price_cache_config: dict = None,
+        kpis_config: dict = None,
+        risk_config: dict = None
+) -> pd.DataFrame:
+    # the panel gives both the prices of every date and the daily returns the risk is measured over
+    dates = pd.bdate_range(from_date, to_date)
+    df = preprocess_portfolio_dataframe(df, csv_schema)
+    panel = get_price_panel_over_dates(list(df[df['asset_type'] != 'cash']['ticker'].unique()), dates,
+                                       price_cache_config)
+    grid = get_portfolio_prices_over_dates(df, dates, panel=panel)
+    grid_with_kpis = calculate_kpis_asset_level(grid, tax_rate, today_dt=grid['today_dt'], kpis_config=kpis_config)
 
-    columns_to_get_from_portfolio = ['ticker', 'asset_type', 'current_value']
-    portfolio_indirect_positions = portfolio_with_kpis[columns_to_get_from_portfolio].copy(deep=False)
-    portfolio_indirect_positions = portfolio_indirect_positions.groupby(['asset_type', 'ticker']).sum().reset_index()
-    portfolio_total_value = portfolio_indirect_positions['current_value'].sum()
-    portfolio_indirect_positions['pct_of_portfolio'] = portfolio_indirect_positions[
-                                                           'current_value'] / portfolio_total_value
-    etfs_in_portfolio = portfolio_indirect_positions[portfolio_indirect_positions['asset_type'] == 'etf'][
-        'ticker'].unique().tolist()
-
-    holdings_df = pd.DataFrame([])
-    for etf in etfs_in_portfolio:
-        holdings_yahoo_url = f'https://finance.yahoo.com/quote/{etf}/holdings?p={etf}'
-        etf_holdings = get_json_and_replace_tickers(tickers_to_replace, holdings_yahoo_url).rename(
-            columns={
-                'symbol': 'ticker',
-                'holdingName': 'holding_name',
-                'holdingPercent': 'holding_percent'
-            }
-        )
-        etf_holdings['etf'] = etf
-        holdings_df = pd.concat([holdings_df, etf_holdings]).reset_index(drop=True)
-
-    yesterdays_prices, lastyears_prices = get_ticker_prices(holdings_df, testing=testing, testing_date=testing_date)
-    holdings_df = holdings_df.merge(lastyears_prices, on='ticker', how='left').merge(yesterdays_prices, on='ticker',
-                                                                                     how='left')
-    holdings_df['holding_daily_return'] = holdings_df['todays_price'] / holdings_df['yesterdays_price'] - 1
-    holdings_df['holding_annual_return'] = holdings_df['todays_price'] / holdings_df['lastyears_price'] - 1
-    holdings_df = holdings_df.rename(columns={'ticker': 'holding_ticker', 'etf': 'ticker'})
-    holdings_df.drop(['lastyears_price', 'yesterdays_price', 'todays_price'], axis=1, inplace=True)
-    portfolio_indirect_positions = portfolio_indirect_positions.merge(holdings_df, on='ticker', how='left')
-
-    portfolio_indirect_positions.loc[portfolio_indirect_positions['asset_type'] == 'cash', 'holding_ticker'] = 'CASH'
-    portfolio_indirect_positions.loc[portfolio_indirect_positions['asset_type'] == 'cash', 'holding_name'] = 'Cash'
-    portfolio_indirect_positions.loc[portfolio_indirect_positions['asset_type'] == 'cash', 'holding_percent'] = 1.0
-    portfolio_indirect_positions.loc[portfolio_indirect_positions['asset_type'] == 'cash', 'holding_daily_return'] = 0.0
-    portfolio_indirect_positions.loc[
-        portfolio_indirect_positions['asset_type'] == 'cash', 'holding_annual_return'] = 0.0
-
-    portfolio_indirect_positions['pct_of_portfolio'] = portfolio_indirect_positions['pct_of_portfolio'] * \
-                                                       portfolio_indirect_positions['holding_percent']
-    portfolio_indirect_positions['current_value'] = portfolio_indirect_positions['current_value'] * \
-                                                    portfolio_indirect_positions['holding_percent']
-
-    cols_to_groupby = [
-        'holding_ticker',
-        'holding_name'
-    ]
-
-    cols_to_sum = [
-        'current_value',
-        'pct_of_portfolio'
-    ]
-
-    cols_to_first = [
-        'holding_daily_return',
-        'holding_annual_return'
-    ]
-
-    sums = portfolio_indirect_positions[cols_to_groupby + cols_to_sum].groupby(cols_to_groupby).sum().reset_index()
-    firsts = portfolio_indirect_positions[cols_to_groupby + cols_to_first].groupby(
-        cols_to_groupby).first().reset_index()
-    result = sums.merge(firsts, on=cols_to_groupby, how='left').sort_values(by='pct_of_portfolio',
-                                                                            ascending=False).rename(
+    return calculate_kpis_portfolio_level_over_dates(grid_with_kpis, kpis_config, get_daily_returns(panel), risk_config)
+
+
+def get_fund_holdings(
+        etfs: list,
+        tickers_to_replace: dict,
+        max_depth: int = 1,
+        holdings_scraping_config: dict = None,
+        holdings_cache_config: dict = None,
+        symbol_index_config: dict = None,
+        price_cache_config: dict = None
+) -> pd.DataFrame:
+    # holdings of the etfs and, up to max_depth levels down, of any constituent that turns out to hold others
+    fund_holdings = []
+    funds_to_look_up = list(etfs)
+    looked_up = set()
+    overridden = set(tickers_to_replace.values())
+    for depth in range(max_depth):
+        funds_to_look_up = [x for x in dict.fromkeys(funds_to_look_up) if x not in looked_up]
+        if not funds_to_look_up:
+            break
+        looked_up.update(funds_to_look_up)
+
+        level_holdings = []
+        for fund, records in zip(funds_to_look_up, get_cached_holdings(funds_to_look_up, holdings_scraping_config,
+                                                                       holdings_cache_config)):
+            holdings = holdings_records_to_df(records, tickers_to_replace)
+            holdings['fund'] = fund
+            level_holdings.append(holdings)
+
+        # the symbols tickers_to_replace doesn't map go through the symbol index, the ones it can't resolve stay
+        # in the look-through but are not priced
+        symbols = [x for holdings in level_holdings for x in holdings['symbol'] if isinstance(x, str)]
+        resolved = resolve_symbols([x for x in dict.fromkeys(symbols) if x not in overridden], symbol_index_config,
+                                   (price_cache_config or {}).get('download'))
+        for holdings in level_holdings:
+            tickers = holdings['symbol'].map(resolved)
+            holdings['resolved'] = tickers.notna() | ~holdings['symbol'].isin(list(resolved))
+            holdings['symbol'] = tickers.fillna(holdings['symbol'])
+        fund_holdings.extend(level_holdings)
+        funds_to_look_up = [x for holdings in level_holdings for x in holdings['symbol']]
+
+    fund_holdings = pd.concat(fund_holdings + [pd.DataFrame(columns=HOLDINGS_COLUMNS + ['fund', 'resolved'])],
+                              ignore_index=True).rename(
         columns={
-            'holding_ticker': 'Ticker',
-            'holding_name': 'Name',
-            'current_value': 'Value',
-            'pct_of_portfolio': 'Pct',
-            'holding_daily_return': '∆ daily',
-            'holding_annual_return': '∆ annual',
+            'symbol': 'ticker',
+            'holdingName': 'holding_name',
+            'holdingPercent': 'weight'
         }
     )
+    fund_holdings['weight'] = pd.to_numeric(fund_holdings['weight'], errors='coerce').fillna(0.0)
+    fund_holdings['resolved'] = fund_holdings['resolved'].fillna(True).astype(bool)
 
-    return result
+    return fund_holdings
 
+
+def get_priced_holdings(
+        fund_holdings: pd.DataFrame
+) -> list:
+    # the tickers of the holdings that have prices, the ones the symbol index could not resolve are left out
+    return fund_holdings.loc[fund_holdings['resolved'], 'ticker'].unique().tolist()
+
+
+def get_indirect_positions(
+        portfolio_with_kpis: pd.DataFrame,
+        tickers_to_replace: dict,
+        testing: bool = False,
+        testing_date: str = '2021-02-26',
+        price_cache_config: dict = None,
+        holdings_scraping_config: dict = None,
+        holdings_cache_config: dict = None,
+        look_through_config: dict = None,
+        panel: pd.DataFrame = None,
+        fund_holdings: pd.DataFrame = None,
+        symbol_index_config: dict = None
+) -> pd.DataFrame:
+    look_through_config = look_through_config or {}
+
+    # cash is pooled into a single CASH position, whatever the ticker used for it in the portfolio
+    positions = portfolio_with_kpis[['ticker', 'asset_type', 'current_value']].copy(deep=False)
+    positions['ticker'] = positions['ticker'].astype(str).where(positions['asset_type'] != 'cash', 'CASH')
+    position_values = positions.groupby('ticker')['current_value'].sum()
+    portfolio_total_value = position_values.sum()
+    etfs_in_portfolio = positions[positions['asset_type'] == 'etf']['ticker'].unique().tolist()
+
+    if fund_holdings is None:
+        with stage('holdings_scraping'):
+            fund_holdings = get_fund_holdings(etfs_in_portfolio,
+                                              tickers_to_replace,
+                                              max_depth=look_through_config.get('max_depth', 1),
+                                              holdings_scraping_config=holdings_scraping_config,
+                                              holdings_cache_config=holdings_cache_config,
+                                              symbol_index_config=symbol_index_config,
+                                              price_cache_config=price_cache_config)
+
+    with stage('look_through'):
+        nodes, weights = build_weight_matrix(fund_holdings, tickers=position_values.index.tolist())
+        exposures = get_exposures(position_values, nodes, resolve_look_through(nodes, weights))
+
+    names = fund_holdings.drop_duplicates('ticker').set_index('ticker')['holding_name']
+    tickers = exposures.index.to_series()
+    result = pd.DataFrame({
+        'Ticker': tickers.to_numpy(),
+        'Name': tickers.map(names).fillna(tickers).to_numpy(),
+        'Value': exposures.to_numpy(),
+        'Pct': exposures.to_numpy() / portfolio_total_value
+    })
+    result.loc[result['Ticker'] == 'CASH', 'Name'] = 'Cash'
+
+    with stage('holdings_prices'):
+        unpriced = fund_holdings.loc[~fund_holdings['resolved'], 'ticker']
+        prices = get_ticker_prices(result[(result['Ticker'] != 'CASH') & ~result['Ticker'].isin(unpriced)]
+                                   .rename(columns={'Ticker': 'ticker'}),
+                                   testing=testing, testing_date=testing_date,
+                                   price_cache_config=price_cache_config, panel=panel).set_index('ticker')
+    result['∆ daily'] = result['Ticker'].map(prices['todays_price'] / prices['yesterdays_price'] - 1)
+    result['∆ annual'] = result['Ticker'].map(prices['todays_price'] / prices['lastyears_price'] - 1)
+
+    return result.sort_values(by='Pct', ascending=False)
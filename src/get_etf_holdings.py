@@ -1,32 +1,130 @@
 import requests as _requests
 import json as _json
 import re as _re
+import random as _random
+import time as _time
+from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
 import pandas as pd
 
+HOLDINGS_URL = 'https://finance.yahoo.com/quote/{etf}/holdings?p={etf}'
+HOLDINGS_COLUMNS = ['symbol', 'holdingName', 'holdingPercent']
 
-def get_json(url, proxy=None):
-    html = _requests.get(url=url, proxies=proxy).text
+_FORMATTED_VALUE_KEYS = {'raw', 'fmt', 'longFmt'}
+_NEXT_STORE = _re.compile(r'"\w+Store"\s*:\s*\{')
+_TOP_HOLDINGS = _re.compile(r'"topHoldings"\s*:\s*')
 
-    if "QuoteSummaryStore" not in html:
-        html = _requests.get(url=url, proxies=proxy).text
-        if "QuoteSummaryStore" not in html:
-            return {}
+_kept_sessions = {}
 
-    json_str = html.split('root.App.main =')[1].split(
-        '(this)')[0].split(';\n}')[0].strip()
-    data = _json.loads(json_str)[
-        'context']['dispatcher']['stores']['QuoteSummaryStore']
 
-    # return data
-    new_data = _json.dumps(data).replace('{}', 'null')
-    new_data = _re.sub(
-        r'\{[\'|\"]raw[\'|\"]:(.*?),(.*?)\}', r'\1', new_data)
+def get_session(pool_size: int = 10) -> _requests.Session:
+    # one session shared by all worker threads, so connections to Yahoo are pooled and reused
+    session = _requests.Session()
+    adapter = _requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['User-Agent'] = 'Mozilla/5.0'
+    return session
 
-    return _json.loads(new_data)
 
+def get_html(url, proxy=None, session=None, timeout=10, retries=3, backoff=1.0):
+    # retries failed requests and pages without QuoteSummaryStore, sleeping with exponential backoff and full
+    # jitter so concurrent workers don't retry in lockstep
+    session = session or _requests
+    for attempt in range(retries + 1):
+        try:
+            html = session.get(url=url, proxies=proxy, timeout=timeout).text
+            if "QuoteSummaryStore" in html:
+                return html
+        except _requests.RequestException as err:
+            print(f' - Request to {url} failed: {err}')
+        if attempt < retries:
+            _time.sleep(_random.uniform(0, backoff * 2 ** attempt))
 
-def get_json_and_replace_tickers(tickers_to_replace, url, proxy=None):
-    etf_holdings_df = pd.DataFrame(get_json(url, proxy)['topHoldings']['holdings'])
+    return None
+
+
+def _unwrap_values(obj):
+    # {} becomes null and formatted values like {"raw": 0.05, "fmt": "5.00%"} collapse to their raw value
+    if not obj:
+        return None
+    if 'raw' in obj and obj.keys() <= _FORMATTED_VALUE_KEYS:
+        return obj['raw']
+    return obj
+
+
+_DECODER = _json.JSONDecoder(object_hook=_unwrap_values)
+
+
+def extract_top_holdings(html):
+    # decodes only the topHoldings subtree of QuoteSummaryStore instead of the whole root.App.main blob
+    store_start = html.find('"QuoteSummaryStore"')
+    if store_start == -1:
+        return None
+
+    # keys are only looked up until the next store starts, so a topHoldings of another store is never picked up
+    next_store = _NEXT_STORE.search(html, store_start + len('"QuoteSummaryStore"'))
+    top_holdings = _TOP_HOLDINGS.search(html, store_start, next_store.start() if next_store else len(html))
+    if top_holdings is None:
+        return {}
+
+    return _DECODER.raw_decode(html, top_holdings.end())[0] or {}
+
+
+def get_json(url, proxy=None, session=None, timeout=10, retries=1, backoff=1.0):
+    html = get_html(url, proxy, session, timeout, retries, backoff)
+    if html is None:
+        return {}
+
+    return {'topHoldings': extract_top_holdings(html)}
+
+
+def get_holdings_records(url, proxy=None, session=None, timeout=10, retries=1, backoff=1.0):
+    # None when the page could not be fetched, an empty list when the quote has no top holdings
+    data = get_json(url, proxy, session, timeout, retries, backoff)
+    if not data:
+        return None
+
+    return (data.get('topHoldings') or {}).get('holdings') or []
+
+
+def holdings_records_to_df(holdings_records, tickers_to_replace):
+    etf_holdings_df = pd.DataFrame(holdings_records, columns=HOLDINGS_COLUMNS)
     etf_holdings_df['symbol'] = etf_holdings_df['symbol'].replace(tickers_to_replace)
 
     return etf_holdings_df
+
+
+def get_json_and_replace_tickers(tickers_to_replace, url, proxy=None, session=None, timeout=10, retries=1,
+                                 backoff=1.0):
+    return holdings_records_to_df(get_holdings_records(url, proxy, session, timeout, retries, backoff) or [],
+                                  tickers_to_replace)
+
+
+def get_holdings_for_etfs(
+        etfs: list,
+        max_workers: int = 8,
+        timeout: float = 10,
+        retries: int = 3,
+        backoff: float = 1.0,
+        proxy: dict = None,
+        keep_session: bool = False
+) -> list:
+    # scrapes the holdings records of every etf with at most max_workers requests in flight; results keep the order
+    # of etfs and are None for pages that could not be fetched. With keep_session the session and its connections
+    # stay open for the next call, as a resident process wants.
+    if keep_session and max_workers in _kept_sessions:
+        session = _kept_sessions[max_workers]
+    else:
+        session = get_session(pool_size=max_workers)
+        if keep_session:
+            _kept_sessions[max_workers] = session
+
+    def get_etf_holdings(etf):
+        return get_holdings_records(HOLDINGS_URL.format(etf=etf), proxy, session, timeout, retries, backoff)
+
+    try:
+        with _ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(get_etf_holdings, etfs))
+    finally:
+        if not keep_session:
+            session.close()
@@ -1,7 +1,49 @@
 from oauth2 import get_oauth_token_and_update_config, refresh_authorization, get_authorization
+import hashlib
+import json
+import os
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import requests
+from dashboard import preprocess_portfolio_dataframe
+from ledger import get_open_lots
+
+SHEETS_URL = 'https://sheets.googleapis.com/v4/spreadsheets/{google_sheet_id}/values/{sheet_name}!{_range}'
+DRIVE_FILE_URL = 'https://www.googleapis.com/drive/v3/files/{google_sheet_id}?fields=modifiedTime'
+SHEET_CACHE_DIR = 'sheets'
+
+_session = None
+
+
+def get_session() -> requests.Session:
+    # a single session for all the calls to google, so the connection is kept alive between them
+    global _session
+    if _session is None:
+        _session = requests.Session()
+    return _session
+
+
+def get_column_letter(n_columns: int) -> str:
+    letters = ''
+    while n_columns > 0:
+        n_columns, remainder = divmod(n_columns - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def strip_cells(df: pd.DataFrame) -> pd.DataFrame:
+    # all the cells are stripped in a single pass, empty ones become missing
+    cells = pd.Series(df.to_numpy(dtype=object).ravel(), dtype=object).str.strip()
+    return pd.DataFrame(cells.to_numpy().reshape(df.shape), columns=df.columns).replace('', np.nan)
+
+
+def values_to_df(values: list) -> pd.DataFrame:
+    # rows come back without their trailing empty cells, so they are padded to the header first
+    header = values[0]
+    rows = [row[:len(header)] + [''] * (len(header) - len(row)) for row in values[1:]]
+    return strip_cells(pd.DataFrame(rows, columns=header, dtype=object))
 
 
 def get_google_sheet_df(
@@ -12,13 +54,149 @@ def get_google_sheet_df(
 ) -> pd.DataFrame:
     """from: https://stackoverflow.com/questions/52365907/how-to-access-google-sheets-data-using-python-requests-module"""
 
-    url = f'https://sheets.googleapis.com/v4/spreadsheets/{google_sheet_id}/values/{sheet_name}!{_range}'
+    url = SHEETS_URL.format(google_sheet_id=google_sheet_id, sheet_name=sheet_name, _range=_range)
     headers = {'authorization': f'Bearer {access_token}',
                'Content-Type': 'application/vnd.api+json'}
 
-    r = requests.get(url, headers=headers)
+    r = get_session().get(url, headers=headers)
     values = r.json()['values']
-    df = pd.DataFrame(values[1:])
-    df.columns = values[0]
-    df = df.apply(lambda x: x.str.strip()).replace('', np.nan)
+    return values_to_df(values)
+
+
+def get_google_sheet_modified_time(
+        access_token: str,
+        google_sheet_id: str
+) -> str:
+    # last modification time of the spreadsheet from the drive api, None if it can't be known
+    url = DRIVE_FILE_URL.format(google_sheet_id=google_sheet_id)
+    try:
+        r = get_session().get(url, headers={'authorization': f'Bearer {access_token}'}, timeout=10)
+        r.raise_for_status()
+        return r.json()['modifiedTime']
+    except (requests.RequestException, ValueError, KeyError) as e:
+        print(f' - Could not check if the sheet changed ({e}), it is read again')
+        return None
+
+
+def get_portfolio_df(
+        access_token: str,
+        google_sheet_id: str,
+        csv_schema: dict,
+        sheet_cache_config: dict = None,
+        sheet_name: str = 'portfolio'
+) -> pd.DataFrame:
+    # typed portfolio frame of the sheet. The parsed frame is cached with the modification time of the spreadsheet and
+    # reused for as long as the spreadsheet doesn't change; a change of the schema also invalidates it.
+    if not sheet_cache_config or not sheet_cache_config.get('enabled', False):
+        return preprocess_portfolio_dataframe(get_google_sheet_df(access_token, google_sheet_id, sheet_name),
+                                              csv_schema)
+
+    cache_dir = os.path.join(sheet_cache_config.get('cache_dir', '.cache'), SHEET_CACHE_DIR)
+    frame_path = os.path.join(cache_dir, f'{google_sheet_id}_{sheet_name}.feather')
+    meta_path = os.path.join(cache_dir, f'{google_sheet_id}_{sheet_name}.json')
+    schema_hash = hashlib.sha1(json.dumps(csv_schema, sort_keys=True).encode()).hexdigest()
+
+    meta = {}
+    if os.path.exists(meta_path) and os.path.exists(frame_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+    modified_time = get_google_sheet_modified_time(access_token, google_sheet_id)
+    if modified_time is not None and meta.get('modified_time') == modified_time \
+            and meta.get('schema_hash') == schema_hash:
+        print(' - The sheet has not changed since the last run, using the cached portfolio')
+        return pd.read_feather(frame_path)
+
+    # only the columns populated in the last load are requested, with a margin for new ones. A header reaching the end
+    # of the range may have been cut short, so the full default range is read then.
+    _range = 'A:Z'
+    if meta.get('n_columns'):
+        _range = f'A:{get_column_letter(meta["n_columns"] + 2)}'
+    df = get_google_sheet_df(access_token, google_sheet_id, sheet_name, _range)
+    if _range != 'A:Z' and len(df.columns) >= meta['n_columns'] + 2:
+        df = get_google_sheet_df(access_token, google_sheet_id, sheet_name)
+    n_columns = len(df.columns)
+    df = preprocess_portfolio_dataframe(df, csv_schema)
+
+    if modified_time is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        df.reset_index(drop=True).to_feather(frame_path + '.tmp')
+        os.replace(frame_path + '.tmp', frame_path)
+        with open(meta_path, 'w') as f:
+            json.dump({'modified_time': modified_time, 'schema_hash': schema_hash, 'n_columns': n_columns}, f)
+
     return df
+
+
+def get_schema_columns(
+        columns: list,
+        csv_schema: dict
+) -> list:
+    # columns of a file that are in the schema, whatever their case
+    return [x for x in columns if x.lower() in csv_schema]
+
+
+def read_csv_portfolio(
+        path: str,
+        csv_schema: dict
+) -> pd.DataFrame:
+    return strip_cells(pd.read_csv(path, usecols=lambda x: x.lower() in csv_schema, dtype=str))
+
+
+def read_parquet_portfolio(
+        path: str,
+        csv_schema: dict
+) -> pd.DataFrame:
+    # memory mapped, and only the schema columns are read from the file
+    columns = get_schema_columns(pq.read_schema(path, memory_map=True).names, csv_schema)
+    return pq.read_table(path, columns=columns, memory_map=True).to_pandas()
+
+
+def read_arrow_portfolio(
+        path: str,
+        csv_schema: dict
+) -> pd.DataFrame:
+    # arrow ipc file (feather v2) or stream, memory mapped so the columns that are not in the schema are never read
+    with pa.memory_map(path) as source:
+        try:
+            table = pa.ipc.open_file(source).read_all()
+        except pa.ArrowInvalid:
+            source.seek(0)
+            table = pa.ipc.open_stream(source).read_all()
+        return table.select(get_schema_columns(table.column_names, csv_schema)).to_pandas()
+
+
+PORTFOLIO_READERS = {
+    'csv': read_csv_portfolio,
+    'parquet': read_parquet_portfolio,
+    'arrow': read_arrow_portfolio,
+}
+
+
+def load_portfolio(
+        portfolio_source: dict,
+        csv_schema: dict,
+        access_token: str = None,
+        sheet_cache_config: dict = None,
+        ledger_config: dict = None
+) -> pd.DataFrame:
+    # typed portfolio frame from a google sheet (sheet_id) or a local csv, parquet or arrow file (path). A ledger source
+    # lists transactions instead of positions, and is reduced to its open lots with the cost basis method of the config.
+    if portfolio_source.get('ledger', False):
+        ledger_config = ledger_config or {}
+        transactions = load_portfolio(dict(portfolio_source, ledger=False), ledger_config['schema_fields'],
+                                      access_token, sheet_cache_config)
+        method = portfolio_source.get('method', ledger_config.get('method', 'fifo'))
+        return get_open_lots(transactions, csv_schema, method)
+
+    source_type = portfolio_source.get('type', 'google_sheet')
+    if source_type == 'google_sheet':
+        return get_portfolio_df(access_token, portfolio_source['sheet_id'], csv_schema, sheet_cache_config,
+                                portfolio_source.get('sheet_name', 'portfolio'))
+    if source_type not in PORTFOLIO_READERS:
+        raise ValueError(f'Unknown portfolio source {source_type}, '
+                         f'use one of {["google_sheet"] + list(PORTFOLIO_READERS)}')
+
+    print(f'Reading the portfolio from {portfolio_source["path"]}')
+    return preprocess_portfolio_dataframe(PORTFOLIO_READERS[source_type](portfolio_source['path'], csv_schema),
+                                          csv_schema)
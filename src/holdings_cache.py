@@ -0,0 +1,146 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from get_etf_holdings import get_holdings_for_etfs
+
+HOLDINGS_CACHE_FILE = 'holdings.sqlite'
+# the snapshots a resident process read or stored, by cache dir, so that its runs only go to the file for the etfs
+# it has no snapshot of yet or whose snapshot expired there. They expire on the same ttl as the ones in the file.
+_resident_snapshots = {}
+_resident_snapshots_lock = threading.Lock()
+
+
+def open_holdings_cache(cache_dir: str) -> sqlite3.Connection:
+    os.makedirs(cache_dir, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(cache_dir, HOLDINGS_CACHE_FILE))
+    conn.execute('CREATE TABLE IF NOT EXISTS holdings '
+                 '(etf TEXT PRIMARY KEY, fetched_at REAL NOT NULL, holdings TEXT NOT NULL)')
+    return conn
+
+
+def read_snapshots(
+        conn: sqlite3.Connection,
+        etfs: list
+) -> dict:
+    rows = conn.execute(f'SELECT etf, fetched_at, holdings FROM holdings WHERE etf IN ({",".join("?" * len(etfs))})',
+                        etfs)
+    return {etf: (fetched_at, json.loads(holdings)) for etf, fetched_at, holdings in rows}
+
+
+def store_snapshots(
+        conn: sqlite3.Connection,
+        snapshots: dict
+) -> dict:
+    now = time.time()
+    conn.executemany('INSERT OR REPLACE INTO holdings (etf, fetched_at, holdings) VALUES (?, ?, ?)',
+                     [(etf, now, json.dumps(records)) for etf, records in snapshots.items()])
+    conn.commit()
+    return {etf: (now, records) for etf, records in snapshots.items()}
+
+
+def read_resident_snapshots(
+        cache_dir: str,
+        etfs: list
+) -> dict:
+    with _resident_snapshots_lock:
+        snapshots = _resident_snapshots.get(cache_dir, {})
+        return {etf: snapshots[etf] for etf in etfs if etf in snapshots}
+
+
+def keep_resident_snapshots(
+        cache_dir: str,
+        snapshots: dict
+):
+    with _resident_snapshots_lock:
+        _resident_snapshots.setdefault(cache_dir, {}).update(snapshots)
+
+
+def scrape_holdings(
+        etfs: list,
+        holdings_scraping_config: dict
+) -> dict:
+    scraped = get_holdings_for_etfs(etfs,
+                                    max_workers=holdings_scraping_config.get('max_workers', 8),
+                                    timeout=holdings_scraping_config.get('timeout_seconds', 10),
+                                    retries=holdings_scraping_config.get('retries', 3),
+                                    backoff=holdings_scraping_config.get('backoff_seconds', 1.0),
+                                    keep_session=holdings_scraping_config.get('keep_session', False))
+    return dict(zip(etfs, scraped))
+
+
+def refresh_snapshots(
+        etfs: list,
+        cache_dir: str,
+        holdings_scraping_config: dict,
+        resident: bool = False
+):
+    # pages that came back without QuoteSummaryStore keep their previous snapshot
+    scraped = scrape_holdings(etfs, holdings_scraping_config)
+    conn = open_holdings_cache(cache_dir)
+    try:
+        stored = store_snapshots(conn, {etf: records for etf, records in scraped.items() if records is not None})
+    finally:
+        conn.close()
+    if resident:
+        keep_resident_snapshots(cache_dir, stored)
+
+
+def get_cached_holdings(
+        etfs: list,
+        holdings_scraping_config: dict = None,
+        holdings_cache_config: dict = None
+) -> list:
+    holdings_scraping_config = holdings_scraping_config or {}
+    if not holdings_cache_config or not holdings_cache_config.get('enabled', False):
+        scraped = scrape_holdings(etfs, holdings_scraping_config)
+        for etf in [etf for etf, records in scraped.items() if records is None]:
+            print(f' - Could not get the holdings of {etf}, it is kept as a single position')
+        return [scraped[etf] or [] for etf in etfs]
+
+    cache_dir = holdings_cache_config.get('cache_dir', '.cache')
+    ttl_seconds = holdings_cache_config.get('ttl_days', 30) * 86400
+    refresh_ahead_seconds = holdings_cache_config.get('refresh_ahead_days', 0) * 86400
+    resident = holdings_cache_config.get('resident', False)
+
+    conn = open_holdings_cache(cache_dir)
+    try:
+        now = time.time()
+        # a resident process reads the file only for the etfs it holds no snapshot of, or an expired one that another
+        # process may have refreshed since
+        snapshots = read_resident_snapshots(cache_dir, etfs) if resident else {}
+        to_read = [etf for etf in etfs if etf not in snapshots or now - snapshots[etf][0] >= ttl_seconds]
+        if to_read:
+            snapshots.update(read_snapshots(conn, to_read))
+            if resident:
+                keep_resident_snapshots(cache_dir, {etf: snapshots[etf] for etf in to_read if etf in snapshots})
+        expired = [etf for etf in etfs if etf not in snapshots or now - snapshots[etf][0] >= ttl_seconds]
+        # snapshots close to expiring are still served, and refreshed in the background for the next run
+        expiring = [etf for etf in etfs if etf not in expired
+                    and now - snapshots[etf][0] >= ttl_seconds - refresh_ahead_seconds]
+
+        holdings = {etf: snapshots[etf][1] for etf in etfs if etf in snapshots}
+        if expired:
+            print(f' - Refreshing the holdings of {len(expired)} etfs')
+            scraped = scrape_holdings(expired, holdings_scraping_config)
+            for etf, records in scraped.items():
+                if records is None:
+                    if etf in holdings:
+                        print(f' - Could not get the holdings of {etf}, using the snapshot from '
+                              f'{time.strftime("%Y-%m-%d", time.localtime(snapshots[etf][0]))}')
+                    else:
+                        print(f' - Could not get the holdings of {etf}, it is kept as a single position')
+            refreshed = {etf: records for etf, records in scraped.items() if records is not None}
+            stored = store_snapshots(conn, refreshed)
+            if resident:
+                keep_resident_snapshots(cache_dir, stored)
+            holdings.update(refreshed)
+    finally:
+        conn.close()
+
+    if expiring:
+        threading.Thread(target=refresh_snapshots, args=(expiring, cache_dir, holdings_scraping_config, resident),
+                         name='holdings-refresh').start()
+
+    return [holdings.get(etf, []) for etf in etfs]
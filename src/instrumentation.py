@@ -0,0 +1,176 @@
+import http.client
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+# Every stage records its wall time, CPU time, peak memory and the HTTP traffic of the process while it was open.
+# Stages nest, a stage opened inside another one is recorded under the path "outer/inner" and its numbers are also
+# part of the outer stage. HTTP traffic is counted at the http.client level, which both requests (through urllib3)
+# and urllib go through, so it includes the requests made from worker threads.
+_stages = []
+_open_stages = []
+_http_counters = {'requests': 0, 'bytes_sent': 0, 'bytes_received': 0}
+_http_counters_lock = threading.Lock()
+_http_counters_installed = False
+# process totals when the run started, so a resident process running many times reports each run on its own
+_run_start = {'cpu_time': 0.0, 'requests': 0, 'bytes_sent': 0, 'bytes_received': 0}
+
+
+def _count_http(key: str, value: int):
+    with _http_counters_lock:
+        _http_counters[key] += value
+
+
+class _CountingReader:
+    # wraps the socket file of an http.client response and counts the bytes read from it
+    def __init__(self, fp):
+        self._fp = fp
+
+    def __getattr__(self, name):
+        return getattr(self._fp, name)
+
+    def read(self, *args):
+        data = self._fp.read(*args)
+        _count_http('bytes_received', len(data))
+        return data
+
+    def read1(self, *args):
+        data = self._fp.read1(*args)
+        _count_http('bytes_received', len(data))
+        return data
+
+    def readline(self, *args):
+        data = self._fp.readline(*args)
+        _count_http('bytes_received', len(data))
+        return data
+
+    def readinto(self, buffer):
+        n_bytes = self._fp.readinto(buffer)
+        _count_http('bytes_received', n_bytes or 0)
+        return n_bytes
+
+
+def install_http_counters():
+    global _http_counters_installed
+    if _http_counters_installed:
+        return
+    _http_counters_installed = True
+
+    putrequest = http.client.HTTPConnection.putrequest
+    send = http.client.HTTPConnection.send
+    response_init = http.client.HTTPResponse.__init__
+
+    def counting_putrequest(self, *args, **kwargs):
+        _count_http('requests', 1)
+        return putrequest(self, *args, **kwargs)
+
+    def counting_send(self, data):
+        # bodies can also be files or iterables, only sized payloads are counted
+        if hasattr(data, '__len__'):
+            _count_http('bytes_sent', len(data))
+        return send(self, data)
+
+    def counting_response_init(self, *args, **kwargs):
+        response_init(self, *args, **kwargs)
+        self.fp = _CountingReader(self.fp)
+
+    http.client.HTTPConnection.putrequest = counting_putrequest
+    http.client.HTTPConnection.send = counting_send
+    http.client.HTTPResponse.__init__ = counting_response_init
+
+
+def get_peak_rss_mb() -> float:
+    # high water mark of the resident memory of the process, ru_maxrss is in KB on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / (1e6 if sys.platform == 'darwin' else 1e3)
+
+
+def _get_traced_peak() -> int:
+    return tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else 0
+
+
+def start_run(trace_memory: bool = False, count_http: bool = True):
+    # clears the stages of a previous run. With trace_memory, the peak of the memory allocated by Python (and NumPy)
+    # is traced per stage, which needs tracemalloc.reset_peak from Python 3.9; otherwise only the peak RSS is kept.
+    _stages.clear()
+    _open_stages.clear()
+    with _http_counters_lock:
+        _run_start.update(_http_counters, cpu_time=time.process_time())
+    if trace_memory and hasattr(tracemalloc, 'reset_peak') and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if count_http:
+        install_http_counters()
+
+
+@contextmanager
+def stage(name: str):
+    path = '/'.join([x['stage'] for x in _open_stages] + [name])
+    if _open_stages and tracemalloc.is_tracing():
+        # the peak of the outer stage so far is kept before the peak is reset for this one
+        _open_stages[-1]['traced_peak'] = max(_open_stages[-1]['traced_peak'], _get_traced_peak())
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+
+    current = {'stage': name, 'traced_peak': 0}
+    _open_stages.append(current)
+    with _http_counters_lock:
+        http_start = dict(_http_counters)
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield
+    finally:
+        wall_time = time.perf_counter() - wall_start
+        cpu_time = time.process_time() - cpu_start
+        with _http_counters_lock:
+            http_end = dict(_http_counters)
+        _open_stages.pop()
+
+        traced_peak = max(current['traced_peak'], _get_traced_peak())
+        if _open_stages:
+            _open_stages[-1]['traced_peak'] = max(_open_stages[-1]['traced_peak'], traced_peak)
+
+        _stages.append({
+            'stage': path,
+            'wall_time_s': round(wall_time, 4),
+            'cpu_time_s': round(cpu_time, 4),
+            'peak_traced_mb': round(traced_peak / 1e6, 2) if tracemalloc.is_tracing() else None,
+            'peak_rss_mb': round(get_peak_rss_mb(), 1),
+            'http_requests': http_end['requests'] - http_start['requests'],
+            'http_bytes_sent': http_end['bytes_sent'] - http_start['bytes_sent'],
+            'http_bytes_received': http_end['bytes_received'] - http_start['bytes_received'],
+        })
+
+
+def get_stages() -> list:
+    # stages in the order they finished, so an inner stage comes before the stage holding it
+    return list(_stages)
+
+
+def write_metrics(
+        metrics_dir: str,
+        run_info: dict,
+        run_started: datetime
+) -> str:
+    os.makedirs(metrics_dir, exist_ok=True)
+    metrics = dict(run_info,
+                   run_started=run_started.isoformat(timespec='seconds'),
+                   wall_time_s=round((datetime.now() - run_started).total_seconds(), 4),
+                   cpu_time_s=round(time.process_time() - _run_start['cpu_time'], 4),
+                   peak_rss_mb=round(get_peak_rss_mb(), 1),
+                   http_requests=_http_counters['requests'] - _run_start['requests'],
+                   http_bytes_sent=_http_counters['bytes_sent'] - _run_start['bytes_sent'],
+                   http_bytes_received=_http_counters['bytes_received'] - _run_start['bytes_received'],
+                   stages=get_stages())
+
+    metrics_path = os.path.join(metrics_dir, f'metrics_{run_started:%Y%m%d_%H%M%S}.json')
+    with open(metrics_path, 'w') as file:
+        json.dump(metrics, file, indent=2)
+
+    return metrics_path
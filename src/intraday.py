@@ -0,0 +1,358 @@
+import os
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import yfinance as yf
+from dashboard import get_fund_holdings, get_price_panel, get_portfolio_prices, get_ticker_prices, \
+    calculate_kpis_asset_level, get_priced_holdings, MONEY_WEIGHTED_RETURN_KPI
+from kpi_engine import compile_kpis, get_input_arrays, evaluate_asset_kpis, reduce_kpi_sums, combine_kpi_sums, \
+    get_portfolio_kpi_formats
+from money_weighted import calculate_money_weighted_returns
+from look_through import build_weight_matrix, resolve_look_through
+from styles import render_df, render_indirect_holdings_df
+from price_cache import download_in_chunks
+
+LIVE_VIEW_FILE = 'live.html'
+
+
+def download_intraday_closes(
+        tickers: list,
+        interval: str = '1m'
+) -> pd.DataFrame:
+    # the bars of today's session so far, a time x ticker frame of their closes
+    prices = yf.download(tickers, period='1d', interval=interval, progress=False)
+    if prices.empty:
+        return pd.DataFrame(columns=tickers, dtype=float)
+    close = prices['Close']
+    if isinstance(close, pd.Series):
+        close = close.to_frame(name=tickers[0])
+    close.columns = [str(x) for x in close.columns]
+    return close
+
+
+# Quote feeds. A feed is made from its config and the last known prices, and returns a function giving the latest
+# price of each requested ticker as a series; tickers without a quote can be left out.
+def make_yahoo_feed(
+        feed_config: dict,
+        start_prices: pd.Series
+):
+    # the bars are downloaded as the closes are, in rate limited chunks (with the download config of the price cache
+    # unless the feed has its own). A ticker missing from a poll keeps its price until the next one, so only the
+    # chunks that failed outright are retried.
+    interval = feed_config.get('interval', '1m')
+    download_config = feed_config.get('download')
+
+    def get_quotes(tickers: list) -> pd.Series:
+        closes = download_in_chunks(download_intraday_closes, tickers, (interval,), download_config,
+                                    retry_errors=False)
+        if closes.empty:
+            return pd.Series(dtype=float)
+        return closes.sort_index().ffill().iloc[-1].dropna()
+
+    return get_quotes
+
+
+def make_simulated_feed(
+        feed_config: dict,
+        start_prices: pd.Series
+):
+    # seeded random walk from the last known prices, where only a share of the tickers moves on every poll, as
+    # quotes do between two polls of a real feed
+    rng = np.random.default_rng(feed_config.get('seed', 0))
+    volatility = feed_config.get('volatility', 0.002)
+    move_share = feed_config.get('move_share', 0.2)
+    prices = start_prices.dropna().astype(float).copy()
+
+    def get_quotes(tickers: list) -> pd.Series:
+        quoted = prices.index.intersection(tickers)
+        moving = quoted[rng.random(len(quoted)) < move_share]
+        prices[moving] = prices[moving] * np.exp(rng.normal(0, volatility, len(moving)))
+        return prices[quoted].copy()
+
+    return get_quotes
+
+
+QUOTE_FEEDS = {
+    'yahoo': make_yahoo_feed,
+    'simulator': make_simulated_feed,
+}
+
+
+class IntradayPortfolio:
+    # The asset level kpis of the portfolio, the portfolio kpis and the look-through exposures, kept up to date from
+    # quotes. Only the rows of the tickers whose price changed are recomputed, and the totals and exposures get the
+    # change of those rows added, rather than being summed again over the whole portfolio.
+
+    def __init__(
+            self,
+            portfolio_with_kpis: pd.DataFrame,
+            tax_rate: float,
+            nodes: pd.Index,
+            closure,
+            leaf_prices: pd.DataFrame,
+            names: pd.Series = None,
+            resum_every: int = 100,
+            kpis_config: dict = None
+    ):
+        self.kpis = portfolio_with_kpis.reset_index(drop=True).copy()
+        self.kpi_plans = compile_kpis(kpis_config)
+        self.parameters = {'tax_rate': tax_rate}
+        # the rows are updated as plain arrays, of the columns the kpis are evaluated from and of the kpis, a quote
+        # only touching a few of them
+        self.kpi_columns = ['todays_price'] + list(self.kpi_plans['asset_outputs'])
+        columns = self.kpi_plans['asset_plan'].get_inputs() + self.kpi_plans['summed_plan'].get_inputs()
+        self.values = {x: np.array(y) for x, y in
+                       get_input_arrays(self.kpis, list(dict.fromkeys(columns + self.kpi_columns))).items()}
+        self.nodes = nodes
+        self.closure = closure.tocsr()
+        self.names = names if names is not None else pd.Series(dtype=str)
+        self.resum_every = resum_every
+        self.n_updates = 0
+
+        # cash is pooled into a single CASH position and never quoted, as in get_indirect_positions
+        is_cash = (self.kpis['asset_type'] == 'cash').to_numpy()
+        self.position_tickers = np.where(is_cash, 'CASH', self.kpis['ticker'].astype(str).to_numpy())
+        self.rows_by_ticker = {ticker: rows for ticker, rows in
+                               pd.Series(self.position_tickers).groupby(self.position_tickers).indices.items()
+                               if ticker != 'CASH'}
+
+        # last and previous close of every quoted ticker: the positions' from their rows, and the ones of the tickers
+        # only held through funds from leaf_prices (indexed by ticker, with yesterdays_price and todays_price)
+        price_columns = ['yesterdays_price', 'todays_price']
+        portfolio_prices = self.kpis[~is_cash][price_columns].groupby(self.position_tickers[~is_cash]).first()
+        prices = pd.concat([portfolio_prices, leaf_prices[price_columns].drop(index=portfolio_prices.index,
+                                                                              errors='ignore')]).astype(float)
+        self.prices = prices['todays_price']
+        self.yesterdays_prices = prices['yesterdays_price']
+        self.changed_at = pd.Series(pd.NaT, index=self.prices.index)
+
+        self.resum()
+
+    def get_kpis(self) -> pd.DataFrame:
+        # asset level kpis at the last quotes, as calculate_kpis_asset_level returns them
+        for column in self.kpi_columns:
+            self.kpis[column] = self.values[column]
+        money_weighted_returns = calculate_money_weighted_returns(self.values)
+        if money_weighted_returns is not None:
+            self.kpis['per_annum_mwr'] = money_weighted_returns
+        return self.kpis
+
+    def resum(self):
+        # totals from scratch, also done every resum_every updates so the rounding of the added changes can't build up
+        self.sums = reduce_kpi_sums(self.kpi_plans, self.values, self.parameters)
+        self.position_values = pd.Series(self.values['current_value']).groupby(self.position_tickers).sum()
+        values = np.zeros(len(self.nodes))
+        values[self.nodes.get_indexer(self.position_values.index)] = self.position_values.to_numpy()
+        self.exposures = self.closure.T @ values
+
+    def get_tickers(self) -> list:
+        # the tickers held directly and the priced holdings, the ones that could not be priced are not quoted either
+        return self.prices.index[self.prices.notna()].tolist()
+
+    def update(
+            self,
+            quotes: pd.Series
+    ) -> list:
+        # applies the quotes and returns the tickers whose price changed
+        quotes = quotes.dropna()
+        quotes = quotes[quotes.index.isin(self.prices.index)]
+        changed = quotes[quotes != self.prices[quotes.index]]
+        if changed.empty:
+            return []
+        self.prices[changed.index] = changed
+        self.changed_at[changed.index] = pd.Timestamp.now()
+
+        changed_positions = [x for x in changed.index if x in self.rows_by_ticker]
+        if changed_positions:
+            rows = [self.rows_by_ticker[x] for x in changed_positions]
+            n_rows = [len(x) for x in rows]
+            rows = np.concatenate(rows)
+            before = {x: y[rows] for x, y in self.values.items()}
+            after = dict(before, todays_price=np.repeat(self.prices[changed_positions].to_numpy(), n_rows))
+            after.update(evaluate_asset_kpis(self.kpi_plans, after, self.parameters))
+
+            self.sums += reduce_kpi_sums(self.kpi_plans, after, self.parameters) \
+                - reduce_kpi_sums(self.kpi_plans, before, self.parameters)
+            for column in self.kpi_columns:
+                self.values[column][rows] = after[column]
+
+            # the exposures move with the value of the positions, through their rows of the look-through closure
+            value_changes = np.add.reduceat(np.nan_to_num(after['current_value'] - before['current_value']),
+                                            np.cumsum([0] + n_rows[:-1]))
+            self.position_values[changed_positions] += value_changes
+            self.exposures += self.closure[self.nodes.get_indexer(changed_positions)].T @ value_changes
+
+        self.n_updates += 1
+        if self.resum_every and self.n_updates % self.resum_every == 0:
+            self.resum()
+
+        return changed.index.tolist()
+
+    def get_portfolio_kpis(self) -> dict:
+        # the money-weighted return doesn't add up from the rows, it is solved again from all of them
+        portfolio_kpis = combine_kpi_sums(self.kpi_plans, self.sums, self.parameters)
+        single_group = np.zeros(len(self.kpis), dtype=int)
+        money_weighted_return = calculate_money_weighted_returns(self.values, single_group, 1)
+        if money_weighted_return is not None:
+            portfolio_kpis[MONEY_WEIGHTED_RETURN_KPI] = money_weighted_return[0]
+        return portfolio_kpis
+
+    def get_positions(self) -> pd.DataFrame:
+        tickers = self.position_values.index
+        prices = self.prices.reindex(tickers)
+        return pd.DataFrame({
+            'Price': prices.to_numpy(),
+            '∆ daily': (prices / self.yesterdays_prices.reindex(tickers) - 1).to_numpy(),
+            'Value': self.position_values.to_numpy(),
+            'Updated': self.changed_at.reindex(tickers).dt.strftime('%H:%M:%S').fillna('-').to_numpy()
+        }, index=tickers.rename('Ticker')).sort_values(by='Value', ascending=False)
+
+    def get_indirect_positions(
+            self,
+            top: int = None
+    ) -> pd.DataFrame:
+        held = np.flatnonzero(self.exposures)
+        tickers = pd.Series(self.nodes[held])
+        result = pd.DataFrame({
+            'Ticker': tickers.to_numpy(),
+            'Name': tickers.map(self.names).fillna(tickers).to_numpy(),
+            'Value': self.exposures[held],
+            'Pct': self.exposures[held] / self.position_values.sum(),
+            '∆ daily': (self.prices.reindex(tickers) / self.yesterdays_prices.reindex(tickers) - 1).to_numpy()
+        })
+        result.loc[result['Ticker'] == 'CASH', 'Name'] = 'Cash'
+        result = result.sort_values(by='Pct', ascending=False)
+
+        return result if top is None else result.head(top)
+
+
+def write_live_view(
+        intraday_portfolio: IntradayPortfolio,
+        output_dir: str,
+        refresh_seconds: int,
+        top: int = 25
+) -> str:
+    # a page reloading itself every refresh_seconds, replaced atomically so a reload never sees half of it
+    global_kpis = pd.DataFrame.from_dict(intraday_portfolio.get_portfolio_kpis(), orient='index').rename(
+        columns={0: datetime.now().strftime('%Y-%m-%d %H:%M:%S')})
+    amount_cols, pct_cols = get_portfolio_kpi_formats(intraday_portfolio.kpi_plans)
+    tables = [
+        render_df(global_kpis, amount_cols=amount_cols, pct_cols=pct_cols + [MONEY_WEIGHTED_RETURN_KPI],
+                  row_wise_style=True),
+        render_df(intraday_portfolio.get_positions(), amount_cols=['Price', 'Value'], pct_cols=['∆ daily'],
+                  str_cols=['Updated'], bar_cols=['∆ daily']),
+        render_indirect_holdings_df(intraday_portfolio.get_indirect_positions(top), amount_cols=['Value'],
+                                    pct_cols=['Pct', '∆ daily'], str_cols=['Ticker', 'Name'],
+                                    bar_cols=['Value', '∆ daily']),
+    ]
+    page = (f'<html><head><meta charset="utf-8"><meta http-equiv="refresh" content="{refresh_seconds}">'
+            f'<title>Portfolio live</title></head><body>\n'
+            + '\n<br>\n'.join(tables)
+            + '\n</body></html>\n')
+
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, LIVE_VIEW_FILE)
+    with open(path + '.tmp', 'w') as file:
+        file.write(page)
+    os.replace(path + '.tmp', path)
+
+    return path
+
+
+def create_intraday_portfolio(
+        df: pd.DataFrame,
+        csv_schema: dict,
+        testing: bool,
+        date_to_use: str,
+        tax_rate: float,
+        tickers_to_replace: dict,
+        price_cache_config: dict = None,
+        holdings_scraping_config: dict = None,
+        holdings_cache_config: dict = None,
+        look_through_config: dict = None,
+        resum_every: int = 100,
+        kpis_config: dict = None,
+        symbol_index_config: dict = None
+) -> IntradayPortfolio:
+    # the starting point is the end of day computation, with the look-through resolved once for the whole session
+    etfs = df[df['asset_type'] == 'etf']['ticker'].astype(str).unique().tolist()
+    fund_holdings = get_fund_holdings(etfs, tickers_to_replace,
+                                      max_depth=(look_through_config or {}).get('max_depth', 1),
+                                      holdings_scraping_config=holdings_scraping_config,
+                                      holdings_cache_config=holdings_cache_config,
+                                      symbol_index_config=symbol_index_config,
+                                      price_cache_config=price_cache_config)
+    portfolio_tickers = df[df['asset_type'] != 'cash']['ticker'].astype(str).unique().tolist()
+    tickers = list(dict.fromkeys(portfolio_tickers + get_priced_holdings(fund_holdings)))
+    panel = get_price_panel(tickers, testing, date_to_use, price_cache_config)
+
+    # the quotes are today's closes to come, the daily changes are from the last close before today
+    portfolio_with_prices = get_portfolio_prices(df, csv_schema, testing=testing, testing_date=date_to_use,
+                                                 price_cache_config=price_cache_config, panel=panel,
+                                                 live_session=True)
+    portfolio_with_kpis = calculate_kpis_asset_level(portfolio_with_prices, tax_rate, testing=testing,
+                                                     testing_date=date_to_use, kpis_config=kpis_config)
+
+    position_tickers = portfolio_with_kpis['ticker'].astype(str).where(portfolio_with_kpis['asset_type'] != 'cash',
+                                                                       'CASH')
+    nodes, weights = build_weight_matrix(fund_holdings, tickers=position_tickers.unique().tolist())
+    closure = resolve_look_through(nodes, weights)
+
+    # the look-through tickers are quoted too, for the daily change of the indirect positions
+    leaves = [x for x in get_priced_holdings(fund_holdings) if x not in portfolio_tickers]
+    leaf_prices = get_ticker_prices(pd.DataFrame({'ticker': leaves}), testing, date_to_use, price_cache_config,
+                                    price_columns=['yesterdays_price', 'todays_price'],
+                                    panel=panel, live_session=True).set_index('ticker')
+    leaf_prices = leaf_prices.drop(index='CASH', errors='ignore')
+    names = fund_holdings.drop_duplicates('ticker').set_index('ticker')['holding_name']
+
+    return IntradayPortfolio(portfolio_with_kpis, tax_rate, nodes, closure, leaf_prices, names, resum_every,
+                             kpis_config)
+
+
+def run_intraday(
+        intraday_portfolio: IntradayPortfolio,
+        intraday_config: dict,
+        download_config: dict = None,
+        on_poll=None
+):
+    # polls the feed every interval_seconds and refreshes the live view, until interrupted or after max_polls polls.
+    # on_poll is called after every poll, to save the metrics of a process that may only end by being killed. Every
+    # poll prints the portfolio level KPI print_kpi, when the KPIs have it.
+    feed_config = dict({'type': 'yahoo', 'download': download_config}, **(intraday_config.get('feed') or {}))
+    feed_type = feed_config.get('type', 'yahoo')
+    if feed_type not in QUOTE_FEEDS:
+        raise ValueError(f'Unknown quote feed {feed_type}, use one of {list(QUOTE_FEEDS)}')
+    get_quotes = QUOTE_FEEDS[feed_type](feed_config, intraday_portfolio.prices)
+
+    interval_seconds = intraday_config.get('interval_seconds', 60)
+    output_dir = intraday_config.get('output_dir', 'html_outputs')
+    max_polls = intraday_config.get('max_polls')
+    tickers = intraday_portfolio.get_tickers()
+    print_kpi = intraday_config.get('print_kpi', 'Capital after liquidating post-tax')
+
+    path = write_live_view(intraday_portfolio, output_dir, interval_seconds, intraday_config.get('top_indirect', 25))
+    print(f'Live view at {os.path.abspath(path)}, polling {len(tickers)} tickers every {interval_seconds}s')
+    n_polls = 0
+    try:
+        while max_polls is None or n_polls < max_polls:
+            poll_started = time.monotonic()
+            try:
+                changed = intraday_portfolio.update(get_quotes(tickers))
+            except Exception as e:
+                print(f' - Could not get quotes ({e!r}), trying again at the next poll')
+                changed = []
+            if changed:
+                write_live_view(intraday_portfolio, output_dir, interval_seconds,
+                                intraday_config.get('top_indirect', 25))
+            n_polls += 1
+            printed = intraday_portfolio.get_portfolio_kpis().get(print_kpi)
+            print(f'{datetime.now():%H:%M:%S} - {len(changed)} prices changed'
+                  + ('' if printed is None else f', {print_kpi} {printed:,.1f}'))
+            if on_poll is not None:
+                on_poll()
+            if max_polls is None or n_polls < max_polls:
+                time.sleep(max(0.0, interval_seconds - (time.monotonic() - poll_started)))
+    except KeyboardInterrupt:
+        print('Intraday mode stopped')
@@ -0,0 +1,321 @@
+import ast
+import json
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# KPIs are named expressions, in the order they are added to the portfolio frame. Asset level expressions go over
+# the columns of the portfolio (schema fields and prices), the parameters (tax_rate) and other asset level KPIs.
+# Portfolio level expressions combine sum(...) of asset level expressions and other portfolio level KPIs.
+DEFAULT_KPIS = {
+    'asset_level': {
+        'years_since_entry': 'days(today_dt - entry_date) / 365',
+        'entry_value': 'holdings * entry_price',
+        'current_value': 'holdings * todays_price',
+        'exit_cost_total': 'exit_cost_fixed_fee + exit_cost_pct * current_value',
+        'net_gain_ex_dividend_pre_tax': 'current_value - entry_value - entry_cost - exit_cost_total',
+        'tax_on_gain': 'net_gain_ex_dividend_pre_tax * tax_rate',
+        'annual_costs_paid': 'annual_cost * years_since_entry',
+        'net_gain_ex_dividend': 'net_gain_ex_dividend_pre_tax - tax_on_gain - annual_costs_paid',
+        'net_gain': 'net_gain_ex_dividend + dividends_received - dividends_costs',
+        '1_day_roa': 'todays_price / yesterdays_price - 1',
+        'per_annum_roa_ex_dividends': '((net_gain_ex_dividend + entry_value) / entry_value) ** (1 / years_since_entry) '
+                                      '- 1',
+        'per_annum_roa': '((net_gain + entry_value) / entry_value) ** (1 / years_since_entry) - 1',
+    },
+    'portfolio_level': {
+        'Starting capital': 'sum(entry_value)',
+        'Costs paid so far': 'sum(annual_costs_paid) + sum(entry_cost)',
+        'Capital after liquidating pre-tax': 'sum(current_value) - sum(exit_cost_total)',
+        'Capital after liquidating post-tax': 'sum(current_value) - sum(exit_cost_total) - sum(tax_on_gain)',
+        'ROC per annum post-tax': 'sum(per_annum_roa * current_value) / sum(current_value)',
+    }
+}
+
+OPERATIONS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.true_divide,
+    ast.Pow: np.power,
+    ast.USub: np.negative,
+    ast.UAdd: np.positive,
+    ast.Gt: np.greater,
+    ast.GtE: np.greater_equal,
+    ast.Lt: np.less,
+    ast.LtE: np.less_equal,
+    ast.Eq: np.equal,
+    ast.NotEq: np.not_equal,
+}
+FUNCTIONS = {
+    'abs': np.abs,
+    'sqrt': np.sqrt,
+    'log': np.log,
+    'exp': np.exp,
+    'minimum': np.minimum,
+    'maximum': np.maximum,
+    'where': np.where,
+    # whole days of a timedelta, rounded down as astype('timedelta64[D]') does
+    'days': lambda x: np.floor(x / np.timedelta64(1, 'D')),
+}
+
+_compiled_kpis = {}
+
+
+class _Plan:
+    # the expressions as a graph of steps, where identical subexpressions are a single step. A step is
+    # (operation, argument, input steps), and every step comes after its inputs.
+    def __init__(self):
+        self.steps = []
+        self._step_ids = {}
+
+    def add(self, operation, argument, inputs=()):
+        key = (operation, argument, tuple(inputs))
+        if key not in self._step_ids:
+            self._step_ids[key] = len(self.steps)
+            self.steps.append(key)
+        return self._step_ids[key]
+
+    def get_inputs(self) -> list:
+        return [argument for operation, argument, inputs in self.steps if operation == 'input']
+
+    def get_last_uses(self, outputs) -> dict:
+        # steps whose values can be dropped once a step is done, as no later step uses them and they are not outputs
+        last_uses = {}
+        for step_id, (operation, argument, inputs) in enumerate(self.steps):
+            for x in inputs:
+                last_uses[x] = step_id
+        dropped = {}
+        for x, step_id in last_uses.items():
+            if x not in outputs:
+                dropped.setdefault(step_id, []).append(x)
+        return dropped
+
+
+def _parse(
+        name: str,
+        expression: str
+) -> ast.AST:
+    try:
+        return ast.parse(str(expression).strip(), mode='eval').body
+    except SyntaxError as e:
+        raise ValueError(f'KPI "{name}" is not a valid expression: {expression} ({e.msg})')
+
+
+def _unparse(node: ast.AST) -> str:
+    # ast.unparse is only there from Python 3.9, before that the error names the kind of expression
+    if hasattr(ast, 'unparse'):
+        return ast.unparse(node)
+    return f'{type(node).__name__} expression'
+
+
+def _add_expression(plan, node, name, resolve_name, resolve_sum=None):
+    # adds the steps of an expression to the plan and returns the step of its value. Names are resolved by
+    # resolve_name, and sum(...) calls by resolve_sum where aggregates are allowed.
+    def add(node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) \
+                and not isinstance(node.value, bool):
+            return plan.add('constant', float(node.value))
+        if isinstance(node, ast.Name):
+            return resolve_name(node.id)
+        if isinstance(node, ast.BinOp) and type(node.op) in OPERATIONS:
+            return plan.add('operation', type(node.op), [add(node.left), add(node.right)])
+        if isinstance(node, ast.UnaryOp) and type(node.op) in OPERATIONS:
+            return plan.add('operation', type(node.op), [add(node.operand)])
+        if isinstance(node, ast.Compare) and len(node.ops) == 1 and type(node.ops[0]) in OPERATIONS:
+            return plan.add('operation', type(node.ops[0]), [add(node.left), add(node.comparators[0])])
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+            if node.func.id == 'sum':
+                if resolve_sum is None:
+                    raise ValueError(f'KPI "{name}": sum() is only allowed in portfolio level KPIs')
+                if len(node.args) != 1:
+                    raise ValueError(f'KPI "{name}": sum() takes a single expression')
+                return resolve_sum(node.args[0], name)
+            if node.func.id in FUNCTIONS:
+                return plan.add('function', node.func.id, [add(x) for x in node.args])
+        raise ValueError(f'KPI "{name}": {_unparse(node)} is not supported, use numbers, names, + - * / ** '
+                         f'comparisons and the functions {["sum"] + list(FUNCTIONS)}')
+
+    return add(node)
+
+
+def compile_kpis(
+        kpis_config: dict = None
+) -> dict:
+    # the KPI expressions as evaluation plans, worked out once per definition: one plan over the rows for the asset
+    # level KPIs, one for the arrays summed by the portfolio level KPIs, and one combining those sums
+    kpis_config = kpis_config or DEFAULT_KPIS
+    key = json.dumps(kpis_config)
+    if key in _compiled_kpis:
+        return _compiled_kpis[key]
+
+    asset_expressions = {name: _parse(name, x) for name, x in (kpis_config.get('asset_level') or {}).items()}
+    portfolio_expressions = {name: _parse(name, x) for name, x in (kpis_config.get('portfolio_level') or {}).items()}
+
+    # asset level KPIs, resolving the names of other KPIs to their steps in dependency order
+    asset_plan = _Plan()
+    asset_steps = {}
+    in_progress = []
+
+    def resolve_asset_name(name):
+        if name not in asset_expressions:
+            return asset_plan.add('input', name)
+        if name in in_progress:
+            raise ValueError(f'KPIs depend on each other in a cycle: {" -> ".join(in_progress + [name])}')
+        if name not in asset_steps:
+            in_progress.append(name)
+            asset_steps[name] = _add_expression(asset_plan, asset_expressions[name], name, resolve_asset_name)
+            in_progress.pop()
+        return asset_steps[name]
+
+    for name in asset_expressions:
+        resolve_asset_name(name)
+
+    # portfolio level KPIs. The arrays inside sum() are read from the frame holding the asset level KPIs, and are all
+    # reduced together; what is left combines the sums and the other portfolio level KPIs.
+    summed_plan = _Plan()
+    summed_steps = []
+    totals_plan = _Plan()
+    totals_steps = {}
+
+    def resolve_sum(node, name):
+        step = _add_expression(summed_plan, node, name, lambda x: summed_plan.add('input', x))
+        if step not in summed_steps:
+            summed_steps.append(step)
+        return totals_plan.add('sum', summed_steps.index(step))
+
+    def resolve_portfolio_name(name):
+        if name not in portfolio_expressions:
+            return totals_plan.add('input', name)
+        if name in in_progress:
+            raise ValueError(f'KPIs depend on each other in a cycle: {" -> ".join(in_progress + [name])}')
+        if name not in totals_steps:
+            in_progress.append(name)
+            totals_steps[name] = _add_expression(totals_plan, portfolio_expressions[name], name,
+                                                 resolve_portfolio_name, resolve_sum)
+            in_progress.pop()
+        return totals_steps[name]
+
+    for name in portfolio_expressions:
+        resolve_portfolio_name(name)
+
+    _compiled_kpis[key] = {
+        'asset_plan': asset_plan,
+        'asset_outputs': {name: asset_steps[name] for name in asset_expressions},
+        'asset_dropped': asset_plan.get_last_uses(set(asset_steps.values())),
+        'summed_plan': summed_plan,
+        'summed_steps': summed_steps,
+        'summed_dropped': summed_plan.get_last_uses(set(summed_steps)),
+        'totals_plan': totals_plan,
+        'totals_outputs': {name: totals_steps[name] for name in portfolio_expressions},
+        # a portfolio level KPI that is a ratio (a return, a share) is shown as a percentage, the others as amounts
+        'totals_pct': [name for name, x in portfolio_expressions.items()
+                       if isinstance(x, ast.BinOp) and isinstance(x.op, ast.Div)],
+    }
+    return _compiled_kpis[key]
+
+
+def get_portfolio_kpi_formats(
+        kpi_plans: dict
+) -> tuple:
+    # the amount and the percentage columns of the portfolio level KPIs, for render_df
+    pct_cols = list(kpi_plans['totals_pct'])
+    return [x for x in kpi_plans['totals_outputs'] if x not in pct_cols], pct_cols
+
+
+def get_input_arrays(
+        df: pd.DataFrame,
+        columns: list
+) -> dict:
+    # contiguous numpy arrays of the columns, numbers as float64 with nan for the missing ones
+    arrays = {}
+    for column in columns:
+        if column not in df.columns:
+            continue
+        if pd.api.types.is_datetime64_any_dtype(df[column]):
+            arrays[column] = df[column].to_numpy(dtype='datetime64[ns]')
+        elif pd.api.types.is_numeric_dtype(df[column]):
+            arrays[column] = df[column].to_numpy(dtype='float64', na_value=np.nan)
+        else:
+            arrays[column] = df[column].to_numpy()
+    return arrays
+
+
+def _run_plan(plan, inputs, dropped=None):
+    values = [None] * len(plan.steps)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for step_id, (operation, argument, step_inputs) in enumerate(plan.steps):
+            if operation == 'input':
+                if argument not in inputs:
+                    raise ValueError(f'Unknown name {argument} in the KPIs, it is neither a KPI, a parameter nor a '
+                                     f'column of the portfolio')
+                values[step_id] = inputs[argument]
+            elif operation == 'constant':
+                values[step_id] = argument
+            elif operation == 'operation':
+                values[step_id] = OPERATIONS[argument](*[values[x] for x in step_inputs])
+            elif operation == 'function':
+                values[step_id] = FUNCTIONS[argument](*[values[x] for x in step_inputs])
+            else:
+                values[step_id] = inputs[(operation, argument)]
+            for x in (dropped or {}).get(step_id, []):
+                values[x] = None
+    return values
+
+
+def evaluate_asset_kpis(
+        kpi_plans: dict,
+        inputs: dict,
+        parameters: dict = None
+) -> dict:
+    # inputs maps names to arrays of one value per row, as get_input_arrays gives them for
+    # kpi_plans['asset_plan'].get_inputs(); parameters are scalars. Returns the array of every asset level KPI.
+    values = _run_plan(kpi_plans['asset_plan'], dict(inputs, **(parameters or {})), kpi_plans['asset_dropped'])
+    return {name: values[step] for name, step in kpi_plans['asset_outputs'].items()}
+
+
+def reduce_kpi_sums(
+        kpi_plans: dict,
+        inputs: dict,
+        parameters: dict = None,
+        groups: np.ndarray = None,
+        n_groups: int = None
+) -> np.ndarray:
+    # the totals behind the portfolio level KPIs, from the arrays of the asset level KPIs. The arrays to sum are
+    # stacked and reduced in one pass, skipping missing values as pandas does; with groups (a group number per row)
+    # there is one column of totals per group, summed through a single sparse product.
+    summed = _run_plan(kpi_plans['summed_plan'], dict(inputs, **(parameters or {})), kpi_plans['summed_dropped'])
+    n_rows = max((len(x) for x in inputs.values() if np.ndim(x)), default=0)
+    stacked = np.empty((len(kpi_plans['summed_steps']), n_rows))
+    for i, step in enumerate(kpi_plans['summed_steps']):
+        stacked[i] = summed[step]
+    del summed
+
+    if groups is None:
+        return np.nansum(stacked, axis=1)
+    n_groups = n_groups if n_groups is not None else int(groups.max()) + 1
+    indicator = sparse.csr_matrix((np.ones(n_rows), (groups, np.arange(n_rows))), shape=(n_groups, n_rows))
+    return (indicator @ np.nan_to_num(stacked, nan=0.0, posinf=np.inf, neginf=-np.inf).T).T
+
+
+def combine_kpi_sums(
+        kpi_plans: dict,
+        sums: np.ndarray,
+        parameters: dict = None
+) -> dict:
+    # the portfolio level KPIs from the totals of reduce_kpi_sums, which can also be kept up to date by adding the
+    # totals of the rows that changed minus their previous ones
+    inputs = dict(parameters or {})
+    inputs.update({('sum', i): x for i, x in enumerate(sums)})
+    values = _run_plan(kpi_plans['totals_plan'], inputs)
+    return {name: values[step] for name, step in kpi_plans['totals_outputs'].items()}
+
+
+def evaluate_portfolio_kpis(
+        kpi_plans: dict,
+        inputs: dict,
+        parameters: dict = None,
+        groups: np.ndarray = None,
+        n_groups: int = None
+) -> dict:
+    return combine_kpi_sums(kpi_plans, reduce_kpi_sums(kpi_plans, inputs, parameters, groups, n_groups), parameters)
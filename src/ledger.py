@@ -0,0 +1,166 @@
+import numpy as np
+import pandas as pd
+from dashboard import compile_schema
+
+LEDGER_EVENT_TYPES = ['buy', 'sell', 'dividend', 'fee']
+COST_BASIS_METHODS = ['fifo', 'average']
+# order of the events of a position within a day: buys first, then dividends and fees, then sells
+_EVENT_RANKS = {'buy': 0, 'dividend': 1, 'fee': 1, 'sell': 2}
+# quantities left below this share of what was bought are rounding leftovers, not open units
+_QUANTITY_TOLERANCE = 1e-9
+
+
+def _cumsum_by_group(
+        values: np.ndarray,
+        groups: np.ndarray,
+        reverse: bool = False
+) -> np.ndarray:
+    # running sum restarting at every group of the sorted rows, from the last row backwards when reverse
+    if reverse:
+        return _cumsum_by_group(values[::-1], groups[::-1])[::-1]
+    return pd.Series(values).groupby(groups, sort=False).cumsum().to_numpy()
+
+
+def _sort_transactions(
+        transactions: pd.DataFrame
+) -> tuple:
+    # transactions sorted by position (broker and ticker), date and event rank, with the position of every row
+    keys = [x for x in ['broker', 'ticker'] if x in transactions.columns]
+    positions = transactions.groupby(keys, sort=False, observed=True, dropna=False).ngroup().to_numpy()
+    ranks = transactions['type'].astype(object).map(_EVENT_RANKS).fillna(1).to_numpy()
+    order = np.lexsort((ranks, transactions['date'].to_numpy(), positions))
+    return transactions.iloc[order].reset_index(drop=True), pd.factorize(positions[order])[0], order
+
+
+def _validate_transactions(
+        transactions: pd.DataFrame,
+        row_numbers: np.ndarray,
+        units: np.ndarray,
+        bought: np.ndarray
+):
+    # every problem of the ledger is reported together, rows as in the file (the header is row 1)
+    event_type = transactions['type'].astype(object).to_numpy()
+    quantity = transactions['quantity'].to_numpy(dtype='float64')
+    price = transactions['price'].to_numpy(dtype='float64')
+    amount = transactions['amount'].to_numpy(dtype='float64')
+    trades = np.isin(event_type, ['buy', 'sell'])
+
+    errors = []
+    checks = [
+        (~np.isin(event_type, LEDGER_EVENT_TYPES), f"type is not one of {LEDGER_EVENT_TYPES} in rows"),
+        (trades & ~(quantity > 0), "quantity of a buy or sell is not a positive number in rows"),
+        (trades & ~(price >= 0), "price of a buy or sell is not a number in rows"),
+        (np.isin(event_type, ['dividend', 'fee']) & np.isnan(amount), "amount of a dividend or fee is missing in rows"),
+        ((event_type == 'sell') & (units < -_QUANTITY_TOLERANCE * bought),
+         "sells more units than were held at the time in rows"),
+    ]
+    for invalid, message in checks:
+        if invalid.any():
+            errors.append(f"{message} {np.sort(row_numbers[invalid]).tolist()}")
+    if errors:
+        raise ValueError('The ledger is not consistent:\n - ' + '\n - '.join(errors))
+
+
+def get_open_lots(
+        transactions: pd.DataFrame,
+        csv_schema: dict,
+        method: str = 'fifo'
+) -> pd.DataFrame:
+    # reduces a typed ledger of buys, sells, dividends and fees to the open lots of the portfolio schema. With fifo
+    # the sells consume the oldest units first, so an open lot is whatever of a buy is beyond the units sold in total;
+    # with average cost every sell takes the same share of each buy, and a position is a single lot at the average
+    # price and the average entry date of its units. Dividends and fees go to the units still held that were held
+    # when they were paid, pro rata; those paid on units sold since are realised and left out.
+    if method not in COST_BASIS_METHODS:
+        raise ValueError(f'Unknown cost basis method {method}, use one of {COST_BASIS_METHODS}')
+    transactions, positions, order = _sort_transactions(transactions)
+    n_positions = positions.max() + 1 if len(positions) else 0
+    event_type = transactions['type'].astype(object).to_numpy()
+    is_buy = event_type == 'buy'
+    is_sell = event_type == 'sell'
+    quantity = np.nan_to_num(transactions['quantity'].to_numpy(dtype='float64'))
+    price = np.nan_to_num(transactions['price'].to_numpy(dtype='float64'))
+    fee = np.nan_to_num(transactions['fee'].to_numpy(dtype='float64'))
+    amount = np.nan_to_num(transactions['amount'].to_numpy(dtype='float64'))
+
+    bought = np.where(is_buy, quantity, 0.0)
+    sold = np.where(is_sell, quantity, 0.0)
+    units = _cumsum_by_group(bought - sold, positions)
+    cumulative_bought = _cumsum_by_group(bought, positions)
+    _validate_transactions(transactions, order + 2, units, cumulative_bought)
+
+    # dividends and fees per unit held when they were paid; none can be attributed when nothing was held
+    held = units > _QUANTITY_TOLERANCE * cumulative_bought
+    is_dividend = (event_type == 'dividend') & held
+    is_fee = (event_type == 'fee') & held
+    safe_units = np.where(held, units, 1.0)
+    per_unit = {
+        'dividends_received': np.where(is_dividend, amount, 0.0) / safe_units,
+        'dividends_costs': np.where(is_dividend, fee, 0.0) / safe_units,
+        'fee_costs': np.where(is_fee, amount + fee, 0.0) / safe_units,
+    }
+
+    if method == 'fifo':
+        # a lot keeps the units bought beyond the total sold of its position, and gets what was paid on them after
+        # its buy
+        total_sold = np.bincount(positions, weights=sold, minlength=n_positions)[positions]
+        remaining = np.clip(cumulative_bought - total_sold, 0.0, bought)
+        lots = np.flatnonzero(is_buy & (remaining > _QUANTITY_TOLERANCE * bought))
+        holdings = remaining[lots]
+        paid_after = {x: _cumsum_by_group(y, positions, reverse=True)[lots] for x, y in per_unit.items()}
+        lot_values = {
+            'entry_date': transactions['date'].to_numpy()[lots],
+            'entry_price': price[lots],
+            'holdings': holdings,
+            'entry_cost': fee[lots] * holdings / bought[lots] + paid_after['fee_costs'] * holdings,
+            'dividends_received': paid_after['dividends_received'] * holdings,
+            'dividends_costs': paid_after['dividends_costs'] * holdings,
+        }
+    else:
+        # a position restarts after every sell that closes it. Within a stretch, the share of a buy surviving to its
+        # end is the product of the shares kept by the later sells, summed as logs.
+        closes = is_sell & ~held
+        starts = np.r_[True, (positions[1:] != positions[:-1]) | closes[:-1]]
+        stretches = np.cumsum(starts) - 1
+        kept_share = np.where(is_sell & held, units / np.where(held, units + sold, 1.0), 1.0)
+        log_kept = _cumsum_by_group(np.log(kept_share), stretches)
+        last_rows = np.r_[np.flatnonzero(starts[1:]), len(stretches) - 1] if len(stretches) else np.array([], int)
+        surviving = np.where(is_buy, bought * np.exp(log_kept[last_rows][stretches] - log_kept), 0.0)
+        # the last stretch of each position is the open one, if anything is still held at its end
+        last_stretch_rows = last_rows[np.r_[positions[last_rows][1:] != positions[last_rows][:-1], True]]
+        lots = last_stretch_rows[held[last_stretch_rows]]
+        lot_stretches = stretches[lots]
+
+        def sum_by_lot(values):
+            return np.bincount(stretches, weights=values, minlength=len(last_rows))[lot_stretches]
+
+        holdings = sum_by_lot(surviving)
+        # the units still held that had been bought when something was paid
+        surviving_before = _cumsum_by_group(surviving, stretches)
+        paid = {x: sum_by_lot(y * surviving_before) for x, y in per_unit.items()}
+        dates = transactions['date'].to_numpy().astype('datetime64[ns]').astype('int64').astype('float64')
+        entry_ns = sum_by_lot(np.where(is_buy, dates, 0.0) * surviving) / holdings
+        lot_values = {
+            'entry_date': np.round(entry_ns / 864e11).astype('int64').astype('datetime64[D]').astype('datetime64[ns]'),
+            'entry_price': sum_by_lot(price * surviving) / holdings,
+            'holdings': holdings,
+            'entry_cost': sum_by_lot(fee * surviving / np.where(is_buy, bought, 1.0)) + paid['fee_costs'],
+            'dividends_received': paid['dividends_received'],
+            'dividends_costs': paid['dividends_costs'],
+        }
+        # the other fields come from the last buy of the position
+        last_buys = pd.Series(np.where(is_buy, np.arange(len(stretches)), -1)).groupby(stretches).max().to_numpy()
+        lots = last_buys[lot_stretches]
+
+    # the fields that are not worked out from the ledger are carried from the buys, or take their defaults
+    schema = compile_schema(csv_schema)
+    open_lots = {}
+    for field in csv_schema:
+        if field in lot_values:
+            open_lots[field] = lot_values[field]
+        elif field in transactions.columns:
+            open_lots[field] = transactions[field].iloc[lots].reset_index(drop=True)
+        else:
+            open_lots[field] = schema['defaults'][field]
+    print(f' - {len(transactions)} transactions reduced to {len(lots)} open lots ({method})')
+    return pd.DataFrame(open_lots, index=pd.RangeIndex(len(lots)))
@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+def build_weight_matrix(
+        fund_holdings: pd.DataFrame,
+        tickers: list = []
+) -> tuple:
+    # fund_holdings has one row per (fund, ticker, weight); returns the node tickers and the sparse matrix holding
+    # the weight of each node (column) inside each fund (row)
+    codes, nodes = pd.factorize(pd.concat([fund_holdings['fund'], fund_holdings['ticker'],
+                                           pd.Series(tickers, dtype=object)], ignore_index=True).astype(str))
+    n_holdings = len(fund_holdings)
+    weights = sparse.csr_matrix(
+        (fund_holdings['weight'].to_numpy(dtype=float), (codes[:n_holdings], codes[n_holdings:2 * n_holdings])),
+        shape=(len(nodes), len(nodes))
+    )
+    weights.sum_duplicates()
+    weights.eliminate_zeros()
+
+    return pd.Index(nodes), weights
+
+
+def resolve_look_through(
+        nodes: pd.Index,
+        weights: sparse.csr_matrix
+) -> sparse.csr_matrix:
+    # closure[i, j] is the weight of leaf j reached from node i through any chain of funds. Leaves map to themselves,
+    # funds that only hold leaves keep their own weights, and funds of funds are expanded recursively with memoization.
+    # A fund met again while it is being expanded closes a cycle and is kept as a leaf at that point. Where the cycle
+    # is cut depends on the fund the expansion started from, so the funds that met one are not memoized.
+    n_nodes = len(nodes)
+    is_fund = np.diff(weights.indptr) > 0
+    holds_funds = np.diff((weights @ sparse.diags(is_fund.astype(float))).tocsr().indptr) > 0
+    holds_funds &= is_fund
+
+    closure = sparse.diags((~is_fund).astype(float), format='csr') \
+        + sparse.diags((is_fund & ~holds_funds).astype(float), format='csr') @ weights
+
+    resolved = {}
+    in_progress = set()
+    reported_cycles = set()
+
+    def resolve(node):
+        # the expanded row of the node, and whether a cycle was met while expanding it
+        if node in resolved:
+            return resolved[node], False
+        if not holds_funds[node]:
+            return closure[node], False
+
+        in_progress.add(node)
+        row = weights[node]
+        cycles = [child for child in row.indices if child in in_progress]
+        for child in cycles:
+            if (child, node) not in reported_cycles:
+                reported_cycles.add((child, node))
+                print(f' - Cycle in fund holdings: {nodes[child]} is held by {nodes[node]}, it is kept as a position')
+
+        # leaves and funds closing a cycle are taken as they are, the other funds are expanded
+        kept = ~is_fund[row.indices] | np.isin(row.indices, cycles)
+        expanded = sparse.csr_matrix((row.data[kept], row.indices[kept], [0, kept.sum()]), shape=(1, n_nodes))
+        met_cycle = len(cycles) > 0
+        for child, weight in zip(row.indices[~kept], row.data[~kept]):
+            child_row, child_met_cycle = resolve(child)
+            expanded = expanded + weight * child_row
+            met_cycle |= child_met_cycle
+        in_progress.discard(node)
+
+        if not met_cycle:
+            resolved[node] = expanded
+        return expanded, met_cycle
+
+    funds_of_funds = np.flatnonzero(holds_funds)
+    if len(funds_of_funds) == 0:
+        return closure
+
+    rows = sparse.vstack([resolve(node)[0] for node in funds_of_funds]).tocoo()
+    closure = closure + sparse.csr_matrix((rows.data, (funds_of_funds[rows.row], rows.col)), shape=closure.shape)
+
+    return closure.tocsr()
+
+
+def get_exposures(
+        position_values: pd.Series,
+        nodes: pd.Index,
+        closure: sparse.csr_matrix
+) -> pd.Series:
+    # value held in every leaf, from the value of each position (indexed by ticker), as a single sparse product
+    values = np.zeros(len(nodes))
+    values[nodes.get_indexer(position_values.index.astype(str))] = position_values.to_numpy(dtype=float)
+    exposures = closure.T @ values
+
+    held = np.flatnonzero(exposures)
+    return pd.Series(exposures[held], index=nodes[held])
@@ -0,0 +1,98 @@
+import numpy as np
+
+# the kpis the cash flows of a position are made of, the return is left out when the kpis config doesn't have them
+CASH_FLOW_COLUMNS = ['years_since_entry', 'entry_value', 'entry_cost', 'dividends_received', 'dividends_costs',
+                     'annual_costs_paid', 'current_value', 'exit_cost_total', 'tax_on_gain']
+# the roots are searched for in log(1 + r), for annual returns from -99.99% to +999900%
+LOG_RETURN_BRACKET = (np.log(1e-4), np.log(1e4))
+
+
+def get_cash_flows(
+        columns
+) -> tuple:
+    # three cash flows per row, timed in years before today: the entry with its costs, the dividends net of their
+    # costs and the annual costs, and the capital after liquidating post-tax today. The portfolio table only keeps the
+    # totals of dividends and annual costs, so they are taken as paid half way through the holding period.
+    flows = {x: np.asarray(columns[x], dtype='float64') for x in CASH_FLOW_COLUMNS}
+    years = flows['years_since_entry']
+    amounts = np.stack([
+        -(flows['entry_value'] + flows['entry_cost']),
+        flows['dividends_received'] - flows['dividends_costs'] - flows['annual_costs_paid'],
+        flows['current_value'] - flows['exit_cost_total'] - flows['tax_on_gain'],
+    ], axis=1)
+    times = np.stack([-years, -years / 2, np.zeros_like(years)], axis=1)
+    # rows missing any of them (a price, say) have no flows, so they don't count in the return of their group
+    valid = ~np.isnan(amounts).any(axis=1) & ~np.isnan(years)
+    return np.where(valid[:, None], amounts, 0.0), np.where(valid[:, None], times, 0.0)
+
+
+def solve_money_weighted_returns(
+        amounts: np.ndarray,
+        times: np.ndarray,
+        groups: np.ndarray,
+        n_groups: int,
+        tolerance: float = 1e-12,
+        max_iterations: int = 100
+) -> np.ndarray:
+    # annual rate r of every group of cash flows, the root of sum(amount * (1 + r) ** -time) = 0. All the groups are
+    # solved together in x = log(1 + r), where the present values and their derivatives are weighted bincounts. Each
+    # step is a newton step, or a bisection when it would leave the bracket still known to hold the root, so every
+    # group converges. Groups whose present value doesn't change sign across the bracket get nan.
+    amounts, times, groups = amounts.ravel(), times.ravel(), groups.ravel()
+    # discounted to the first flow of each group instead of today, the same roots are much better conditioned
+    first_times = np.full(n_groups, np.inf)
+    np.minimum.at(first_times, groups, times)
+    times = times - first_times[groups]
+
+    def present_values(x, flows):
+        flow_groups = groups[flows]
+        with np.errstate(over='ignore', invalid='ignore'):
+            discounted = amounts[flows] * np.exp(-x[flow_groups] * times[flows])
+        return (np.bincount(flow_groups, weights=discounted, minlength=n_groups),
+                np.bincount(flow_groups, weights=-times[flows] * discounted, minlength=n_groups))
+
+    all_flows = np.arange(len(amounts))
+    low = np.full(n_groups, LOG_RETURN_BRACKET[0])
+    high = np.full(n_groups, LOG_RETURN_BRACKET[1])
+    low_sign = np.sign(present_values(low, all_flows)[0])
+    bracketed = low_sign * np.sign(present_values(high, all_flows)[0]) < 0
+    x = (low + high) / 2
+
+    # only the groups still converging, and their flows, take part in each step
+    active = np.flatnonzero(bracketed)
+    flows = all_flows[bracketed[groups]]
+    for _ in range(max_iterations):
+        if not len(active):
+            break
+        value, derivative = (y[active] for y in present_values(x, flows))
+        same_sign = np.sign(value) == low_sign[active]
+        low[active] = np.where(same_sign, x[active], low[active])
+        high[active] = np.where(same_sign, high[active], x[active])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            newton = x[active] - value / derivative
+        next_x = np.where((newton >= low[active]) & (newton <= high[active]), newton, (low[active] + high[active]) / 2)
+        # a converged group keeps its root, a bisection of its one sided bracket would throw it away
+        converged = (np.abs(next_x - x[active]) < tolerance) | (high[active] - low[active] < tolerance) | (value == 0)
+        x[active[~converged]] = next_x[~converged]
+        if converged.any():
+            active = active[~converged]
+            still_active = np.zeros(n_groups, dtype=bool)
+            still_active[active] = True
+            flows = flows[still_active[groups[flows]]]
+
+    return np.where(bracketed, np.expm1(x), np.nan)
+
+
+def calculate_money_weighted_returns(
+        columns,
+        groups: np.ndarray = None,
+        n_groups: int = None
+) -> np.ndarray:
+    # money-weighted annual return (xirr) post-tax of every row of the kpis, or of every group of rows when groups
+    # (a group number per row) are given. None when the kpis don't have the columns of the cash flows.
+    if any(x not in columns for x in CASH_FLOW_COLUMNS):
+        return None
+    amounts, times = get_cash_flows(columns)
+    if groups is None:
+        groups, n_groups = np.arange(len(amounts)), len(amounts)
+    return solve_money_weighted_returns(amounts, times, np.repeat(np.asarray(groups), amounts.shape[1]), n_groups)
@@ -1,12 +1,16 @@
 # Adapted from https://blog.macuyiko.com/post/2016/how-to-send-html-mails-with-oauth2-and-gmail-in-python.html
 
 import base64
+import hashlib
 import json
+import os
 import smtplib
+import time
 import urllib.parse
 import urllib.request
 
 GOOGLE_ACCOUNTS_BASE_URL = 'https://accounts.google.com'
+TOKEN_CACHE_FILE = 'access_token.json'
 REDIRECT_URI = 'urn:ietf:wg:oauth:2.0:oob'
 SCOPES = [
     'https://mail.google.com/',
@@ -96,18 +100,61 @@ def refresh_authorization(google_client_id, google_client_secret, refresh_token)
     return response['access_token'], response['expires_in']
 
 
+def get_token_cache_key(client_id, refresh_token):
+    # a cached access token is only valid for the client and refresh token it was issued from
+    return hashlib.sha256(f'{client_id}:{refresh_token}'.encode()).hexdigest()
+
+
+def read_cached_access_token(cache_dir, cache_key, expiry_margin_seconds=300):
+    # the cached access token, or None if there is none for this key or it expires within the margin
+    try:
+        with open(os.path.join(cache_dir, TOKEN_CACHE_FILE)) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get('key') != cache_key or cached.get('expires_at', 0) - expiry_margin_seconds <= time.time():
+        return None
+    return cached['access_token']
+
+
+def store_access_token(cache_dir, cache_key, access_token, expires_in):
+    # the file is only readable by its owner and replaced atomically, so a concurrent run never reads half of it
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = os.path.join(cache_dir, TOKEN_CACHE_FILE)
+    fd = os.open(cache_path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'key': cache_key, 'access_token': access_token, 'expires_at': time.time() + int(expires_in)}, f)
+    os.replace(cache_path + '.tmp', cache_path)
+
+
 def get_oauth_token_and_update_config(
         sender_email: str,
         GOOGLE_CLIENT_ID: str,
         GOOGLE_CLIENT_SECRET: str,
-        GOOGLE_REFRESH_TOKEN: str = None
+        GOOGLE_REFRESH_TOKEN: str = None,
+        token_cache_config: dict = None
 ) -> tuple:
+    token_cache_config = token_cache_config or {}
+    cache_enabled = token_cache_config.get('enabled', False)
+    cache_dir = token_cache_config.get('cache_dir', '.cache')
+
     if GOOGLE_REFRESH_TOKEN is None:
         print('No refresh token found, obtaining one')
         refresh_token, access_token, expires_in = get_authorization(GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET)
     else:
         refresh_token = GOOGLE_REFRESH_TOKEN
-        access_token, expires_in = refresh_authorization(GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET, GOOGLE_REFRESH_TOKEN)
+        cache_key = get_token_cache_key(GOOGLE_CLIENT_ID, refresh_token)
+        access_token = read_cached_access_token(cache_dir, cache_key,
+                                                token_cache_config.get('expiry_margin_seconds', 300)) \
+            if cache_enabled else None
+        if access_token is not None:
+            print(' - Using the cached access token')
+            expires_in = None
+        else:
+            access_token, expires_in = refresh_authorization(GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET, refresh_token)
+
+    if cache_enabled and expires_in is not None:
+        store_access_token(cache_dir, get_token_cache_key(GOOGLE_CLIENT_ID, refresh_token), access_token, expires_in)
 
     auth_string = generate_oauth2_string(sender_email, access_token, as_base64=True)
     return refresh_token, access_token, auth_string
@@ -0,0 +1,575 @@
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import pandas as pd
+import yfinance as yf
+
+PRICE_CACHE_FILE = 'prices.sqlite'
+# the adjusted closes of a ticker are cached on the basis of its dividends and splits when they were fetched, and
+# Yahoo rewrites the whole adjusted history after every new one. Each range fetched is widened by this many days into
+# the cached ones around it, and a ticker whose closes there moved by more than the tolerance has its cache dropped.
+ADJUSTMENT_CHECK_DAYS = 7
+ADJUSTMENT_TOLERANCE = 1e-6
+# one bucket per (rate, burst) for the whole process, so the limit holds across calls and across the runs of serve
+_token_buckets = {}
+_token_buckets_lock = threading.Lock()
+_download_pool = {'executor': None, 'max_workers': None}
+_download_pool_lock = threading.Lock()
+# the closes a resident process keeps in memory, one store per cache dir
+_resident_prices = {}
+_resident_prices_lock = threading.Lock()
+
+
+def download_adj_close(
+        tickers: list,
+        start: str,
+        end: str
+) -> pd.DataFrame:
+    # returns a date x ticker frame of adjusted closes, end date excluded
+    prices = yf.download(tickers, start=start, end=end, progress=False)
+    if prices.empty:
+        return pd.DataFrame(index=pd.DatetimeIndex([], name='Date'), columns=tickers, dtype=float)
+
+    adj_close = prices['Adj Close']
+    if isinstance(adj_close, pd.Series):
+        adj_close = adj_close.to_frame(name=tickers[0])
+
+    index = pd.DatetimeIndex(adj_close.index)
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    adj_close.index = index.normalize().rename('Date')
+    adj_close.columns = [str(x) for x in adj_close.columns]
+
+    return adj_close
+
+
+class TokenBucket:
+    # lets rate_per_second acquisitions through on average and up to burst of them at once, acquire waits for a token
+
+    def __init__(
+            self,
+            rate_per_second: float,
+            burst: int = 1
+    ):
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # the token is taken at once, possibly leaving the bucket in debt that the next acquisitions wait off
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate_per_second)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate_per_second if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+def get_token_bucket(
+        rate_per_second: float,
+        burst: int = 1
+) -> TokenBucket:
+    with _token_buckets_lock:
+        if (rate_per_second, burst) not in _token_buckets:
+            _token_buckets[(rate_per_second, burst)] = TokenBucket(rate_per_second, burst)
+        return _token_buckets[(rate_per_second, burst)]
+
+
+def _download_chunk(
+        download,
+        tickers: list,
+        download_args: tuple
+) -> tuple:
+    # the closes of a chunk and the tickers of it yfinance reported an error for. A ticker without any close in the
+    # range is data, a market closed those days or not closed yet today, only the errors are failures.
+    errors = getattr(yf.shared, '_ERRORS', None)
+    if errors is not None:
+        errors.clear()
+    adj_close = download(tickers, *download_args)
+    errors = {str(x).upper() for x in getattr(yf.shared, '_ERRORS', None) or {}}
+    return adj_close, [x for x in tickers if x.upper() in errors]
+
+
+def get_download_pool(
+        max_workers: int
+) -> ProcessPoolExecutor:
+    # one pool of processes for the whole process, started on the first chunked download and reused by the next ones.
+    # Its processes are spawned rather than forked, as serve and intraday have other threads running (the trigger
+    # server, the holdings refresh) whose locks a fork would copy in whatever state they are.
+    with _download_pool_lock:
+        if _download_pool['executor'] is None or _download_pool['max_workers'] != max_workers:
+            if _download_pool['executor'] is not None:
+                _download_pool['executor'].shutdown(wait=False)
+            _download_pool['executor'] = ProcessPoolExecutor(max_workers=max_workers,
+                                                             mp_context=multiprocessing.get_context('spawn'))
+            _download_pool['max_workers'] = max_workers
+        return _download_pool['executor']
+
+
+def download_chunks(
+        download,
+        chunks: list,
+        download_args: tuple,
+        token_bucket: TokenBucket,
+        max_workers: int = 4
+) -> list:
+    # (closes, tickers with errors) of download(chunk, *download_args) for every chunk of tickers, None for the chunks
+    # whose download raised. yf.download keeps its results in module globals, so concurrent downloads run in processes
+    # rather than threads; every one of them waits for a token before it is started. The download function goes to
+    # the processes by name, so it has to be a module level one.
+    if len(chunks) == 1 or max_workers <= 1:
+        downloads = []
+        for chunk in chunks:
+            token_bucket.acquire()
+            try:
+                downloads.append(_download_chunk(download, chunk, download_args))
+            except Exception as err:
+                print(f' - Downloading {len(chunk)} tickers failed: {err}')
+                downloads.append(None)
+        return downloads
+
+    executor = get_download_pool(max_workers)
+    futures = []
+    for chunk in chunks:
+        token_bucket.acquire()
+        futures.append(executor.submit(_download_chunk, download, chunk, download_args))
+    downloads = []
+    for chunk, future in zip(chunks, futures):
+        try:
+            downloads.append(future.result())
+        except Exception as err:
+            print(f' - Downloading {len(chunk)} tickers failed: {err}')
+            downloads.append(None)
+    return downloads
+
+
+def download_in_chunks(
+        download,
+        tickers: list,
+        download_args: tuple = (),
+        download_config: dict = None,
+        retry_errors: bool = True
+) -> pd.DataFrame:
+    # download(chunk, *download_args), a date x ticker frame, in chunks of tickers run in parallel under a token
+    # bucket rate limit, merged back into one frame. The chunks that raised and, with retry_errors, the tickers
+    # yfinance reported errors for are retried on their own with an exponential backoff, and those still failing at
+    # the end are reported as missing. Tickers without a close in the range are not retried, they are returned as
+    # they came.
+    download_config = download_config or {}
+    chunk_size = download_config.get('chunk_size', 100)
+    retries = download_config.get('retries', 2)
+    backoff = download_config.get('backoff_seconds', 1.0)
+    token_bucket = get_token_bucket(download_config.get('requests_per_second', 2.0), download_config.get('burst', 4))
+
+    closes = {}
+    to_download = list(dict.fromkeys(tickers))
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+            print(f' - Retrying {len(to_download)} tickers')
+        chunks = [to_download[i:i + chunk_size] for i in range(0, len(to_download), chunk_size)]
+        failed = []
+        for chunk, downloaded in zip(chunks, download_chunks(download, chunks, download_args, token_bucket,
+                                                             download_config.get('max_workers', 4))):
+            if downloaded is None:
+                failed.extend(chunk)
+                continue
+            adj_close, errors = downloaded
+            if retry_errors:
+                failed.extend(errors)
+            closes.update({x: adj_close[x] for x in adj_close.columns if x not in errors})
+        to_download = failed
+        if not to_download:
+            break
+
+    if to_download:
+        print(f' - No prices for {len(to_download)} of {len(tickers)} tickers: {to_download[:10]}'
+              + (' ...' if len(to_download) > 10 else ''))
+    adj_close = pd.DataFrame(closes)
+    if adj_close.empty:
+        return pd.DataFrame(index=pd.DatetimeIndex([], name='Date'), columns=tickers, dtype=float)
+    return adj_close.sort_index().reindex(columns=tickers)
+
+
+def download_adj_close_chunked(
+        tickers: list,
+        start: str,
+        end: str,
+        download_config: dict = None,
+        retry_errors: bool = True
+) -> pd.DataFrame:
+    # download_adj_close through download_in_chunks
+    adj_close = download_in_chunks(download_adj_close, tickers, (start, end), download_config, retry_errors)
+    adj_close.index = pd.DatetimeIndex(adj_close.index).rename('Date')
+    return adj_close
+
+
+def get_quoted_tickers(
+        tickers: list,
+        probe_days: int = 10,
+        download_config: dict = None
+) -> set:
+    # the tickers with at least one close in the last probe_days. Most tickers probed are expected not to exist, so
+    # their errors are not retried, only the chunks that failed outright.
+    if not tickers:
+        return set()
+    end = (datetime.today() + timedelta(1)).strftime('%Y-%m-%d')
+    start = (datetime.today() - timedelta(probe_days)).strftime('%Y-%m-%d')
+    adj_close = download_adj_close_chunked(tickers, start, end, download_config, retry_errors=False)
+    return set(adj_close.columns[adj_close.notna().any()])
+
+
+class ResidentPrices:
+    # the closes of the cache file that a resident process holds in memory: for each ticker, every close the file has
+    # in the [start, end) range held. They follow the writes the process makes to the file, and are all forgotten when
+    # the file was changed otherwise, by another process or by deleting it.
+
+    def __init__(self):
+        self.closes = {}
+        self.ranges = {}
+        self.file_state = None
+        self.lock = threading.Lock()
+
+    def check_file_state(
+            self,
+            file_state: tuple
+    ):
+        if file_state != self.file_state:
+            self.closes.clear()
+            self.ranges.clear()
+
+    def get_not_held(
+            self,
+            tickers: list,
+            start: str,
+            end: str
+    ) -> list:
+        return [x for x in tickers if x not in self.ranges or start < self.ranges[x][0] or end > self.ranges[x][1]]
+
+    def read(
+            self,
+            tickers: list,
+            start: str,
+            end: str
+    ) -> pd.DataFrame:
+        adj_close = pd.DataFrame({x: self.closes[x][(self.closes[x].index >= start) & (self.closes[x].index < end)]
+                                  for x in tickers})
+        adj_close.index = pd.DatetimeIndex(adj_close.index).rename('Date')
+        return adj_close.reindex(columns=tickers).sort_index()
+
+    def hold(
+            self,
+            adj_close: pd.DataFrame,
+            start: str,
+            end: str
+    ):
+        # the closes just read from the file over [start, end), which replace what was held of their tickers
+        for ticker in adj_close.columns:
+            self.closes[ticker] = adj_close[ticker].dropna()
+            self.ranges[ticker] = (start, end)
+
+    def store(
+            self,
+            adj_close: pd.DataFrame,
+            start: str,
+            end: str
+    ):
+        # the closes just written to the file over [start, end). A ticker held over a range that doesn't touch this
+        # one would have a gap, it is forgotten and read again from the file when needed.
+        for ticker in adj_close.columns:
+            if ticker not in self.ranges:
+                continue
+            held_start, held_end = self.ranges[ticker]
+            if start > held_end or end < held_start:
+                self.forget([ticker])
+                continue
+            stored = adj_close[ticker].dropna()
+            held = self.closes[ticker]
+            self.closes[ticker] = pd.concat([held[~held.index.isin(stored.index)], stored]).sort_index()
+            self.ranges[ticker] = (min(start, held_start), max(end, held_end))
+
+    def forget(
+            self,
+            tickers: list
+    ):
+        for ticker in tickers:
+            self.closes.pop(ticker, None)
+            self.ranges.pop(ticker, None)
+
+    def drop_before(
+            self,
+            cutoff: str
+    ):
+        for ticker, (start, end) in list(self.ranges.items()):
+            if start < cutoff:
+                self.closes[ticker] = self.closes[ticker][self.closes[ticker].index >= cutoff]
+                self.ranges[ticker] = (cutoff, max(cutoff, end))
+
+
+def get_resident_prices(
+        cache_dir: str
+) -> ResidentPrices:
+    with _resident_prices_lock:
+        if cache_dir not in _resident_prices:
+            _resident_prices[cache_dir] = ResidentPrices()
+        return _resident_prices[cache_dir]
+
+
+def get_file_state(
+        cache_dir: str
+) -> tuple:
+    # what tells a change of the cache file from outside the process
+    try:
+        stat = os.stat(os.path.join(cache_dir, PRICE_CACHE_FILE))
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def open_price_cache(cache_dir: str) -> sqlite3.Connection:
+    os.makedirs(cache_dir, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(cache_dir, PRICE_CACHE_FILE))
+    conn.execute('CREATE TABLE IF NOT EXISTS prices '
+                 '(ticker TEXT NOT NULL, date TEXT NOT NULL, adj_close REAL NOT NULL, PRIMARY KEY (ticker, date))')
+    # coverage holds, per ticker, the half-open [start, end) date range already fetched and settled
+    conn.execute('CREATE TABLE IF NOT EXISTS coverage '
+                 '(ticker TEXT PRIMARY KEY, start TEXT NOT NULL, end TEXT NOT NULL, last_used REAL NOT NULL)')
+    return conn
+
+
+def get_missing_ranges(
+        conn: sqlite3.Connection,
+        tickers: list,
+        start: str,
+        end: str
+) -> dict:
+    # maps each (start, end) range that still has to be downloaded to the tickers missing it
+    coverage = dict(((t, (s, e)) for t, s, e in conn.execute(
+        f'SELECT ticker, start, end FROM coverage WHERE ticker IN ({",".join("?" * len(tickers))})', tickers)))
+
+    missing_ranges = {}
+    for ticker in tickers:
+        if ticker not in coverage:
+            missing_ranges.setdefault((start, end), []).append(ticker)
+            continue
+        covered_start, covered_end = coverage[ticker]
+        if start < covered_start:
+            missing_ranges.setdefault((start, covered_start), []).append(ticker)
+        if end > covered_end:
+            missing_ranges.setdefault((covered_end, end), []).append(ticker)
+
+    return missing_ranges
+
+
+def shift_date(
+        date: str,
+        days: int
+) -> str:
+    return (datetime.strptime(date, '%Y-%m-%d') + timedelta(days)).strftime('%Y-%m-%d')
+
+
+def get_readjusted_tickers(
+        conn: sqlite3.Connection,
+        adj_close: pd.DataFrame,
+        start: str,
+        end: str
+) -> list:
+    # the tickers whose closes downloaded outside of [start, end), where they were already cached, differ from the
+    # cached ones: their history was adjusted again since it was cached
+    outside = adj_close[(adj_close.index < start) | (adj_close.index >= end)]
+    long_prices = outside.rename_axis(index='date', columns='ticker').stack().dropna().rename('downloaded') \
+        .reset_index()
+    if long_prices.empty:
+        return []
+    long_prices['date'] = long_prices['date'].dt.strftime('%Y-%m-%d')
+    tickers = long_prices['ticker'].unique().tolist()
+    cached = pd.read_sql_query(
+        f'SELECT ticker, date, adj_close FROM prices WHERE ticker IN ({",".join("?" * len(tickers))}) '
+        f'AND date >= ? AND date <= ?', conn, params=tickers + [long_prices['date'].min(), long_prices['date'].max()])
+    compared = long_prices.merge(cached, on=['ticker', 'date'])
+    difference = (compared['downloaded'] - compared['adj_close']).abs()
+    changed = difference > ADJUSTMENT_TOLERANCE * compared['adj_close'].abs()
+    return compared.loc[changed, 'ticker'].unique().tolist()
+
+
+def drop_cached_tickers(
+        conn: sqlite3.Connection,
+        tickers: list,
+        resident: ResidentPrices = None
+):
+    conn.executemany('DELETE FROM prices WHERE ticker = ?', [(t,) for t in tickers])
+    conn.executemany('DELETE FROM coverage WHERE ticker = ?', [(t,) for t in tickers])
+    conn.commit()
+    if resident is not None:
+        resident.forget(tickers)
+
+
+def store_prices(
+        conn: sqlite3.Connection,
+        adj_close: pd.DataFrame,
+        start: str,
+        end: str,
+        settled_before: str
+):
+    long_prices = adj_close.rename_axis(index='date', columns='ticker').stack().dropna().rename('adj_close') \
+        .reset_index()
+    if long_prices.empty:
+        return
+    long_prices['date'] = long_prices['date'].dt.strftime('%Y-%m-%d')
+    conn.executemany('INSERT OR REPLACE INTO prices (ticker, date, adj_close) VALUES (?, ?, ?)',
+                     long_prices[['ticker', 'date', 'adj_close']].itertuples(index=False, name=None))
+
+    # closes from settled_before onwards may still move, so coverage never extends past it and those dates are
+    # fetched again on the next run. Tickers without any close in the range are not marked as covered, so a
+    # failed download is retried instead of being cached as empty.
+    covered_end = min(end, settled_before)
+    now = time.time()
+    for ticker in long_prices['ticker'].unique():
+        row = conn.execute('SELECT start, end FROM coverage WHERE ticker = ?', (ticker,)).fetchone()
+        if row is None:
+            if start < covered_end:
+                conn.execute('INSERT INTO coverage (ticker, start, end, last_used) VALUES (?, ?, ?, ?)',
+                             (ticker, start, covered_end, now))
+        else:
+            conn.execute('UPDATE coverage SET start = ?, end = ?, last_used = ? WHERE ticker = ?',
+                         (min(start, row[0]), max(covered_end, row[1]), now, ticker))
+    conn.commit()
+
+
+def read_cached_prices(
+        conn: sqlite3.Connection,
+        tickers: list,
+        start: str,
+        end: str,
+        resident: ResidentPrices = None
+) -> pd.DataFrame:
+    # the closes held by the resident store are taken from it, the others are read from the file and held from then on
+    placeholders = ",".join("?" * len(tickers))
+    conn.execute(f'UPDATE coverage SET last_used = ? WHERE ticker IN ({placeholders})', [time.time()] + tickers)
+    conn.commit()
+    if resident is not None:
+        not_held = resident.get_not_held(tickers, start, end)
+        if not_held:
+            resident.hold(read_cached_prices(conn, not_held, start, end), start, end)
+        return resident.read(tickers, start, end)
+
+    long_prices = pd.read_sql_query(
+        f'SELECT ticker, date, adj_close FROM prices WHERE ticker IN ({placeholders}) AND date >= ? AND date < ?',
+        conn, params=tickers + [start, end])
+
+    adj_close = long_prices.pivot(index='date', columns='ticker', values='adj_close')
+    adj_close.index = pd.to_datetime(adj_close.index).rename('Date')
+    adj_close.columns.name = None
+
+    return adj_close.reindex(columns=tickers).sort_index()
+
+
+def evict_price_cache(
+        conn: sqlite3.Connection,
+        cache_dir: str,
+        max_age_days: int = None,
+        max_size_mb: float = None,
+        resident: ResidentPrices = None
+):
+    # age based: drop closes older than max_age_days and shrink the coverage accordingly
+    if max_age_days is not None:
+        cutoff = (datetime.today() - timedelta(max_age_days)).strftime('%Y-%m-%d')
+        conn.execute('DELETE FROM prices WHERE date < ?', (cutoff,))
+        conn.execute('UPDATE coverage SET start = ? WHERE start < ?', (cutoff, cutoff))
+        conn.execute('DELETE FROM coverage WHERE start >= end')
+        conn.commit()
+        if resident is not None:
+            resident.drop_before(cutoff)
+
+    # size based: drop the least recently used tickers until the file fits in max_size_mb
+    if max_size_mb is not None:
+        file_size = os.path.getsize(os.path.join(cache_dir, PRICE_CACHE_FILE))
+        n_rows = conn.execute('SELECT COUNT(*) FROM prices').fetchone()[0]
+        if file_size > max_size_mb * 1e6 and n_rows > 0:
+            rows_to_drop = n_rows * (1 - max_size_mb * 1e6 / file_size)
+            tickers_by_last_use = conn.execute(
+                'SELECT c.ticker, COUNT(p.date) FROM coverage c LEFT JOIN prices p ON c.ticker = p.ticker '
+                'GROUP BY c.ticker ORDER BY c.last_used').fetchall()
+            tickers_to_drop = []
+            for ticker, ticker_rows in tickers_by_last_use:
+                if rows_to_drop <= 0:
+                    break
+                tickers_to_drop.append(ticker)
+                rows_to_drop -= ticker_rows
+            drop_cached_tickers(conn, tickers_to_drop, resident)
+            conn.execute('VACUUM')
+
+
+def get_adj_close_prices(
+        tickers: list,
+        start: str,
+        end: str,
+        price_cache_config: dict = None
+) -> pd.DataFrame:
+    if not tickers:
+        return pd.DataFrame(index=pd.DatetimeIndex([], name='Date'), dtype=float)
+    download_config = (price_cache_config or {}).get('download')
+    if not price_cache_config or not price_cache_config.get('enabled', False):
+        return download_adj_close_chunked(tickers, start, end, download_config)
+
+    cache_dir = price_cache_config.get('cache_dir', '.cache')
+    if price_cache_config.get('resident', False):
+        resident = get_resident_prices(cache_dir)
+        with resident.lock:
+            resident.check_file_state(get_file_state(cache_dir))
+            adj_close = get_cached_adj_close_prices(tickers, start, end, price_cache_config, resident)
+            resident.file_state = get_file_state(cache_dir)
+        return adj_close
+    return get_cached_adj_close_prices(tickers, start, end, price_cache_config)
+
+
+def get_cached_adj_close_prices(
+        tickers: list,
+        start: str,
+        end: str,
+        price_cache_config: dict,
+        resident: ResidentPrices = None
+) -> pd.DataFrame:
+    # the closes of the cache, downloading the ranges it misses first; with a resident store, the closes it holds are
+    # read from memory and kept in step with what is written to the file
+    cache_dir = price_cache_config.get('cache_dir', '.cache')
+    download_config = price_cache_config.get('download')
+    check_days = price_cache_config.get('adjustment_check_days', ADJUSTMENT_CHECK_DAYS)
+    settled_before = datetime.today().strftime('%Y-%m-%d')
+    conn = open_price_cache(cache_dir)
+    try:
+        # the tickers whose cache is dropped for being on an old adjustment basis are downloaded again whole, in a
+        # second pass
+        for _ in range(2):
+            missing_ranges = get_missing_ranges(conn, tickers, start, end)
+            if not missing_ranges:
+                break
+            for (missing_start, missing_end), missing_tickers in missing_ranges.items():
+                print(f' - Downloading {len(missing_tickers)} tickers from {missing_start} to {missing_end}')
+                adj_close = download_adj_close_chunked(missing_tickers, shift_date(missing_start, -check_days),
+                                                       shift_date(missing_end, check_days), download_config)
+                readjusted = get_readjusted_tickers(conn, adj_close, missing_start, missing_end)
+                if readjusted:
+                    print(f' - The adjusted closes of {len(readjusted)} tickers changed, their cache is dropped: '
+                          f'{readjusted[:10]}' + (' ...' if len(readjusted) > 10 else ''))
+                    drop_cached_tickers(conn, readjusted, resident)
+                in_range = (adj_close.index >= missing_start) & (adj_close.index < missing_end)
+                store_prices(conn, adj_close[in_range], missing_start, missing_end, settled_before)
+                if resident is not None:
+                    resident.store(adj_close[in_range], missing_start, missing_end)
+
+        adj_close = read_cached_prices(conn, tickers, start, end, resident)
+        evict_price_cache(conn, cache_dir, price_cache_config.get('max_age_days'),
+                          price_cache_config.get('max_size_mb'), resident)
+    finally:
+        conn.close()
+
+    return adj_close
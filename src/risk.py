@@ -0,0 +1,138 @@
+from statistics import NormalDist
+import numpy as np
+import pandas as pd
+
+TRADING_DAYS_PER_YEAR = 252
+# the risk kpis added to the global kpis, by how they are rendered
+RISK_PCT_KPIS = ['Volatility per annum', 'Max drawdown']
+RISK_AMOUNT_KPIS = ['VaR 1-day historical', 'VaR 1-day parametric']
+
+
+def get_daily_returns(
+        panel: pd.DataFrame
+) -> pd.DataFrame:
+    # close to close returns of every ticker of the price panel. Days a ticker has no close yet, or has none at all,
+    # are taken as days it didn't move.
+    closes = panel.sort_index().ffill()
+    return closes.pct_change().iloc[1:].fillna(0.0)
+
+
+def get_volatilities(
+        returns: pd.DataFrame
+) -> pd.Series:
+    # annualised volatility of every ticker
+    return returns.std() * np.sqrt(TRADING_DAYS_PER_YEAR)
+
+
+def get_covariance(
+        returns: np.ndarray
+) -> np.ndarray:
+    # sample covariance of the columns, days in rows
+    centered = returns - returns.mean(axis=0)
+    return centered.T @ centered / (len(returns) - 1)
+
+
+def get_portfolio_risk(
+        values: np.ndarray,
+        returns: np.ndarray,
+        covariance: np.ndarray = None,
+        confidence: float = 0.95
+) -> dict:
+    # risk of holding values (one per column of returns) through the days of returns: the annualised volatility, the
+    # 1-day value at risk at the confidence level from the daily profits and losses of the window (historical) and
+    # from the covariance assuming they are normal (parametric), and the largest fall from a peak in the window.
+    total = values.sum()
+    if len(returns) < 2 or not total > 0:
+        return {x: np.nan for x in RISK_PCT_KPIS + RISK_AMOUNT_KPIS}
+    if covariance is None:
+        covariance = get_covariance(returns)
+
+    profits = returns @ values
+    deviation = np.sqrt(max(values @ covariance @ values, 0.0))
+    path = np.cumprod(1 + profits / total)
+    peaks = np.maximum.accumulate(np.r_[1.0, path])[1:]
+
+    return {
+        'Volatility per annum': deviation / total * np.sqrt(TRADING_DAYS_PER_YEAR),
+        'Max drawdown': (1 - path / peaks).max(),
+        'VaR 1-day historical': -np.quantile(profits, 1 - confidence),
+        'VaR 1-day parametric': NormalDist().inv_cdf(confidence) * deviation - profits.mean(),
+    }
+
+
+class RollingCovariance:
+    # Covariance of the last `window` days of returns of n assets, moved on a day at a time. The window is kept with
+    # the sum of its rows and of their outer products, so adding a day and dropping the oldest one are rank one
+    # updates, O(n²), rather than O(window n²) for the covariance from scratch. The sums are recomputed from the
+    # rows every recompute_every days so the rounding of the updates can't build up.
+
+    def __init__(
+            self,
+            n_assets: int,
+            window: int = TRADING_DAYS_PER_YEAR,
+            recompute_every: int = None
+    ):
+        self.window = window
+        self.recompute_every = recompute_every or window
+        self.rows = np.zeros((window, n_assets))
+        self.n_rows = 0
+        self.next_row = 0
+        self.n_updates = 0
+        self.sum = np.zeros(n_assets)
+        self.products = np.zeros((n_assets, n_assets))
+
+    def update(
+            self,
+            returns: np.ndarray
+    ):
+        if self.n_rows == self.window:
+            dropped = self.rows[self.next_row]
+            self.sum -= dropped
+            self.products -= np.outer(dropped, dropped)
+        else:
+            self.n_rows += 1
+        self.rows[self.next_row] = returns
+        self.sum += returns
+        self.products += np.outer(returns, returns)
+        self.next_row = (self.next_row + 1) % self.window
+
+        self.n_updates += 1
+        if self.n_updates % self.recompute_every == 0:
+            rows = self.get_returns()
+            self.sum = rows.sum(axis=0)
+            self.products = rows.T @ rows
+
+    def get_returns(self) -> np.ndarray:
+        # the days of the window, oldest first
+        if self.n_rows < self.window:
+            return self.rows[:self.n_rows]
+        return np.concatenate([self.rows[self.next_row:], self.rows[:self.next_row]])
+
+    def get_covariance(self) -> np.ndarray:
+        if self.n_rows < 2:
+            return np.full(self.products.shape, np.nan)
+        mean = self.sum / self.n_rows
+        return (self.products - self.n_rows * np.outer(mean, mean)) / (self.n_rows - 1)
+
+
+def get_portfolio_risk_over_dates(
+        values: np.ndarray,
+        returns: pd.DataFrame,
+        dates: pd.DatetimeIndex,
+        window: int = TRADING_DAYS_PER_YEAR,
+        confidence: float = 0.95
+) -> pd.DataFrame:
+    # get_portfolio_risk at every date (sorted) of the values (one row per date, one column per column of returns),
+    # over the window of returns up to that date. The covariance is rolled forward through the days in between.
+    rolling = RollingCovariance(returns.shape[1], window)
+    rows = returns.to_numpy()
+    ends = returns.index.searchsorted(dates, side='right')
+    next_row = 0
+    risk = []
+    for date_values, end in zip(values, ends):
+        for row in rows[next_row:end]:
+            rolling.update(row)
+        next_row = max(next_row, end)
+        risk.append(get_portfolio_risk(date_values, rolling.get_returns(), rolling.get_covariance(), confidence))
+
+    return pd.DataFrame(risk, index=dates, columns=RISK_PCT_KPIS + RISK_AMOUNT_KPIS)
@@ -1,59 +1,127 @@
 import argparse
+import cProfile
+import multiprocessing
 import os
+import sys
 import yaml
 import pandas as pd
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 from dashboard import get_portfolio_prices, get_indirect_positions, calculate_kpis_portfolio_level, \
-    calculate_kpis_asset_level
-from styles import style_df, style_indirect_holdings_df
+    calculate_kpis_asset_level, calculate_kpis_over_dates, preprocess_portfolio_dataframe, get_fund_holdings, \
+    get_price_panel, get_priced_holdings, MONEY_WEIGHTED_RETURN_KPI
+from risk import get_daily_returns, get_volatilities, RISK_PCT_KPIS, RISK_AMOUNT_KPIS
+from styles import render_df, render_indirect_holdings_df
 from oauth2 import get_oauth_token_and_update_config
-from send_email import create_email_message, send_email_message_oauth
-from get_portfolio_df import get_google_sheet_df
-from utils import set_heroku_config_var
+from send_email import create_email_message, send_email_message_oauth, send_email_messages_oauth
+from get_portfolio_df import load_portfolio
+from utils import persist_refresh_token
+from snapshot_store import write_snapshots, write_snapshot
+from instrumentation import stage, start_run, write_metrics
+from scheduler import serve_jobs
+from intraday import create_intraday_portfolio, run_intraday
 
 
-def create_html_tables(
+def calculate_portfolio_tables(
         df: pd.DataFrame,
         csv_schema: dict,
         testing: bool,
         date_to_use: str,
         tax_rate: float,
-        tickers_to_replace: dict
-):
+        tickers_to_replace: dict,
+        price_cache_config: dict = None,
+        holdings_scraping_config: dict = None,
+        holdings_cache_config: dict = None,
+        look_through_config: dict = None,
+        snapshot_store_config: dict = None,
+        panel: pd.DataFrame = None,
+        fund_holdings: pd.DataFrame = None,
+        kpis_config: dict = None,
+        risk_config: dict = None,
+        symbol_index_config: dict = None
+) -> tuple:
+    # one panel of the portfolio's closes gives both the prices and the daily returns of the risk, unless a panel
+    # fetched beforehand for several portfolios is given
+    portfolio_panel = panel
+    if portfolio_panel is None:
+        with stage('price_panel'):
+            df = preprocess_portfolio_dataframe(df, csv_schema)
+            portfolio_panel = get_price_panel(list(df[df['asset_type'] != 'cash']['ticker'].unique()), testing,
+                                              date_to_use, price_cache_config)
+
     # get prices
-    portfolio_with_prices = get_portfolio_prices(df, csv_schema, testing=testing, testing_date=date_to_use)
+    with stage('portfolio_prices'):
+        portfolio_with_prices = get_portfolio_prices(df, csv_schema, testing=testing, testing_date=date_to_use,
+                                                     price_cache_config=price_cache_config, panel=portfolio_panel)
 
     # calculate kpis for the portfolio at asset level
-    portfolio_with_kpis = calculate_kpis_asset_level(portfolio_with_prices, tax_rate, testing=testing,
-                                                     testing_date=date_to_use)
+    with stage('kpis_asset_level'):
+        portfolio_with_kpis = calculate_kpis_asset_level(portfolio_with_prices, tax_rate, testing=testing,
+                                                         testing_date=date_to_use, kpis_config=kpis_config)
+
+    # daily returns of the tickers of the portfolio over the year of closes the prices are looked up in
+    with stage('risk'):
+        tickers = list(portfolio_with_kpis[portfolio_with_kpis['asset_type'] != 'cash']['ticker'].unique())
+        returns = get_daily_returns(portfolio_panel.reindex(columns=tickers))
+        portfolio_with_kpis['volatility_per_annum'] = portfolio_with_kpis['ticker'].map(
+            get_volatilities(returns)).where(portfolio_with_kpis['asset_type'] != 'cash', 0.0)
 
     # calculate kpis for the portfolio globally
-    portfolio_global_kpis = calculate_kpis_portfolio_level(portfolio_with_kpis)
+    with stage('kpis_portfolio_level'):
+        portfolio_global_kpis = calculate_kpis_portfolio_level(portfolio_with_kpis, kpis_config, returns, risk_config)
+
+    # calculate kpis for the indirect positions
+    with stage('indirect_positions'):
+        portfolio_indirect_positions = get_indirect_positions(portfolio_with_kpis,
+                                                              tickers_to_replace,
+                                                              testing=testing,
+                                                              testing_date=date_to_use,
+                                                              price_cache_config=price_cache_config,
+                                                              holdings_scraping_config=holdings_scraping_config,
+                                                              holdings_cache_config=holdings_cache_config,
+                                                              look_through_config=look_through_config,
+                                                              panel=panel,
+                                                              fund_holdings=fund_holdings,
+                                                              symbol_index_config=symbol_index_config)
+
+    # persist the results of the day before rendering them
+    if snapshot_store_config and snapshot_store_config.get('enabled', False):
+        print('Saving snapshots...')
+        with stage('snapshots'):
+            write_snapshots(snapshot_store_config, pd.Timestamp(date_to_use).strftime('%Y-%m-%d'),
+                            portfolio_with_kpis, pd.DataFrame([portfolio_global_kpis]), portfolio_indirect_positions)
+
+    return portfolio_with_kpis, portfolio_global_kpis, portfolio_indirect_positions
+
+
+def render_html_tables(
+        portfolio_with_kpis: pd.DataFrame,
+        portfolio_global_kpis: dict,
+        portfolio_indirect_positions: pd.DataFrame,
+        date_to_use: str,
+        output_dir: str = 'html_outputs'
+) -> dict:
+    # the reports are rendered in memory and returned by file name, they are also saved to output_dir unless it is None
+    reports = {}
     portfolio_global_kpis_df = pd.DataFrame.from_dict(portfolio_global_kpis, orient='index').rename(
         columns={0: date_to_use}
     )
 
-    # calculate kpis for the indirect positions
-    portfolio_indirect_positions = get_indirect_positions(portfolio_with_kpis,
-                                                          tickers_to_replace,
-                                                          testing=testing,
-                                                          testing_date=date_to_use)
-
-    # styling and saving as html
+    # styling as html
     amount_cols = [
         'Starting capital',
         'Costs paid so far',
         'Capital after liquidating pre-tax',
         'Capital after liquidating post-tax'
-    ]
+    ] + RISK_AMOUNT_KPIS
     pct_cols = [
-        'ROC per annum post-tax'
-    ]
-    portfolio_global_kpis_df_html = style_df(portfolio_global_kpis_df, amount_cols=amount_cols, pct_cols=pct_cols,
-                                             row_wise_style=True).render()
-    print('Saving global portfolio results...')
-    with open("html_outputs/portfolio_global_kpis.html", "w") as file:
-        file.write(portfolio_global_kpis_df_html)
+        'ROC per annum post-tax',
+        MONEY_WEIGHTED_RETURN_KPI
+    ] + RISK_PCT_KPIS
+    print('Rendering global portfolio results...')
+    with stage('render_global_kpis'):
+        reports['portfolio_global_kpis.html'] = render_df(portfolio_global_kpis_df, amount_cols=amount_cols,
+                                                          pct_cols=pct_cols, row_wise_style=True)
 
     amount_cols = [
         'entry_price',
@@ -78,7 +146,9 @@ def create_html_tables(
         'exit_cost_pct',
         '1_day_roa',
         'per_annum_roa_ex_dividends',
-        'per_annum_roa'
+        'per_annum_roa',
+        'per_annum_mwr',
+        'volatility_per_annum'
     ]
     date_cols = [
         'entry_date',
@@ -88,11 +158,11 @@ def create_html_tables(
         'holdings',
         'years_since_entry'
     ]
-    portfolio_with_kpis_html = style_df(portfolio_with_kpis.T, amount_cols=amount_cols, pct_cols=pct_cols,
-                                        date_cols=date_cols, float_cols=float_cols, row_wise_style=True).render()
-    print('Saving asset level results...')
-    with open("html_outputs/portfolio_with_kpis.html", "w") as file:
-        file.write(portfolio_with_kpis_html)
+    print('Rendering asset level results...')
+    with stage('render_with_kpis'):
+        reports['portfolio_with_kpis.html'] = render_df(portfolio_with_kpis.T, amount_cols=amount_cols,
+                                                        pct_cols=pct_cols, date_cols=date_cols,
+                                                        float_cols=float_cols, row_wise_style=True)
 
     amount_cols = [
         'Value'
@@ -111,35 +181,186 @@ def create_html_tables(
         'Ticker',
         'Name'
     ]
-    portfolio_indirect_positions_html = style_indirect_holdings_df(portfolio_indirect_positions,
-                                                                   amount_cols=amount_cols,
-                                                                   pct_cols=pct_cols,
-                                                                   bar_cols=bar_cols,
-                                                                   str_cols=str_cols
-                                                                   ).render()
-    print('Saving indirect positions results...')
-    with open("html_outputs/portfolio_indirect_positions.html", "w") as file:
-        file.write(portfolio_indirect_positions_html)
+    print('Rendering indirect positions results...')
+    with stage('render_indirect_positions'):
+        reports['portfolio_indirect_positions.html'] = render_indirect_holdings_df(portfolio_indirect_positions,
+                                                                                   amount_cols=amount_cols,
+                                                                                   pct_cols=pct_cols,
+                                                                                   bar_cols=bar_cols,
+                                                                                   str_cols=str_cols)
+
+    if output_dir is not None:
+        print(f'Saving the results to {output_dir}...')
+        with stage('save_reports'):
+            os.makedirs(output_dir, exist_ok=True)
+            for file_name, html in reports.items():
+                with open(os.path.join(output_dir, file_name), 'w') as file:
+                    file.write(html)
     print('Done.')
 
+    return reports
 
-def main():
-    parser = argparse.ArgumentParser(description="Produce simple portfolio KPIs for a given portfolio")
-    parser.add_argument("config", type=str, help="The path to a config yaml required to run the program")
-    parser.add_argument("--testdate", type=lambda s: datetime.strptime(s, '%Y-%m-%d'), help="Add a dummy date to test "
-                                                                                            "the program")
-    parser.add_argument("--local", action='store_true', help="Perform local test. You'll be prompted to input env vars.")
-    parser.add_argument("--dummy", action='store_true',
-                        help="Perform test on dummy portfolio file.")
-    args = parser.parse_args()
 
-    # Initial setup based on the configuration file
-    with open(args.config) as f:
-        config = yaml.load(f, Loader=yaml.FullLoader)
+def create_html_tables(
+        df: pd.DataFrame,
+        csv_schema: dict,
+        testing: bool,
+        date_to_use: str,
+        tax_rate: float,
+        tickers_to_replace: dict,
+        price_cache_config: dict = None,
+        holdings_scraping_config: dict = None,
+        holdings_cache_config: dict = None,
+        look_through_config: dict = None,
+        snapshot_store_config: dict = None,
+        kpis_config: dict = None,
+        output_dir: str = 'html_outputs',
+        risk_config: dict = None,
+        symbol_index_config: dict = None
+) -> dict:
+    with stage('calculate'):
+        portfolio_tables = calculate_portfolio_tables(df, csv_schema, testing, date_to_use, tax_rate,
+                                                      tickers_to_replace, price_cache_config, holdings_scraping_config,
+                                                      holdings_cache_config, look_through_config,
+                                                      snapshot_store_config, kpis_config=kpis_config,
+                                                      risk_config=risk_config, symbol_index_config=symbol_index_config)
+    with stage('render'):
+        return render_html_tables(*portfolio_tables, date_to_use, output_dir)
+
+
+def create_batch_html_tables(
+        dfs: dict,
+        csv_schema: dict,
+        testing: bool,
+        date_to_use: str,
+        tax_rate: float,
+        tickers_to_replace: dict,
+        price_cache_config: dict = None,
+        holdings_scraping_config: dict = None,
+        holdings_cache_config: dict = None,
+        look_through_config: dict = None,
+        snapshot_store_config: dict = None,
+        max_workers: int = 4,
+        kpis_config: dict = None,
+        output_dir: str = 'html_outputs',
+        risk_config: dict = None,
+        symbol_index_config: dict = None
+) -> dict:
+    # prices and holdings are fetched once for the union of the tickers of all portfolios, then every portfolio is
+    # calculated from them and rendered in a pool of processes. Returns the reports of each portfolio, which are also
+    # saved to a folder of output_dir named after it unless output_dir is None.
+    preprocessed = {name: preprocess_portfolio_dataframe(df, csv_schema) for name, df in dfs.items()}
+    all_positions = pd.concat(preprocessed.values(), ignore_index=True)
+
+    etfs = all_positions[all_positions['asset_type'] == 'etf']['ticker'].unique().tolist()
+    with stage('holdings_scraping'):
+        fund_holdings = get_fund_holdings(etfs,
+                                          tickers_to_replace,
+                                          max_depth=(look_through_config or {}).get('max_depth', 1),
+                                          holdings_scraping_config=holdings_scraping_config,
+                                          holdings_cache_config=holdings_cache_config,
+                                          symbol_index_config=symbol_index_config,
+                                          price_cache_config=price_cache_config)
+    tickers = list(dict.fromkeys(all_positions[all_positions['asset_type'] != 'cash']['ticker'].tolist()
+                                 + get_priced_holdings(fund_holdings)))
+    print(f'Getting prices for {len(tickers)} tickers of {len(dfs)} portfolios...')
+    with stage('price_panel'):
+        panel = get_price_panel(tickers, testing, date_to_use, price_cache_config)
+
+    # the renders run in other processes, only their total wall time is recorded here. The processes are spawned
+    # rather than forked, as serve runs a batch with the trigger server and the holdings refresh threads running.
+    with stage('render'), ProcessPoolExecutor(max_workers=max_workers,
+                                              mp_context=multiprocessing.get_context('spawn')) as executor:
+        renders = {}
+        for name, df in preprocessed.items():
+            print(f'Calculating portfolio {name}...')
+            portfolio_snapshot_store_config = None
+            if snapshot_store_config:
+                portfolio_snapshot_store_config = dict(snapshot_store_config, root_dir=os.path.join(
+                    snapshot_store_config.get('root_dir', 'snapshots'), name))
+            with stage(f'calculate_{name}'):
+                portfolio_tables = calculate_portfolio_tables(df, csv_schema, testing, date_to_use, tax_rate,
+                                                              tickers_to_replace, price_cache_config,
+                                                              holdings_scraping_config, holdings_cache_config,
+                                                              look_through_config, portfolio_snapshot_store_config,
+                                                              panel=panel, fund_holdings=fund_holdings,
+                                                              kpis_config=kpis_config, risk_config=risk_config)
+            portfolio_output_dir = os.path.join(output_dir, name) if output_dir is not None else None
+            renders[name] = executor.submit(render_html_tables, *portfolio_tables, date_to_use, portfolio_output_dir)
+        return {name: render.result() for name, render in renders.items()}
+
 
+def create_backfill_tables(
+        df: pd.DataFrame,
+        csv_schema: dict,
+        from_date: str,
+        to_date: str,
+        tax_rate: float,
+        price_cache_config: dict = None,
+        snapshot_store_config: dict = None,
+        kpis_config: dict = None,
+        risk_config: dict = None,
+        output_dir: str = 'html_outputs'
+) -> pd.DataFrame:
+    # calculate the global kpis for every business day in the range, from a single price panel. They are returned, and
+    # also saved to output_dir as csv and as an html table unless output_dir is None.
+    with stage('calculate'):
+        portfolio_global_kpis_over_dates = calculate_kpis_over_dates(df, csv_schema, from_date, to_date, tax_rate,
+                                                                     price_cache_config, kpis_config, risk_config)
+
+    if snapshot_store_config and snapshot_store_config.get('enabled', False):
+        print('Saving snapshots...')
+        root_dir = snapshot_store_config.get('root_dir', 'snapshots')
+        for date, portfolio_global_kpis in portfolio_global_kpis_over_dates.iterrows():
+            write_snapshot(root_dir, 'portfolio_global_kpis', portfolio_global_kpis.to_frame().T,
+                           date.strftime('%Y-%m-%d'))
+
+    amount_cols = [
+        'Starting capital',
+        'Costs paid so far',
+        'Capital after liquidating pre-tax',
+        'Capital after liquidating post-tax'
+    ] + RISK_AMOUNT_KPIS
+    pct_cols = [
+        'ROC per annum post-tax',
+        MONEY_WEIGHTED_RETURN_KPI
+    ] + RISK_PCT_KPIS
+    if output_dir is not None:
+        print(f'Saving global portfolio results over time to {output_dir}...')
+        os.makedirs(output_dir, exist_ok=True)
+        path = os.path.join(output_dir, f'portfolio_global_kpis_{from_date}_{to_date}')
+        portfolio_global_kpis_over_dates.to_csv(path + '.csv')
+        with stage('render'), open(path + '.html', 'w') as file:
+            render_df(portfolio_global_kpis_over_dates.reset_index(), amount_cols=amount_cols, pct_cols=pct_cols,
+                      date_cols=['Date'], file=file)
+    print('Done.')
+
+    return portfolio_global_kpis_over_dates
+
+
+def run(
+        args: argparse.Namespace,
+        config: dict,
+        on_poll=None
+):
     csv_schema = config['portfolio_file']['schema_fields']
     tax_rate = config['parameters']['tax_rate']
     tickers_to_replace = config['tickers_to_replace']
+    price_cache_config = config.get('price_cache')
+    holdings_scraping_config = config.get('holdings_scraping')
+    holdings_cache_config = config.get('holdings_cache')
+    look_through_config = config.get('look_through')
+    snapshot_store_config = config.get('snapshot_store')
+    sheet_cache_config = config.get('sheet_cache')
+    token_cache_config = config.get('token_cache') or {}
+    kpis_config = config.get('kpis')
+    risk_config = config.get('risk')
+    symbol_index_config = config.get('symbol_index')
+    ledger_config = config.get('ledger_file')
+    report_config = config.get('report') or {}
+    smtp_config = config.get('smtp') or {}
+    output_dir = 'html_outputs' if report_config.get('write_files', True) else None
+    compress_attachments_over_kb = report_config.get('compress_attachments_over_kb', 100)
 
     # check if it is a local test to setup the necessary env vars, otherwise assumes vars will be set already
     # note: in local mode google refresh token is assumed to be empty
@@ -151,10 +372,7 @@ def main():
             google_client_id = local_config['GOOGLE_CLIENT_ID']
             google_client_secret = local_config['GOOGLE_CLIENT_SECRET']
             google_refresh_token = local_config['GOOGLE_REFRESH_TOKEN']
-            if args.dummy:
-                google_sheet_id = local_config['GOOGLE_SHEET_DUMMY_ID']
-            else:
-                google_sheet_id = local_config['GOOGLE_SHEET_ID']
+            google_sheet_id = local_config.get('GOOGLE_SHEET_ID')
     else:
         try:
             sender_email = os.environ['SENDER_EMAIL']
@@ -162,29 +380,26 @@ def main():
             google_client_id = os.environ['GOOGLE_CLIENT_ID']
             google_client_secret = os.environ['GOOGLE_CLIENT_SECRET']
             google_refresh_token = os.environ['GOOGLE_REFRESH_TOKEN']
-            google_sheet_id = os.environ['GOOGLE_SHEET_ID']
+            google_sheet_id = os.environ.get('GOOGLE_SHEET_ID')
         except KeyError as err:
             print(f'Environment variable not available: {err}')
             exit()
 
-    # get access token or refresh token
-    refresh_token, access_token, auth_string = get_oauth_token_and_update_config(
-        sender_email,
-        google_client_id,
-        google_client_secret,
-        google_refresh_token
-    )
-
-    # set refresh token environment variables
-    if args.local:
-        local_config['GOOGLE_REFRESH_TOKEN'] = refresh_token
-        with open('./configs/vars.yaml', 'w') as change_local_config:
-            yaml.dump(local_config, change_local_config)
-    else:
-        set_heroku_config_var('GOOGLE_REFRESH_TOKEN', refresh_token)
+    # get access token or refresh token, the access token is reused while it is valid
+    with stage('oauth_refresh'):
+        refresh_token, access_token, auth_string = get_oauth_token_and_update_config(
+            sender_email,
+            google_client_id,
+            google_client_secret,
+            google_refresh_token,
+            token_cache_config
+        )
 
-    # read portfolio dataframe from google sheets
-    df_pfolio = get_google_sheet_df(access_token, google_sheet_id)
+    # save the refresh token, only if it changed
+    with stage('refresh_token_persist'):
+        backend = 'local_file' if args.local else token_cache_config.get('refresh_token_backend', 'heroku')
+        if persist_refresh_token(refresh_token, google_refresh_token, backend):
+            print(f'Refresh token saved to {backend}')
 
     if args.testdate is not None:
         testing = True
@@ -193,12 +408,186 @@ def main():
         testing = False
         date_to_use = datetime.today().strftime('%Y-%m-%d')
 
+    # run every portfolio of the batch config with a single fetch of prices and holdings
+    if args.batch:
+        portfolios = config['batch']['portfolios']
+        with stage('portfolio_load'):
+            dfs_pfolio = {x['name']: load_portfolio(x, csv_schema, access_token, sheet_cache_config, ledger_config)
+                          for x in portfolios}
+        reports = create_batch_html_tables(dfs_pfolio, csv_schema, testing, date_to_use, tax_rate,
+                                           tickers_to_replace, price_cache_config, holdings_scraping_config,
+                                           holdings_cache_config, look_through_config, snapshot_store_config,
+                                           max_workers=config['batch'].get('max_workers', 4),
+                                           kpis_config=kpis_config, output_dir=output_dir,
+                                           risk_config=risk_config, symbol_index_config=symbol_index_config)
+        # all the emails go out over one smtp session
+        with stage('smtp_send'):
+            messages = [(create_email_message(sender_email, x['receiver_email'], date_to_use,
+                                              reports=reports[x['name']],
+                                              compress_attachments_over_kb=compress_attachments_over_kb),
+                         x['receiver_email']) for x in portfolios]
+            refused = send_email_messages_oauth(messages, sender_email, google_client_id, auth_string,
+                                                smtp_config.get('port', 587),
+                                                smtp_config.get('server', 'smtp.gmail.com'),
+                                                smtp_config.get('starttls', True))
+        for receiver_email, message_refused in refused.items():
+            print(f' - The email to {receiver_email} was refused for {list(message_refused)}')
+        return
+
+    # read portfolio dataframe from google sheets or a local file, --dummy reads the dummy portfolio csv
+    if args.dummy:
+        portfolio_source = {'type': 'csv', 'path': 'dummy_portfolio.csv'}
+    elif args.source is not None:
+        portfolio_source = {'type': args.source, 'path': args.portfolio, 'sheet_id': args.portfolio or google_sheet_id}
+    else:
+        portfolio_source = dict({'type': 'google_sheet', 'sheet_id': google_sheet_id},
+                                **(config.get('portfolio_source') or {}))
+    if args.ledger:
+        portfolio_source['ledger'] = True
+    with stage('portfolio_load'):
+        df_pfolio = load_portfolio(portfolio_source, csv_schema, access_token, sheet_cache_config, ledger_config)
+
+    if args.from_date is not None:
+        from_date = args.from_date.strftime('%Y-%m-%d')
+        to_date = (args.to_date or datetime.today()).strftime('%Y-%m-%d')
+        create_backfill_tables(df_pfolio, csv_schema, from_date, to_date, tax_rate, price_cache_config,
+                               snapshot_store_config, kpis_config, risk_config, output_dir)
+        return
+
+    if args.command == 'intraday':
+        intraday_config = config.get('intraday') or {}
+        with stage('intraday_setup'):
+            intraday_portfolio = create_intraday_portfolio(df_pfolio, csv_schema, testing, date_to_use, tax_rate,
+                                                           tickers_to_replace, price_cache_config,
+                                                           holdings_scraping_config, holdings_cache_config,
+                                                           look_through_config, intraday_config.get('resum_every', 100),
+                                                           kpis_config, symbol_index_config)
+        run_intraday(intraday_portfolio, intraday_config, (price_cache_config or {}).get('download'), on_poll)
+        return
+
     # create the html table outputs
-    create_html_tables(df_pfolio, csv_schema, testing, date_to_use, tax_rate, tickers_to_replace)
+    reports = create_html_tables(df_pfolio, csv_schema, testing, date_to_use, tax_rate, tickers_to_replace,
+                                 price_cache_config, holdings_scraping_config, holdings_cache_config,
+                                 look_through_config, snapshot_store_config, kpis_config, output_dir, risk_config,
+                                 symbol_index_config)
 
     # send email
-    message = create_email_message(sender_email, receiver_email, date_to_use)
-    send_email_message_oauth(message, sender_email, receiver_email, google_client_id, auth_string)
+    with stage('smtp_send'):
+        message = create_email_message(sender_email, receiver_email, date_to_use, reports=reports,
+                                       compress_attachments_over_kb=compress_attachments_over_kb)
+        refused = send_email_message_oauth(message, sender_email, receiver_email, google_client_id, auth_string,
+                                           smtp_config.get('port', 587), smtp_config.get('server', 'smtp.gmail.com'),
+                                           smtp_config.get('starttls', True))
+    if refused:
+        print(f' - The email to {receiver_email} was refused for {list(refused)}')
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Produce simple portfolio KPIs for a given portfolio")
+    parser.add_argument("config", type=str, help="The path to a config yaml required to run the program")
+    parser.add_argument("command", nargs='?', choices=['run', 'serve', 'intraday'], default='run',
+                        help="run once (default), serve to stay resident and run the jobs scheduled in the config, or "
+                             "intraday to follow the portfolio on a live view during the day, no email is sent")
+    parser.add_argument("--testdate", type=lambda s: datetime.strptime(s, '%Y-%m-%d'), help="Add a dummy date to test "
+                                                                                            "the program")
+    parser.add_argument("--from", dest="from_date", type=lambda s: datetime.strptime(s, '%Y-%m-%d'),
+                        help="Backfill the global kpis from this date, no email is sent")
+    parser.add_argument("--to", dest="to_date", type=lambda s: datetime.strptime(s, '%Y-%m-%d'),
+                        help="Last date of the backfill, defaults to today")
+    parser.add_argument("--batch", action='store_true',
+                        help="Run every portfolio listed under batch in the config, sharing one price fetch")
+    parser.add_argument("--local", action='store_true', help="Perform local test. You'll be prompted to input env vars.")
+    parser.add_argument("--dummy", action='store_true',
+                        help="Perform test on dummy portfolio file.")
+    parser.add_argument("--source", choices=['google_sheet', 'csv', 'parquet', 'arrow'],
+                        help="Where to read the portfolio from, overrides portfolio_source in the config")
+    parser.add_argument("--portfolio", type=str,
+                        help="Path of the portfolio file, or the sheet id for --source google_sheet")
+    parser.add_argument("--ledger", action='store_true',
+                        help="The portfolio source is a ledger of transactions, reduced to its open lots")
+    parser.add_argument("--profile", action='store_true',
+                        help="Save a cProfile dump of the run next to its metrics file")
+    return parser
+
+
+def run_instrumented(
+        args: argparse.Namespace,
+        config: dict,
+        resident: bool = False
+):
+    # every run records the time, memory and http traffic of its stages in a json metrics file. Memory is never
+    # traced in the long lived processes, the jobs of serve and intraday, where tracemalloc would stay on and slow
+    # down everything after; the metrics of intraday are saved again after every poll as it only ends when stopped.
+    instrumentation_config = config.get('instrumentation') or {}
+    instrumentation_enabled = instrumentation_config.get('enabled', False)
+    metrics_dir = instrumentation_config.get('metrics_dir', 'metrics')
+    long_lived = resident or args.command == 'intraday'
+    run_started = datetime.now()
+    if instrumentation_enabled:
+        start_run(trace_memory=instrumentation_config.get('trace_memory', False) and not long_lived)
+
+    run_info = {
+        'mode': 'batch' if args.batch else 'backfill' if args.from_date is not None
+        else 'intraday' if args.command == 'intraday' else 'daily',
+        'testdate': None if args.testdate is None else args.testdate.strftime('%Y-%m-%d')
+    }
+    on_poll = (lambda: write_metrics(metrics_dir, run_info, run_started)) \
+        if instrumentation_enabled and args.command == 'intraday' else None
+
+    profiler = cProfile.Profile() if args.profile else None
+    try:
+        if profiler is None:
+            run(args, config, on_poll)
+        else:
+            profiler.runcall(run, args, config, on_poll)
+    finally:
+        if instrumentation_enabled:
+            metrics_path = write_metrics(metrics_dir, run_info, run_started)
+            print(f'Run metrics saved to {metrics_path}')
+        if profiler is not None:
+            os.makedirs(metrics_dir, exist_ok=True)
+            profile_path = os.path.join(metrics_dir, f'profile_{run_started:%Y%m%d_%H%M%S}.prof')
+            profiler.dump_stats(profile_path)
+            print(f'Profile saved to {profile_path}, inspect it with python -m pstats {profile_path}')
+
+
+def serve(
+        parser: argparse.ArgumentParser,
+        base_args: list,
+        config: dict
+):
+    # resident mode: the config is parsed once and the process stays up between runs, so imports, compiled templates
+    # and schemas, the google and holdings http sessions and the cached access token are reused, and the closes and
+    # holdings snapshots of their caches are kept in memory, following the caches' own invalidation. Every job runs
+    # with its own command line arguments on top of the ones given to serve.
+    serve_config = config.get('serve') or {}
+    jobs = serve_config.get('jobs') or []
+    if not jobs:
+        raise ValueError('serve needs at least one job under serve.jobs in the config')
+    config['holdings_scraping'] = dict(config.get('holdings_scraping') or {}, keep_session=True)
+    config['holdings_cache'] = dict(config.get('holdings_cache') or {}, resident=True)
+    config['price_cache'] = dict(config.get('price_cache') or {}, resident=True)
+
+    jobs_args = {x['name']: parser.parse_args(base_args + [str(y) for y in x.get('args', [])]) for x in jobs}
+
+    serve_jobs(jobs, lambda name: run_instrumented(jobs_args[name], config, resident=True),
+               host=serve_config.get('host', '127.0.0.1'),
+               port=int(os.environ.get('PORT', serve_config.get('port', 8765))),
+               trigger_token=os.environ.get('SERVE_TRIGGER_TOKEN'))
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    # Initial setup based on the configuration file
+    with open(args.config) as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+
+    if args.command == 'serve':
+        serve(parser, [x for x in sys.argv[1:] if x != 'serve'], config)
+    else:
+        run_instrumented(args, config)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,192 @@
+import hmac
+import ipaddress
+import json
+import queue
+import threading
+import traceback
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# minute, hour, day of month, month and day of week (0 or 7 is sunday), as in crontab
+CRON_FIELDS = [('minute', 0, 59), ('hour', 0, 23), ('day', 1, 31), ('month', 1, 12), ('weekday', 0, 7)]
+CRON_MAX_DAYS_AHEAD = 366 * 5
+# header the shared secret of the triggers is sent in, when the server listens beyond the loopback interface
+TRIGGER_TOKEN_HEADER = 'X-Trigger-Token'
+
+
+def parse_cron_field(
+        field: str,
+        low: int,
+        high: int
+) -> set:
+    # supports *, */n, a, a-b, a-b/n and comma separated lists of those
+    values = set()
+    for part in field.split(','):
+        value_range, _, step = part.partition('/')
+        if value_range == '*':
+            start, end = low, high
+        elif '-' in value_range:
+            start, end = map(int, value_range.split('-'))
+        else:
+            start = int(value_range)
+            end = high if step else start
+        if not low <= start <= end <= high:
+            raise ValueError(f'{part} is out of the range {low}-{high}')
+        values.update(range(start, end + 1, int(step) if step else 1))
+    return values
+
+
+def parse_cron(
+        expression: str
+) -> dict:
+    fields = expression.split()
+    if len(fields) != len(CRON_FIELDS):
+        raise ValueError(f'A cron expression has {len(CRON_FIELDS)} fields, got "{expression}"')
+    cron = {name: parse_cron_field(field, low, high) for field, (name, low, high) in zip(fields, CRON_FIELDS)}
+    if 7 in cron['weekday']:
+        cron['weekday'] = (cron['weekday'] - {7}) | {0}
+    # as in cron, a day matches either field when both day of month and day of week are restricted, and a field
+    # starting with * (*/2 too) is not restricted
+    cron['day_restricted'] = not fields[2].startswith('*')
+    cron['weekday_restricted'] = not fields[4].startswith('*')
+    return cron
+
+
+def get_next_run(
+        cron: dict,
+        after: datetime
+) -> datetime:
+    # first minute strictly after `after` matching the expression, walking days first and then their hours
+    after = after.replace(second=0, microsecond=0)
+    for days_ahead in range(CRON_MAX_DAYS_AHEAD):
+        day = (after + timedelta(days_ahead)).replace(hour=0, minute=0)
+        if day.month not in cron['month']:
+            continue
+        day_matches = day.day in cron['day']
+        weekday_matches = (day.weekday() + 1) % 7 in cron['weekday']
+        if cron['day_restricted'] and cron['weekday_restricted']:
+            if not (day_matches or weekday_matches):
+                continue
+        elif not (day_matches and weekday_matches):
+            continue
+        for hour in sorted(cron['hour']):
+            for minute in sorted(cron['minute']):
+                candidate = day.replace(hour=hour, minute=minute)
+                if candidate > after:
+                    return candidate
+    raise ValueError(f'The cron expression never matches in the next {CRON_MAX_DAYS_AHEAD} days')
+
+
+def is_loopback(
+        host: str
+) -> bool:
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class _TriggerHandler(BaseHTTPRequestHandler):
+    # GET /status lists the jobs, POST /run/<job> queues a run of the job
+    def _send_json(self, status, body):
+        data = json.dumps(body, indent=2, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip('/') in ('', '/status'):
+            with self.server.jobs_lock:
+                self._send_json(200, self.server.jobs)
+        else:
+            self._send_json(404, {'error': 'unknown path, use GET /status or POST /run/<job>'})
+
+    def do_POST(self):
+        parts = self.path.strip('/').split('/')
+        token = self.server.trigger_token
+        sent_token = self.headers.get(TRIGGER_TOKEN_HEADER)
+        if token is not None and sent_token is None:
+            self._send_json(401, {'error': f'missing {TRIGGER_TOKEN_HEADER} header'})
+        elif token is not None and not hmac.compare_digest(sent_token.encode(), token.encode()):
+            self._send_json(403, {'error': f'wrong {TRIGGER_TOKEN_HEADER} header'})
+        elif len(parts) != 2 or parts[0] != 'run':
+            self._send_json(404, {'error': 'unknown path, use GET /status or POST /run/<job>'})
+        elif parts[1] not in self.server.jobs:
+            self._send_json(404, {'error': f'unknown job {parts[1]}, use one of {list(self.server.jobs)}'})
+        else:
+            self.server.triggers.put(parts[1])
+            self._send_json(202, {'queued': parts[1]})
+
+    def log_message(self, format, *args):
+        print(f' - Trigger server: {format % args}')
+
+
+def start_trigger_server(
+        jobs: dict,
+        host: str = '127.0.0.1',
+        port: int = 8765,
+        trigger_token: str = None
+) -> ThreadingHTTPServer:
+    # serves GET /status and POST /run/<job> from a thread, over the state of the jobs by name. The triggers are put
+    # on server.triggers, and need the trigger_token in their header when it is given.
+    server = ThreadingHTTPServer((host, port), _TriggerHandler)
+    server.daemon_threads = True
+    server.jobs = jobs
+    server.jobs_lock = threading.Lock()
+    server.triggers = queue.Queue()
+    server.trigger_token = trigger_token
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def serve_jobs(
+        jobs: list,
+        run_job,
+        host: str = '127.0.0.1',
+        port: int = 8765,
+        trigger_token: str = None
+):
+    # runs every job (a dict with a name and a cron schedule) with run_job(name) when it is due, or when it is
+    # triggered over http. Runs happen one at a time in this thread, a failed run is reported and the loop goes on.
+    # Triggers need the trigger_token in their header when it is given, and it has to be when host isn't loopback.
+    if trigger_token is None and not is_loopback(host):
+        raise ValueError(f'Serving triggers on {host} needs a trigger token, only loopback hosts can go without')
+    state = {job['name']: {'schedule': job['schedule'], 'next_run': None, 'last_run': None, 'last_status': None,
+                           'last_duration_s': None} for job in jobs}
+    crons = {job['name']: parse_cron(job['schedule']) for job in jobs}
+    for name, cron in crons.items():
+        state[name]['next_run'] = get_next_run(cron, datetime.now())
+
+    server = start_trigger_server(state, host, port, trigger_token)
+    print(f'Serving {len(jobs)} jobs, triggers on http://{host}:{server.server_port}')
+
+    try:
+        while True:
+            next_name = min(state, key=lambda x: state[x]['next_run'])
+            wait_seconds = max(0.0, (state[next_name]['next_run'] - datetime.now()).total_seconds())
+            try:
+                name = server.triggers.get(timeout=wait_seconds)
+                print(f'Manual run of {name}')
+            except queue.Empty:
+                name = next_name
+                with server.jobs_lock:
+                    state[name]['next_run'] = get_next_run(crons[name], datetime.now())
+                print(f'Scheduled run of {name}')
+
+            started = datetime.now()
+            try:
+                run_job(name)
+                status = 'ok'
+            except (Exception, SystemExit) as e:
+                traceback.print_exc()
+                status = f'failed: {e!r}'
+            with server.jobs_lock:
+                state[name].update(last_run=started, last_status=status,
+                                   last_duration_s=round((datetime.now() - started).total_seconds(), 2))
+            print(f'Run of {name} {status}, next scheduled run at {state[name]["next_run"]:%Y-%m-%d %H:%M}')
+    finally:
+        server.shutdown()
@@ -1,3 +1,6 @@
+import gzip
+import os
+import re
 import smtplib
 import ssl
 from email.mime.text import MIMEText
@@ -6,27 +9,55 @@ from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from oauth2 import get_oauth_token_and_update_config
 
+REPORT_FILES = ['portfolio_global_kpis.html', 'portfolio_indirect_positions.html', 'portfolio_with_kpis.html']
+# zlib's default level, the html tables barely get smaller at 9 and take several times longer
+ATTACHMENT_COMPRESSLEVEL = 6
+
+
+def read_reports(
+        output_dir: str = 'html_outputs'
+) -> dict:
+    # the reports saved by an earlier render, by file name
+    reports = {}
+    for file_name in REPORT_FILES:
+        with open(os.path.join(output_dir, file_name), 'r') as file:
+            reports[file_name] = file.read()
+    return reports
+
 
 def create_email_message(
         sender_email: str,
         receiver_email: str,
-        date_to_use: str
+        date_to_use: str,
+        output_dir: str = 'html_outputs',
+        reports: dict = None,
+        compress_attachments_over_kb: float = 100
 ) -> MIMEMultipart:
+    # the reports are the html of the render by file name, read back from output_dir when they are not given. The
+    # asset level table is attached, gzipped when it is larger than compress_attachments_over_kb.
+    if reports is None:
+        reports = read_reports(output_dir)
+
     # Create contents of the message
     text = f"""\
     Hi,
     Here is your daily portfolio dashboard for {date_to_use}."""
-    global_kpis = open("html_outputs/portfolio_global_kpis.html", 'r').read()
-    indirect = open("html_outputs/portfolio_indirect_positions.html", 'r').read()
+    global_kpis = reports['portfolio_global_kpis.html']
+    indirect = reports['portfolio_indirect_positions.html']
 
     html_part = MIMEMultipart(_subtype='related')
     body = MIMEText(f'{text} <br> {global_kpis} <br> {indirect}', _subtype='html')
     html_part.attach(body)
 
-    filename = 'html_outputs/portfolio_with_kpis.html'
-    with open(filename, "rb") as attachment:
+    filename = 'portfolio_with_kpis.html'
+    attachment = reports[filename].encode()
+    if compress_attachments_over_kb is not None and len(attachment) > compress_attachments_over_kb * 1024:
+        attachment = gzip.compress(attachment, compresslevel=ATTACHMENT_COMPRESSLEVEL)
+        filename += '.gz'
+        attach_part = MIMEBase("application", "gzip")
+    else:
         attach_part = MIMEBase("application", "octet-stream")
-        attach_part.set_payload(attachment.read())
+    attach_part.set_payload(attachment)
 
     # Encode file in ASCII characters to send by email
     encoders.encode_base64(attach_part)
@@ -48,6 +79,84 @@ def create_email_message(
     return message
 
 
+def _send_pipelined(
+        server: smtplib.SMTP,
+        sender_email: str,
+        receiver_emails: list,
+        message: bytes
+) -> dict:
+    # MAIL, RCPT and DATA go out in a single write and their replies are read after (RFC 2920), then the message.
+    # Errors are raised as smtplib.sendmail raises them, with the session left ready for the next message.
+    commands = [f'mail FROM:{smtplib.quoteaddr(sender_email)}'] + \
+               [f'rcpt TO:{smtplib.quoteaddr(x)}' for x in receiver_emails] + ['data']
+    server.send(''.join(f'{x}\r\n' for x in commands))
+    replies = [server.getreply() for _ in commands]
+    (mail_code, mail_response), rcpt_replies, (data_code, data_response) = replies[0], replies[1:-1], replies[-1]
+    refused = {x: reply for x, reply in zip(receiver_emails, rcpt_replies) if reply[0] not in (250, 251)}
+
+    if mail_code != 250 or len(refused) == len(receiver_emails) or data_code != 354:
+        if data_code == 354:
+            # the server took the data command anyway, an empty message ends it before the reset
+            server.send('.\r\n')
+            server.getreply()
+        server.rset()
+        if mail_code != 250:
+            raise smtplib.SMTPSenderRefused(mail_code, mail_response, sender_email)
+        if len(refused) == len(receiver_emails):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        raise smtplib.SMTPDataError(data_code, data_response)
+
+    # line endings as CRLF and leading dots doubled, as smtplib.SMTP.data does
+    data = re.sub(rb'(?:\r\n|\n|\r(?!\n))', b'\r\n', message)
+    data = re.sub(rb'(?m)^\.', b'..', data)
+    if not data.endswith(b'\r\n'):
+        data += b'\r\n'
+    server.send(data + b'.\r\n')
+    code, response = server.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, response)
+    return refused
+
+
+def send_email_messages_oauth(
+        messages: list,
+        sender_email: str,
+        google_client_id: str,
+        auth_string: str,
+        port: int = 587,
+        smtp_server: str = "smtp.gmail.com",
+        starttls: bool = True
+) -> dict:
+    # sends every (message, receiver email) pair over a single authenticated session, pipelining the commands of each
+    # message when the server supports it. A message refused by the server doesn't stop the others, the session is
+    # reset and the next one sent. Returns the refused recipients, with the reply of the server, of each receiver
+    # email that had some.
+    with smtplib.SMTP(f'{smtp_server}:{port}') as server:
+        server.ehlo(google_client_id)
+        if starttls:
+            server.starttls(context=ssl.create_default_context())
+            server.ehlo(google_client_id)
+        server.docmd('AUTH', 'XOAUTH2 ' + auth_string)
+
+        refused = {}
+        for message, receiver_email in messages:
+            receiver_emails = [receiver_email] if isinstance(receiver_email, str) else list(receiver_email)
+            try:
+                if server.has_extn('pipelining'):
+                    message_refused = _send_pipelined(server, sender_email, receiver_emails, message.as_bytes())
+                else:
+                    message_refused = server.sendmail(sender_email, receiver_emails, message.as_bytes())
+            except smtplib.SMTPRecipientsRefused as e:
+                server.rset()
+                message_refused = e.recipients
+            except (smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                server.rset()
+                message_refused = {x: (e.smtp_code, e.smtp_error) for x in receiver_emails}
+            if message_refused:
+                refused[str(receiver_email)] = message_refused
+        return refused
+
+
 def send_email_message_oauth(
         message: MIMEMultipart,
         sender_email: str,
@@ -55,11 +164,14 @@ def send_email_message_oauth(
         google_client_id: str,
         auth_string: str,
         port: int = 587,
-        smtp_server: str = "smtp.gmail.com"
-):
-    server = smtplib.SMTP(f'{smtp_server}:{port}')
-    server.ehlo(google_client_id)
-    server.starttls()
-    server.docmd('AUTH', 'XOAUTH2 ' + auth_string)
-    server.sendmail(sender_email, receiver_email, message.as_string())
-    server.quit()
+        smtp_server: str = "smtp.gmail.com",
+        starttls: bool = True
+) -> dict:
+    # a single email fails as smtplib.sendmail does, refused by all its recipients it raises SMTPRecipientsRefused.
+    # Otherwise returns the recipients that refused it, with the reply of the server.
+    refused = send_email_messages_oauth([(message, receiver_email)], sender_email, google_client_id, auth_string,
+                                        port, smtp_server, starttls).get(str(receiver_email), {})
+    receiver_emails = [receiver_email] if isinstance(receiver_email, str) else list(receiver_email)
+    if refused and len(refused) == len(receiver_emails):
+        raise smtplib.SMTPRecipientsRefused(refused)
+    return refused
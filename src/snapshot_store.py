@@ -0,0 +1,153 @@
+import glob
+import os
+import time
+from datetime import datetime, timedelta
+import pandas as pd
+
+# Snapshots are stored as <root_dir>/<table>/date=<YYYY-MM-DD>/part-<ns>.parquet. Parts are only ever added, so a
+# rerun for the same date appends a new part instead of rewriting the partition; compaction merges old parts. Every row
+# carries the snapshot_ts of the run that wrote it, which tells reruns apart once their parts are merged.
+SNAPSHOT_TABLES = ['portfolio_with_kpis', 'portfolio_global_kpis', 'portfolio_indirect_positions']
+
+
+def compact_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.copy()
+    for col in df.columns:
+        if pd.api.types.is_integer_dtype(df[col].dtype):
+            df[col] = pd.to_numeric(df[col], downcast='integer')
+        elif pd.api.types.is_object_dtype(df[col].dtype) or pd.api.types.is_string_dtype(df[col].dtype):
+            df[col] = df[col].astype('category')
+    return df
+
+
+def get_partition_dir(root_dir: str, table: str, date: str) -> str:
+    return os.path.join(root_dir, table, f'date={date}')
+
+
+def write_snapshot(
+        root_dir: str,
+        table: str,
+        df: pd.DataFrame,
+        date: str
+) -> str:
+    partition_dir = get_partition_dir(root_dir, table, date)
+    os.makedirs(partition_dir, exist_ok=True)
+    snapshot_ts = time.time_ns()
+    part_path = os.path.join(partition_dir, f'part-{snapshot_ts}.parquet')
+
+    # written under a temporary name first, so readers never see a half written part
+    df = compact_dtypes(df.reset_index(drop=True))
+    df['snapshot_ts'] = snapshot_ts
+    df.to_parquet(part_path + '.tmp', index=False)
+    os.replace(part_path + '.tmp', part_path)
+
+    return part_path
+
+
+def list_partitions(
+        root_dir: str,
+        table: str,
+        start: str = None,
+        end: str = None
+) -> list:
+    # partition dates between start and end (both included), from the directory names alone
+    dates = sorted(os.path.basename(x)[len('date='):] for x in glob.glob(os.path.join(root_dir, table, 'date=*')))
+    return [x for x in dates if (start is None or x >= start) and (end is None or x <= end)]
+
+
+def list_parts(
+        root_dir: str,
+        table: str,
+        date: str
+) -> list:
+    return sorted(glob.glob(os.path.join(get_partition_dir(root_dir, table, date), 'part-*.parquet')))
+
+
+def read_snapshots(
+        root_dir: str,
+        table: str,
+        start: str = None,
+        end: str = None,
+        columns: list = None,
+        latest_only: bool = True
+) -> pd.DataFrame:
+    # reads only the partitions in the date range and, if given, only the requested columns. With latest_only, a date
+    # that was snapshotted more than once only returns the rows of its last run.
+    frames = []
+    for date in list_partitions(root_dir, table, start, end):
+        for part in list_parts(root_dir, table, date):
+            frame = pd.read_parquet(part, columns=None if columns is None else columns + ['snapshot_ts'])
+            frame.insert(0, 'date', pd.Timestamp(date))
+            frames.append(frame)
+
+    if not frames:
+        return pd.DataFrame(columns=['date'] + (columns or []))
+
+    snapshots = pd.concat(frames, ignore_index=True)
+    if latest_only:
+        snapshots = snapshots[snapshots['snapshot_ts'] == snapshots.groupby('date')['snapshot_ts'].transform('max')]
+
+    return snapshots.drop(columns='snapshot_ts').reset_index(drop=True)
+
+
+def compact_partitions(
+        root_dir: str,
+        table: str,
+        older_than_days: int = 30
+):
+    # merges the parts of every partition older than older_than_days into a single part
+    cutoff = (datetime.today() - timedelta(older_than_days)).strftime('%Y-%m-%d')
+    for date in list_partitions(root_dir, table, end=cutoff):
+        parts = list_parts(root_dir, table, date)
+        if len(parts) < 2:
+            continue
+        compacted = pd.concat([pd.read_parquet(x) for x in parts], ignore_index=True)
+        # the merged part takes the place of the newest one, then the older parts are dropped
+        compacted.to_parquet(parts[-1] + '.tmp', index=False)
+        os.replace(parts[-1] + '.tmp', parts[-1])
+        for part in parts[:-1]:
+            os.remove(part)
+
+
+def write_snapshots(
+        snapshot_store_config: dict,
+        date: str,
+        portfolio_with_kpis: pd.DataFrame,
+        portfolio_global_kpis: pd.DataFrame,
+        portfolio_indirect_positions: pd.DataFrame
+):
+    root_dir = snapshot_store_config.get('root_dir', 'snapshots')
+    frames = dict(zip(SNAPSHOT_TABLES, [portfolio_with_kpis, portfolio_global_kpis, portfolio_indirect_positions]))
+    for table, df in frames.items():
+        write_snapshot(root_dir, table, df, date)
+        compact_partitions(root_dir, table, snapshot_store_config.get('compact_after_days', 30))
+
+
+def get_kpi_trend(
+        root_dir: str,
+        kpis: list,
+        start: str = None,
+        end: str = None
+) -> pd.DataFrame:
+    return read_snapshots(root_dir, 'portfolio_global_kpis', start, end, columns=kpis).set_index('date')
+
+
+def get_drawdown(
+        root_dir: str,
+        start: str = None,
+        end: str = None,
+        kpi: str = 'Capital after liquidating post-tax'
+) -> pd.Series:
+    values = get_kpi_trend(root_dir, [kpi], start, end)[kpi]
+    return (values / values.cummax() - 1).rename('drawdown')
+
+
+def get_exposure_drift(
+        root_dir: str,
+        start: str = None,
+        end: str = None
+) -> pd.DataFrame:
+    # change in each holding's share of the portfolio against the first snapshot of the range
+    exposures = read_snapshots(root_dir, 'portfolio_indirect_positions', start, end, columns=['Ticker', 'Pct'])
+    exposures = exposures.pivot_table(index='date', columns='Ticker', values='Pct', aggfunc='sum', observed=True)
+    return exposures.fillna(0.0) - exposures.fillna(0.0).iloc[0] if len(exposures) else exposures
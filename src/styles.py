@@ -1,4 +1,8 @@
+from typing import Optional
+from uuid import uuid4
+import numpy as np
 import pandas as pd
+from jinja2 import Environment
 from pandas.io.formats.style import Styler
 
 def style_df(
@@ -81,4 +85,187 @@ def style_indirect_holdings_df(
 
     df = style_df(df, amount_cols, pct_cols, date_cols, float_cols, str_cols)
 
-    return df.bar(subset=bar_cols, align='mid', color=[bar_neg_color, bar_pos_color])
\ No newline at end of file
+    return df.bar(subset=bar_cols, align='mid', color=[bar_neg_color, bar_pos_color])
+
+# Template based rendering. The formats are applied per column with vectorized operations and the table is streamed
+# through a template compiled once, producing the same markup and css as the Styler path above.
+AMOUNT_FORMAT = "{:,.1f}€"
+PCT_FORMAT = "{:.2%}"
+DATE_FORMAT = "%Y-%m-%d"
+FLOAT_FORMAT = "{:,.1f}"
+
+_TABLE_TEMPLATE = Environment(autoescape=True, trim_blocks=True, lstrip_blocks=True).from_string("""\
+<style  type="text/css" >
+{% for selector, props in table_styles %}
+    #T_{{ uuid }} {{ selector }} {
+{% for prop, value in props %}
+          {{ prop }}: {{ value }};
+{% endfor %}
+    }
+{% endfor %}
+{% for cell_id, css in cell_styles %}
+    #T_{{ uuid }}{{ cell_id }} {
+        {{ css }}
+    }
+{% endfor %}
+</style><table id="T_{{ uuid }}" >
+<thead>    <tr>
+{% if show_index %}
+        <th class="blank level0" ></th>
+{% endif %}
+{% for col in columns %}
+        <th class="col_heading level0 col{{ loop.index0 }}" >{{ col }}</th>
+{% endfor %}
+    </tr></thead><tbody>
+{% for index_value, row in rows %}
+{% set r = loop.index0 %}
+                <tr>
+{% if show_index %}
+                        <th id="T_{{ uuid }}level0_row{{ r }}" class="row_heading level0 row{{ r }}" >{{ index_value }}</th>
+{% endif %}
+{% for value in row %}
+                        <td id="T_{{ uuid }}row{{ r }}_col{{ loop.index0 }}" class="data row{{ r }} col{{ loop.index0 }}" >\
+{{ value }}</td>
+{% endfor %}
+            </tr>
+{% endfor %}
+    </tbody></table>""")
+
+
+def _get_table_styles(max_col_width: str) -> list:
+    return [
+        ("th", [("text-align", "center"), ("text-weight", "bold"), ("font-size", "12"),
+                ("font-family", "monospace"), ("width", max_col_width)]),
+        ("index", [("text-align", "center"), ("text-weight", "bold"), ("font-size", "12"),
+                   ("font-family", "monospace")]),
+        ("td", [("text-align", "center"), ("text-weight", "bold"), ("font-size", "10"),
+                ("font-family", "monospace"), ("width", max_col_width)]),
+    ]
+
+
+def _format_numbers(values: pd.Series, number_format: str, na_rep: str) -> pd.Series:
+    numbers = pd.to_numeric(values, errors='coerce').astype(float)
+    return numbers.map(number_format.format).where(numbers.notna(), na_rep)
+
+
+def _format_default(values: pd.Series) -> pd.Series:
+    # same as the Styler default: floats with the display precision, anything else as str
+    precision = pd.get_option("display.precision")
+    if pd.api.types.is_float_dtype(values.dtype):
+        return values.astype(float).map(f"{{:.{precision}f}}".format)
+    return values.map(lambda x: f"{x:.{precision}f}" if pd.api.types.is_float(x) else str(x))
+
+
+def format_df(
+        df: pd.DataFrame,
+        amount_cols: list,
+        pct_cols: list,
+        date_cols: list = [],
+        float_cols: list = [],
+        str_cols: list = [],
+        na_rep: str = "-"
+) -> pd.DataFrame:
+    formatted = {}
+    for col in df.columns:
+        if col in amount_cols:
+            formatted[col] = _format_numbers(df[col], AMOUNT_FORMAT, na_rep)
+        elif col in pct_cols:
+            formatted[col] = _format_numbers(df[col], PCT_FORMAT, na_rep)
+        elif col in float_cols:
+            formatted[col] = _format_numbers(df[col], FLOAT_FORMAT, na_rep)
+        elif col in date_cols:
+            dates = pd.to_datetime(df[col], errors='coerce')
+            formatted[col] = dates.dt.strftime(DATE_FORMAT).where(dates.notna(), na_rep)
+        elif col in str_cols:
+            formatted[col] = df[col].astype(str).str[:18]
+        else:
+            formatted[col] = _format_default(df[col])
+
+    return pd.DataFrame(formatted, index=df.index, columns=df.columns)
+
+
+def get_bar_styles(
+        df: pd.DataFrame,
+        bar_cols: list,
+        bar_neg_color: str = 'lightcoral',
+        bar_pos_color: str = 'lightgreen',
+        width: float = 100
+) -> list:
+    # css of Styler.bar(align='mid') for every cell of bar_cols, with the bar extents computed column-wise in numpy
+    cell_styles = []
+    for col in bar_cols:
+        col_position = df.columns.get_loc(col)
+        values = pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=float)
+        if np.isnan(values).all():
+            continue
+        smin = min(0, np.nanmin(values))
+        smax = max(0, np.nanmax(values))
+        normed = width * (values - smin) / (smax - smin + 1e-12)
+        zero = -width * smin / (smax - smin + 1e-12)
+
+        starts = np.minimum(normed, zero)
+        ends = np.minimum(np.maximum(normed, zero), width)
+        colors = np.where(normed > zero, bar_pos_color, bar_neg_color)
+        for row_position in np.flatnonzero(~np.isnan(values)):
+            start, end, color = starts[row_position], ends[row_position], colors[row_position]
+            css = "width: 10em; height: 80%;"
+            if end > start:
+                css += "background: linear-gradient(90deg,"
+                if start > 0:
+                    css += f" transparent {start:.1f}%, {color} {start:.1f}%,"
+                css += f" {color} {end:.1f}%, transparent {end:.1f}%)"
+            cell_styles.append((f"row{row_position}_col{col_position}", css))
+
+    return cell_styles
+
+
+def render_df(
+        df: pd.DataFrame,
+        amount_cols: list,
+        pct_cols: list,
+        date_cols: list = [],
+        float_cols: list = [],
+        str_cols: list = [],
+        row_wise_style: bool = False,
+        max_col_width: str = '180px',
+        bar_cols: list = [],
+        bar_neg_color: str = 'lightcoral',
+        bar_pos_color: str = 'lightgreen',
+        file=None
+) -> Optional[str]:
+    # drop-in for style_df(...).render(); with row_wise_style the formats apply to the rows of df, as in style_df.
+    # The html is streamed to file when one is given and None is returned, otherwise the html is returned.
+    if row_wise_style:
+        formatted = format_df(df.T, amount_cols, pct_cols, date_cols, float_cols, str_cols).T
+    else:
+        formatted = format_df(df, amount_cols, pct_cols, date_cols, float_cols, str_cols)
+
+    stream = _TABLE_TEMPLATE.generate(
+        uuid=uuid4().hex[:5] + "_",
+        table_styles=_get_table_styles(max_col_width),
+        cell_styles=get_bar_styles(df, bar_cols, bar_neg_color, bar_pos_color),
+        show_index=row_wise_style,
+        columns=formatted.columns,
+        rows=zip(formatted.index, formatted.itertuples(index=False, name=None))
+    )
+    if file is None:
+        return "".join(stream)
+    for chunk in stream:
+        file.write(chunk)
+
+
+def render_indirect_holdings_df(
+        df: pd.DataFrame,
+        amount_cols: list,
+        pct_cols: list,
+        date_cols: list = [],
+        float_cols: list = [],
+        str_cols: list = [],
+        bar_cols: list = ['Value', 'Pct'],
+        bar_neg_color: str = 'lightcoral',
+        bar_pos_color: str = 'lightgreen',
+        file=None
+) -> Optional[str]:
+    # as render_df, None when the html is streamed to file
+    return render_df(df, amount_cols, pct_cols, date_cols, float_cols, str_cols, bar_cols=bar_cols,
+                     bar_neg_color=bar_neg_color, bar_pos_color=bar_pos_color, file=file)
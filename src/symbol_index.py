@@ -0,0 +1,101 @@
+import os
+import re
+import sqlite3
+import time
+from price_cache import get_quoted_tickers
+
+SYMBOL_INDEX_FILE = 'symbols.sqlite'
+# exchanges tried, in order, for a holding symbol that is not quoted as it is
+DEFAULT_EXCHANGE_SUFFIXES = ['.L', '.DE', '.PA', '.AS', '.SW', '.MI', '.MC', '.BR', '.ST', '.CO', '.HE', '.OL', '.TO',
+                             '.AX', '.HK', '.T', '.KS', '.TW', '.SI']
+
+
+def open_symbol_index(cache_dir: str) -> sqlite3.Connection:
+    os.makedirs(cache_dir, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(cache_dir, SYMBOL_INDEX_FILE))
+    # ticker is null for the symbols none of whose candidates are quoted
+    conn.execute('CREATE TABLE IF NOT EXISTS symbols '
+                 '(symbol TEXT PRIMARY KEY, ticker TEXT, checked_at REAL NOT NULL)')
+    return conn
+
+
+def get_candidates(
+        symbol: str,
+        exchange_suffixes: list = DEFAULT_EXCHANGE_SUFFIXES
+) -> list:
+    # the symbol as it is and with its share class written the Yahoo way (BRK.B -> BRK-B, NIBE B -> NIBE-B), numeric
+    # codes also padded to four digits (00700 -> 0700), then those with every exchange suffix, and last the symbol
+    # without the suffix it came with (STM.SI -> STM)
+    bases = [symbol, re.sub(r'[ .]([A-Z])$', r'-\1', symbol)]
+    if symbol.isdigit():
+        bases.append(symbol.lstrip('0').zfill(4))
+    bases = list(dict.fromkeys(bases))
+    candidates = bases + [x + y for y in exchange_suffixes for x in bases if '.' not in x and ' ' not in x]
+    if '.' in symbol:
+        candidates.append(symbol.rsplit('.', 1)[0])
+    return list(dict.fromkeys(candidates))
+
+
+def probe_symbols(
+        symbols: list,
+        exchange_suffixes: list = DEFAULT_EXCHANGE_SUFFIXES,
+        probe_days: int = 10,
+        download_config: dict = None
+) -> dict:
+    # the first quoted candidate of every symbol, None when there is none. Most symbols are quoted as they are, so
+    # those are probed first and the candidates of the rest all together after, two chunked downloads in all.
+    resolved = {}
+    quoted = get_quoted_tickers(symbols, probe_days, download_config)
+    pending = []
+    for symbol in symbols:
+        if symbol in quoted:
+            resolved[symbol] = symbol
+        else:
+            pending.append(symbol)
+
+    candidates = {x: get_candidates(x, exchange_suffixes)[1:] for x in pending}
+    quoted = get_quoted_tickers(list(dict.fromkeys(y for x in candidates.values() for y in x)), probe_days,
+                                download_config)
+    for symbol in pending:
+        resolved[symbol] = next((x for x in candidates[symbol] if x in quoted), None)
+    return resolved
+
+
+def resolve_symbols(
+        symbols: list,
+        symbol_index_config: dict = None,
+        download_config: dict = None
+) -> dict:
+    # maps every symbol to its Yahoo ticker, or to None when it can't be resolved. Resolutions are kept for good,
+    # failures for negative_ttl_days before the symbol is probed again. The probes are downloaded as the prices are,
+    # with the download config of the price cache.
+    if not symbols or not symbol_index_config or not symbol_index_config.get('enabled', False):
+        return {x: x for x in symbols}
+
+    negative_ttl_seconds = symbol_index_config.get('negative_ttl_days', 7) * 86400
+    conn = open_symbol_index(symbol_index_config.get('cache_dir', '.cache'))
+    try:
+        rows = conn.execute(f'SELECT symbol, ticker, checked_at FROM symbols '
+                            f'WHERE symbol IN ({",".join("?" * len(symbols))})', symbols)
+        now = time.time()
+        resolved = {symbol: ticker for symbol, ticker, checked_at in rows
+                    if ticker is not None or now - checked_at < negative_ttl_seconds}
+
+        to_probe = [x for x in symbols if x not in resolved]
+        if to_probe:
+            probed = probe_symbols(to_probe,
+                                   symbol_index_config.get('exchange_suffixes', DEFAULT_EXCHANGE_SUFFIXES),
+                                   symbol_index_config.get('probe_days', 10), download_config)
+            conn.executemany('INSERT OR REPLACE INTO symbols (symbol, ticker, checked_at) VALUES (?, ?, ?)',
+                             [(symbol, ticker, now) for symbol, ticker in probed.items()])
+            conn.commit()
+            print(f' - Resolved {sum(x is not None for x in probed.values())} of {len(probed)} new symbols')
+            resolved.update(probed)
+    finally:
+        conn.close()
+
+    unresolved = [x for x in symbols if resolved[x] is None]
+    if unresolved:
+        print(f' - {len(unresolved)} symbols could not be resolved and are not priced: {unresolved[:10]}'
+              + (' ...' if len(unresolved) > 10 else ''))
+    return {x: resolved[x] for x in symbols}
@@ -1,5 +1,40 @@
 import os
+import yaml
 
 
 def set_heroku_config_var(name, value):
-	os.system('heroku config:set ' + name + '=' + value)
\ No newline at end of file
+	os.system('heroku config:set ' + name + '=' + value)
+
+
+def persist_refresh_token_local_file(refresh_token, vars_path='./configs/vars.yaml'):
+	with open(vars_path) as f:
+		local_config = yaml.load(f, Loader=yaml.FullLoader)
+	local_config['GOOGLE_REFRESH_TOKEN'] = refresh_token
+	with open(vars_path, 'w') as f:
+		yaml.dump(local_config, f)
+
+
+def persist_refresh_token_env(refresh_token):
+	# only seen by this process and the ones it starts, for runs where the token is managed outside of the app
+	os.environ['GOOGLE_REFRESH_TOKEN'] = refresh_token
+
+
+def persist_refresh_token_heroku(refresh_token):
+	set_heroku_config_var('GOOGLE_REFRESH_TOKEN', refresh_token)
+
+
+REFRESH_TOKEN_BACKENDS = {
+	'local_file': persist_refresh_token_local_file,
+	'env': persist_refresh_token_env,
+	'heroku': persist_refresh_token_heroku,
+}
+
+
+def persist_refresh_token(refresh_token, previous_refresh_token, backend='heroku'):
+	# the refresh token is only written when it changed, returns whether it was
+	if refresh_token == previous_refresh_token:
+		return False
+	if backend not in REFRESH_TOKEN_BACKENDS:
+		raise ValueError(f'Unknown refresh token backend {backend}, use one of {list(REFRESH_TOKEN_BACKENDS)}')
+	REFRESH_TOKEN_BACKENDS[backend](refresh_token)
+	return True
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the modules of src and benchmarks import each other by their bare names, as they do when run as scripts
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT_DIR, 'src'), os.path.join(ROOT_DIR, 'benchmarks')]
@@ -0,0 +1,62 @@
+import holdings_cache
+from holdings_cache import get_cached_holdings, read_resident_snapshots
+
+HOLDINGS = {
+    'F1': [{'symbol': 'A', 'holdingName': 'A', 'holdingPercent': 0.6}],
+    'F2': [{'symbol': 'B', 'holdingName': 'B', 'holdingPercent': 0.4}],
+}
+
+
+def make_spies(monkeypatch) -> tuple:
+    scraped, read = [], []
+
+    def scrape_holdings(etfs, holdings_scraping_config):
+        scraped.extend(etfs)
+        return {etf: HOLDINGS[etf] for etf in etfs}
+
+    read_snapshots = holdings_cache.read_snapshots
+
+    def spy_read_snapshots(conn, etfs):
+        read.extend(etfs)
+        return read_snapshots(conn, etfs)
+
+    monkeypatch.setattr(holdings_cache, 'scrape_holdings', scrape_holdings)
+    monkeypatch.setattr(holdings_cache, 'read_snapshots', spy_read_snapshots)
+    return scraped, read
+
+
+def test_resident_snapshots_are_read_from_memory(tmp_path, monkeypatch):
+    scraped, read = make_spies(monkeypatch)
+    config = {'enabled': True, 'cache_dir': str(tmp_path), 'ttl_days': 30, 'resident': True}
+
+    assert get_cached_holdings(['F1'], {}, config) == [HOLDINGS['F1']]
+    assert get_cached_holdings(['F1', 'F2'], {}, config) == [HOLDINGS['F1'], HOLDINGS['F2']]
+
+    # the snapshot of F1 scraped on the first run is not read from the file again
+    assert scraped == ['F1', 'F2']
+    assert read == ['F1', 'F2']
+
+
+def test_expired_resident_snapshots_are_read_again_from_the_file(tmp_path, monkeypatch):
+    scraped, read = make_spies(monkeypatch)
+    config = {'enabled': True, 'cache_dir': str(tmp_path), 'ttl_days': 30, 'resident': True}
+    get_cached_holdings(['F1'], {}, config)
+
+    # as if the snapshot held had expired and another process had refreshed the one in the file since
+    fetched_at, records = read_resident_snapshots(str(tmp_path), ['F1'])['F1']
+    holdings_cache.keep_resident_snapshots(str(tmp_path), {'F1': (fetched_at - 31 * 86400, records)})
+
+    assert get_cached_holdings(['F1'], {}, config) == [HOLDINGS['F1']]
+    assert scraped == ['F1'] and read == ['F1', 'F1']
+    assert read_resident_snapshots(str(tmp_path), ['F1'])['F1'][0] == fetched_at
+
+
+def test_snapshots_are_read_from_the_file_when_not_resident(tmp_path, monkeypatch):
+    scraped, read = make_spies(monkeypatch)
+    config = {'enabled': True, 'cache_dir': str(tmp_path), 'ttl_days': 30}
+
+    get_cached_holdings(['F1'], {}, config)
+    get_cached_holdings(['F1'], {}, config)
+
+    assert scraped == ['F1'] and read == ['F1', 'F1']
+    assert read_resident_snapshots(str(tmp_path), ['F1']) == {}
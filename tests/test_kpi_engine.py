@@ -0,0 +1,148 @@
+import ast
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from kpi_engine import (DEFAULT_KPIS, compile_kpis, evaluate_asset_kpis, evaluate_portfolio_kpis, get_input_arrays,
+                        get_portfolio_kpi_formats)
+
+TAX_RATE = 0.28
+
+
+def make_portfolio() -> pd.DataFrame:
+    return pd.DataFrame({
+        'holdings': [10.0, 5.0, 200.0],
+        'entry_price': [100.0, 40.0, 1.5],
+        'entry_date': pd.to_datetime(['2018-03-01', '2020-06-15', '2015-01-02']),
+        'entry_cost': [2.0, 1.0, 0.0],
+        'annual_cost': [0.5, 0.0, 1.2],
+        'exit_cost_fixed_fee': [1.0, 1.0, 0.0],
+        'exit_cost_pct': [0.001, 0.0, 0.002],
+        'dividends_received': [12.0, 0.0, 30.0],
+        'dividends_costs': [1.0, 0.0, 4.5],
+        'yesterdays_price': [118.0, 38.0, 2.1],
+        'todays_price': [120.0, 37.0, 2.0],
+        'today_dt': pd.to_datetime(['2021-02-26'] * 3),
+    })
+
+
+def get_reference_kpis(portfolio: pd.DataFrame) -> tuple:
+    # the formulas as they were written by hand before the KPIs were expressions
+    kpis = portfolio.copy()
+    kpis['years_since_entry'] = (kpis['today_dt'] - kpis['entry_date']).dt.days / 365
+    kpis['entry_value'] = kpis['holdings'] * kpis['entry_price']
+    kpis['current_value'] = kpis['holdings'] * kpis['todays_price']
+    kpis['exit_cost_total'] = kpis['exit_cost_fixed_fee'] + kpis['exit_cost_pct'] * kpis['current_value']
+    kpis['net_gain_ex_dividend_pre_tax'] = kpis['current_value'] - kpis['entry_value'] - kpis['entry_cost'] \
+        - kpis['exit_cost_total']
+    kpis['tax_on_gain'] = kpis['net_gain_ex_dividend_pre_tax'] * TAX_RATE
+    kpis['annual_costs_paid'] = kpis['annual_cost'] * kpis['years_since_entry']
+    kpis['net_gain_ex_dividend'] = kpis['net_gain_ex_dividend_pre_tax'] - kpis['tax_on_gain'] \
+        - kpis['annual_costs_paid']
+    kpis['net_gain'] = kpis['net_gain_ex_dividend'] + kpis['dividends_received'] - kpis['dividends_costs']
+    kpis['1_day_roa'] = kpis['todays_price'] / kpis['yesterdays_price'] - 1
+    kpis['per_annum_roa_ex_dividends'] = ((kpis['net_gain_ex_dividend'] + kpis['entry_value']) / kpis['entry_value']) \
+        ** (1 / kpis['years_since_entry']) - 1
+    kpis['per_annum_roa'] = ((kpis['net_gain'] + kpis['entry_value']) / kpis['entry_value']) \
+        ** (1 / kpis['years_since_entry']) - 1
+
+    portfolio_kpis = {
+        'Starting capital': kpis['entry_value'].sum(),
+        'Costs paid so far': kpis['annual_costs_paid'].sum() + kpis['entry_cost'].sum(),
+        'Capital after liquidating pre-tax': kpis['current_value'].sum() - kpis['exit_cost_total'].sum(),
+        'Capital after liquidating post-tax': kpis['current_value'].sum() - kpis['exit_cost_total'].sum()
+        - kpis['tax_on_gain'].sum(),
+        'ROC per annum post-tax': kpis['per_annum_roa'].dot(kpis['current_value']) / kpis['current_value'].sum(),
+    }
+    return kpis, portfolio_kpis
+
+
+def evaluate(kpis_config: dict, portfolio: pd.DataFrame) -> tuple:
+    kpi_plans = compile_kpis(kpis_config)
+    columns = kpi_plans['asset_plan'].get_inputs() + kpi_plans['summed_plan'].get_inputs()
+    inputs = get_input_arrays(portfolio, columns)
+    parameters = {'tax_rate': TAX_RATE}
+    asset_kpis = evaluate_asset_kpis(kpi_plans, inputs, parameters)
+    return asset_kpis, evaluate_portfolio_kpis(kpi_plans, dict(inputs, **asset_kpis), parameters)
+
+
+def test_default_kpis_match_the_hand_written_formulas():
+    portfolio = make_portfolio()
+    reference, reference_portfolio_kpis = get_reference_kpis(portfolio)
+
+    asset_kpis, portfolio_kpis = evaluate(DEFAULT_KPIS, portfolio)
+
+    assert list(asset_kpis) == list(DEFAULT_KPIS['asset_level'])
+    for name, values in asset_kpis.items():
+        np.testing.assert_allclose(values, reference[name].to_numpy(float), rtol=1e-12, err_msg=name)
+    assert list(portfolio_kpis) == list(reference_portfolio_kpis)
+    for name, value in portfolio_kpis.items():
+        assert value == pytest.approx(reference_portfolio_kpis[name], rel=1e-12), name
+
+
+def test_kpis_can_be_listed_before_the_ones_they_use():
+    kpis_config = {'asset_level': {'doubled': 'value * 2', 'value': 'holdings * todays_price'},
+                   'portfolio_level': {'Share': 'Total / sum(value)', 'Total': 'sum(doubled)'}}
+
+    asset_kpis, portfolio_kpis = evaluate(kpis_config, make_portfolio())
+
+    np.testing.assert_allclose(asset_kpis['doubled'], [2400.0, 370.0, 800.0])
+    assert portfolio_kpis == {'Share': pytest.approx(2.0), 'Total': pytest.approx(3570.0)}
+
+
+def test_cycle_is_reported_with_its_path():
+    kpis_config = {'asset_level': {'a': 'b + 1', 'b': 'c * 2', 'c': 'a - holdings'}}
+
+    with pytest.raises(ValueError, match='KPIs depend on each other in a cycle: a -> b -> c -> a'):
+        compile_kpis(kpis_config)
+
+
+def test_portfolio_level_cycle_is_reported_with_its_path():
+    kpis_config = {'asset_level': {}, 'portfolio_level': {'X': 'Y + sum(holdings)', 'Y': 'X / 2'}}
+
+    with pytest.raises(ValueError, match='KPIs depend on each other in a cycle: X -> Y -> X'):
+        compile_kpis(kpis_config)
+
+
+def test_unknown_name_is_reported_when_evaluated():
+    with pytest.raises(ValueError, match='Unknown name no_such_column in the KPIs'):
+        evaluate({'asset_level': {'a': 'holdings * no_such_column'}}, make_portfolio())
+
+
+@pytest.mark.parametrize('expression', ['holdings.real', '__import__("os")', 'holdings[0]', 'lambda: 1',
+                                        'abs(holdings, key=1)', 'not holdings', '"text"', 'a if b else c'])
+def test_expressions_outside_the_whitelist_are_refused(expression):
+    with pytest.raises(ValueError, match='KPI "a": .* is not supported'):
+        compile_kpis({'asset_level': {'a': expression}})
+
+
+def test_invalid_syntax_is_refused():
+    with pytest.raises(ValueError, match='KPI "a" is not a valid expression'):
+        compile_kpis({'asset_level': {'a': 'holdings *'}})
+
+
+def test_sum_is_refused_in_asset_level_kpis():
+    with pytest.raises(ValueError, match=r'KPI "a": sum\(\) is only allowed in portfolio level KPIs'):
+        compile_kpis({'asset_level': {'a': 'holdings / sum(holdings)'}})
+
+
+def test_sum_takes_a_single_expression():
+    with pytest.raises(ValueError, match=r'KPI "A": sum\(\) takes a single expression'):
+        compile_kpis({'asset_level': {}, 'portfolio_level': {'A': 'sum(holdings, todays_price)'}})
+
+
+def test_unsupported_expression_without_unparse(monkeypatch):
+    # Python 3.8 has no ast.unparse, the error then names the kind of expression
+    monkeypatch.delattr(ast, 'unparse', raising=False)
+
+    with pytest.raises(ValueError, match='KPI "a": Subscript expression is not supported'):
+        compile_kpis({'asset_level': {'a': 'holdings[0]'}})
+
+
+def test_ratios_are_formatted_as_percentages():
+    amount_cols, pct_cols = get_portfolio_kpi_formats(compile_kpis(DEFAULT_KPIS))
+
+    assert pct_cols == ['ROC per annum post-tax']
+    assert amount_cols == ['Starting capital', 'Costs paid so far', 'Capital after liquidating pre-tax',
+                           'Capital after liquidating post-tax']
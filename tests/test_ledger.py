@@ -0,0 +1,152 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import yaml
+
+from ledger import get_open_lots
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'configs', 'config.yaml')
+LOT_FIELDS = ['holdings', 'entry_price', 'entry_date', 'entry_cost', 'dividends_received', 'dividends_costs']
+
+
+@pytest.fixture(scope='module')
+def csv_schema():
+    with open(CONFIG_PATH) as f:
+        return yaml.safe_load(f)['portfolio_file']['schema_fields']
+
+
+def make_transactions(rows: list) -> pd.DataFrame:
+    # rows of (date, type, ticker, quantity, price, fee, amount), all on the same broker
+    transactions = pd.DataFrame(rows, columns=['date', 'type', 'ticker', 'quantity', 'price', 'fee', 'amount'])
+    transactions['date'] = pd.to_datetime(transactions['date'])
+    transactions['broker'] = 'broker'
+    transactions['asset_type'] = 'stock'
+    return transactions
+
+
+def get_reference_lots(
+        transactions: pd.DataFrame,
+        method: str
+) -> pd.DataFrame:
+    # the open lots worked out one transaction at a time, rows already in the order they happen
+    positions = {}
+    for row in transactions.itertuples():
+        lots = positions.setdefault(row.ticker, [])
+        held = sum(x['holdings'] for x in lots)
+        if row.type == 'buy':
+            lots.append({'entry_date': row.date, 'entry_price': row.price, 'holdings': row.quantity,
+                         'entry_cost': row.fee, 'dividends_received': 0.0, 'dividends_costs': 0.0})
+        elif row.type == 'sell' and method == 'fifo':
+            to_sell = row.quantity
+            while to_sell > 1e-12:
+                sold = min(to_sell, lots[0]['holdings'])
+                kept_share = (lots[0]['holdings'] - sold) / lots[0]['holdings']
+                for field in ['holdings', 'entry_cost', 'dividends_received', 'dividends_costs']:
+                    lots[0][field] *= kept_share
+                to_sell -= sold
+                if lots[0]['holdings'] <= 1e-12:
+                    lots.pop(0)
+        elif row.type == 'sell':
+            kept_share = (held - row.quantity) / held
+            for lot in lots:
+                for field in ['holdings', 'entry_cost', 'dividends_received', 'dividends_costs']:
+                    lot[field] *= kept_share
+            if held - row.quantity <= 1e-12:
+                lots.clear()
+        else:
+            for lot in lots:
+                share = lot['holdings'] / held
+                if row.type == 'dividend':
+                    lot['dividends_received'] += row.amount * share
+                    lot['dividends_costs'] += row.fee * share
+                else:
+                    lot['entry_cost'] += (row.amount + row.fee) * share
+
+    open_lots = []
+    for ticker, lots in positions.items():
+        if method == 'fifo':
+            open_lots += [dict(x, ticker=ticker) for x in lots]
+        elif lots:
+            holdings = sum(x['holdings'] for x in lots)
+            entry_ns = sum(x['entry_date'].value * x['holdings'] for x in lots) / holdings
+            open_lots.append({
+                'ticker': ticker,
+                'entry_date': pd.Timestamp(entry_ns).round('D'),
+                'entry_price': sum(x['entry_price'] * x['holdings'] for x in lots) / holdings,
+                'holdings': holdings,
+                **{x: sum(y[x] for y in lots) for x in ['entry_cost', 'dividends_received', 'dividends_costs']},
+            })
+    return pd.DataFrame(open_lots, columns=['ticker'] + LOT_FIELDS)
+
+
+def assert_lots_equal(open_lots, reference):
+    open_lots = open_lots.sort_values(['ticker', 'entry_date']).reset_index(drop=True)
+    reference = reference.sort_values(['ticker', 'entry_date']).reset_index(drop=True)
+    assert open_lots['ticker'].tolist() == reference['ticker'].tolist()
+    assert (pd.to_datetime(open_lots['entry_date']) == pd.to_datetime(reference['entry_date'])).all()
+    for field in ['holdings', 'entry_price', 'entry_cost', 'dividends_received', 'dividends_costs']:
+        np.testing.assert_allclose(open_lots[field].to_numpy(float), reference[field].to_numpy(float),
+                                   rtol=1e-9, atol=1e-9, err_msg=field)
+
+
+TRANSACTIONS = [
+    # partial sells across lots, with a dividend and a fee paid in between
+    ('2020-01-02', 'buy', 'AAA', 10, 100.0, 1.0, np.nan),
+    ('2020-02-03', 'buy', 'AAA', 5, 110.0, 0.5, np.nan),
+    ('2020-03-02', 'dividend', 'AAA', np.nan, np.nan, 0.3, 15.0),
+    ('2020-04-01', 'sell', 'AAA', 12, 120.0, 1.0, np.nan),
+    ('2020-05-04', 'buy', 'AAA', 3, 105.0, 0.2, np.nan),
+    ('2020-06-01', 'fee', 'AAA', np.nan, np.nan, 0.0, 2.0),
+    ('2020-07-01', 'sell', 'AAA', 1, 115.0, 0.1, np.nan),
+    # closed, then reopened
+    ('2020-01-02', 'buy', 'BBB', 4, 50.0, 0.4, np.nan),
+    ('2020-02-03', 'dividend', 'BBB', np.nan, np.nan, 0.0, 4.0),
+    ('2020-03-02', 'sell', 'BBB', 4, 60.0, 0.4, np.nan),
+    ('2020-04-01', 'buy', 'BBB', 2, 55.0, 0.2, np.nan),
+    ('2020-05-04', 'buy', 'BBB', 6, 58.0, 0.6, np.nan),
+    ('2020-06-01', 'sell', 'BBB', 3, 62.0, 0.3, np.nan),
+    # closed for good
+    ('2020-01-02', 'buy', 'CCC', 7, 20.0, 0.0, np.nan),
+    ('2020-02-03', 'sell', 'CCC', 7, 25.0, 0.0, np.nan),
+]
+
+
+@pytest.mark.parametrize('method', ['fifo', 'average'])
+def test_open_lots_match_reference(csv_schema, method):
+    transactions = make_transactions(TRANSACTIONS)
+
+    open_lots = get_open_lots(transactions, csv_schema, method)
+
+    assert list(open_lots.columns) == list(csv_schema)
+    assert 'CCC' not in open_lots['ticker'].tolist()
+    assert_lots_equal(open_lots, get_reference_lots(transactions, method))
+
+
+@pytest.mark.parametrize('method', ['fifo', 'average'])
+def test_open_lots_do_not_depend_on_row_order(csv_schema, method):
+    transactions = make_transactions(TRANSACTIONS)
+    shuffled = transactions.sample(frac=1, random_state=0).reset_index(drop=True)
+
+    assert_lots_equal(get_open_lots(shuffled, csv_schema, method), get_reference_lots(transactions, method))
+
+
+def test_reopened_position_starts_from_its_new_buys(csv_schema):
+    transactions = make_transactions(TRANSACTIONS)
+
+    open_lots = get_open_lots(transactions, csv_schema, 'average').set_index('ticker')
+
+    assert open_lots.loc['BBB', 'holdings'] == pytest.approx(5.0)
+    assert open_lots.loc['BBB', 'entry_price'] == pytest.approx((2 * 55.0 + 6 * 58.0) / 8)
+    assert open_lots.loc['BBB', 'dividends_received'] == 0.0
+
+
+def test_overselling_is_reported(csv_schema):
+    transactions = make_transactions([
+        ('2020-01-02', 'buy', 'AAA', 10, 100.0, 0.0, np.nan),
+        ('2020-02-03', 'sell', 'AAA', 11, 100.0, 0.0, np.nan),
+    ])
+
+    with pytest.raises(ValueError, match=r'sells more units than were held at the time in rows \[3\]'):
+        get_open_lots(transactions, csv_schema, 'fifo')
@@ -0,0 +1,94 @@
+import pandas as pd
+import pytest
+
+import dashboard
+from dashboard import get_fund_holdings
+from look_through import build_weight_matrix, get_exposures, resolve_look_through
+
+# F1 holds a leaf and F2, F2 and F3 hold each other
+FUND_HOLDINGS = {
+    'F1': {'A': 0.5, 'F2': 0.5},
+    'F2': {'B': 0.4, 'F3': 0.6},
+    'F3': {'C': 0.7, 'F2': 0.3},
+}
+
+# by hand, cutting each cycle where the expansion from the fund first meets a fund again:
+# F2 = 0.4 B + 0.6 (0.7 C + 0.3 F2), F3 = 0.7 C + 0.3 (0.4 B + 0.6 F3) and F1 = 0.5 A + 0.5 F2
+EXPECTED_CLOSURE = {
+    'F1': {'A': 0.5, 'B': 0.2, 'C': 0.21, 'F2': 0.09},
+    'F2': {'B': 0.4, 'C': 0.42, 'F2': 0.18},
+    'F3': {'B': 0.12, 'C': 0.7, 'F3': 0.18},
+}
+
+
+def make_fund_holdings(funds: list) -> pd.DataFrame:
+    return pd.DataFrame([(fund, ticker, weight) for fund in funds for ticker, weight in FUND_HOLDINGS[fund].items()],
+                        columns=['fund', 'ticker', 'weight'])
+
+
+def get_closure_rows(funds: list) -> dict:
+    nodes, weights = build_weight_matrix(make_fund_holdings(funds), ['D'])
+    closure = resolve_look_through(nodes, weights)
+    rows = {}
+    for node in nodes:
+        row = closure[nodes.get_loc(node)]
+        rows[node] = {nodes[x]: pytest.approx(weight, abs=1e-12) for x, weight in zip(row.indices, row.data)}
+    return rows
+
+
+@pytest.mark.parametrize('funds', [['F1', 'F2', 'F3'], ['F3', 'F2', 'F1'], ['F2', 'F1', 'F3']])
+def test_closure_of_funds_of_funds_with_a_cycle(funds, capsys):
+    rows = get_closure_rows(funds)
+
+    for fund, expected in EXPECTED_CLOSURE.items():
+        assert rows[fund] == expected, fund
+    for leaf in ['A', 'B', 'C', 'D']:
+        assert rows[leaf] == {leaf: 1.0}
+    assert sorted(capsys.readouterr().out.splitlines()) == [
+        ' - Cycle in fund holdings: F2 is held by F3, it is kept as a position',
+        ' - Cycle in fund holdings: F3 is held by F2, it is kept as a position',
+    ]
+
+
+def test_funds_holding_only_leaves_keep_their_weights(capsys):
+    nodes, weights = build_weight_matrix(make_fund_holdings(['F1']))
+    closure = resolve_look_through(nodes, weights)
+
+    assert closure[nodes.get_loc('F1')].toarray().tolist() == [[0.0, 0.5, 0.5]]
+    assert capsys.readouterr().out == ''
+
+
+def test_exposures():
+    nodes, weights = build_weight_matrix(make_fund_holdings(['F1', 'F2', 'F3']), ['D'])
+    closure = resolve_look_through(nodes, weights)
+
+    exposures = get_exposures(pd.Series({'F1': 100.0, 'F3': 50.0, 'D': 10.0}), nodes, closure)
+
+    expected = pd.Series({'A': 50.0, 'B': 26.0, 'C': 56.0, 'D': 10.0, 'F2': 9.0, 'F3': 9.0})
+    pd.testing.assert_series_equal(exposures.sort_index(), expected)
+
+
+@pytest.mark.parametrize('max_depth, expected_funds', [
+    (1, ['F1']),
+    (2, ['F1', 'F2']),
+    (3, ['F1', 'F2', 'F3']),
+    (5, ['F1', 'F2', 'F3']),
+])
+def test_holdings_are_looked_up_to_max_depth(max_depth, expected_funds, monkeypatch):
+    looked_up = []
+
+    def get_cached_holdings(funds, scraping_config, cache_config):
+        looked_up.extend(funds)
+        return [[{'symbol': ticker, 'holdingName': ticker, 'holdingPercent': weight}
+                 for ticker, weight in FUND_HOLDINGS.get(fund, {}).items()] for fund in funds]
+
+    monkeypatch.setattr(dashboard, 'get_cached_holdings', get_cached_holdings)
+
+    fund_holdings = get_fund_holdings(['F1'], {}, max_depth)
+
+    # the leaves of a level are looked up on the next one too, and a fund is never looked up twice
+    assert [x for x in looked_up if x in FUND_HOLDINGS] == expected_funds
+    assert len(looked_up) == len(set(looked_up))
+    pd.testing.assert_frame_equal(fund_holdings[['fund', 'ticker', 'weight']],
+                                  make_fund_holdings(expected_funds), check_like=True)
+    assert fund_holdings['resolved'].all()
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+from scipy.optimize import brentq
+
+from money_weighted import LOG_RETURN_BRACKET, calculate_money_weighted_returns, solve_money_weighted_returns
+
+
+def get_reference_return(amounts, times):
+    # the root of the present value in r itself, over the same bracket
+    def present_value(r):
+        return np.sum(amounts * (1 + r) ** -times)
+
+    return brentq(present_value, np.expm1(LOG_RETURN_BRACKET[0]), np.expm1(LOG_RETURN_BRACKET[1]), xtol=1e-14)
+
+
+def make_columns(years_since_entry, entry_value, current_value, dividends_received=0.0, costs=0.0):
+    n_rows = len(years_since_entry)
+    return {
+        'years_since_entry': years_since_entry,
+        'entry_value': entry_value,
+        'entry_cost': np.full(n_rows, costs),
+        'dividends_received': np.full(n_rows, dividends_received),
+        'dividends_costs': np.zeros(n_rows),
+        'annual_costs_paid': np.full(n_rows, costs),
+        'current_value': current_value,
+        'exit_cost_total': np.full(n_rows, costs),
+        'tax_on_gain': np.zeros(n_rows),
+    }
+
+
+def test_groups_match_brentq():
+    rng = np.random.default_rng(0)
+    n_groups, n_flows = 200, 6
+    groups = np.repeat(np.arange(n_groups), n_flows)
+    times = -rng.uniform(0, 10, (n_groups, n_flows))
+    times[:, 0] = -10.0
+    # an outflow first and inflows of varied sizes after, so the roots range from deep losses to large gains
+    amounts = rng.uniform(1, 100, (n_groups, n_flows)) * rng.uniform(0.01, 3, (n_groups, 1))
+    amounts[:, 0] = -50.0 * (n_flows - 1)
+
+    returns = solve_money_weighted_returns(amounts, times, groups, n_groups)
+
+    expected = [get_reference_return(amounts[x], times[x]) for x in range(n_groups)]
+    np.testing.assert_allclose(returns, expected, rtol=1e-9, atol=1e-12)
+
+
+def test_rows_match_brentq():
+    columns = make_columns(np.array([0.5, 1.0, 3.0, 10.0]), np.array([100.0, 100.0, 100.0, 100.0]),
+                           np.array([130.0, 80.0, 100.0, 400.0]), dividends_received=5.0, costs=1.0)
+
+    returns = calculate_money_weighted_returns(columns)
+
+    for x, money_weighted_return in enumerate(returns):
+        years = columns['years_since_entry'][x]
+        amounts = np.array([-101.0, 5.0 - 1.0, columns['current_value'][x] - 1.0])
+        times = np.array([-years, -years / 2, 0.0])
+        assert money_weighted_return == pytest.approx(get_reference_return(amounts, times), rel=1e-9)
+
+
+def test_grouped_rows_are_solved_together():
+    columns = make_columns(np.array([1.0, 2.0, 4.0]), np.array([100.0, 50.0, 20.0]), np.array([110.0, 70.0, 15.0]))
+
+    returns = calculate_money_weighted_returns(columns, np.array([0, 0, 1]), 2)
+
+    amounts = np.array([-100.0, 0.0, 110.0, -50.0, 0.0, 70.0])
+    times = np.array([-1.0, -0.5, 0.0, -2.0, -1.0, 0.0])
+    assert returns[0] == pytest.approx(get_reference_return(amounts, times), rel=1e-9)
+    assert returns[1] == pytest.approx((15.0 / 20.0) ** (1 / 4) - 1, rel=1e-9)
+
+
+def test_unbracketed_groups_are_nan():
+    # flows of a single sign, and a loss beyond the bracket, have no root to find
+    amounts = np.array([[-100.0, -10.0], [100.0, 10.0], [-100.0, 1e-9], [-100.0, 110.0]])
+    times = np.array([[-1.0, 0.0], [-1.0, 0.0], [-1.0, 0.0], [-1.0, 0.0]])
+
+    returns = solve_money_weighted_returns(amounts, times, np.repeat(np.arange(4), 2), 4)
+
+    assert np.isnan(returns[:3]).all()
+    assert returns[3] == pytest.approx(0.1, rel=1e-9)
+
+
+def test_same_day_flows_are_nan():
+    # bought today: every flow is at the same time and the present value doesn't depend on the rate
+    columns = make_columns(np.array([0.0, 0.0]), np.array([100.0, 100.0]), np.array([100.0, 105.0]))
+
+    assert np.isnan(calculate_money_weighted_returns(columns)).all()
+
+
+def test_missing_columns_give_none():
+    columns = make_columns(np.array([1.0]), np.array([100.0]), np.array([110.0]))
+    del columns['tax_on_gain']
+
+    assert calculate_money_weighted_returns(columns) is None
@@ -0,0 +1,284 @@
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+import yfinance as yf
+
+import price_cache
+from price_cache import (PRICE_CACHE_FILE, download_adj_close_chunked, download_in_chunks, evict_price_cache,
+                         get_adj_close_prices, get_missing_ranges, open_price_cache, read_cached_prices, store_prices)
+
+
+def make_closes(tickers: list, start: str, end: str, factors: dict = None) -> pd.DataFrame:
+    # a close per business day of [start, end), set by its date and the same for every ticker up to its adjustment
+    # factor, so overlapping downloads agree
+    index = pd.bdate_range(start, end, inclusive='left', name='Date')
+    base = 100 + (index - pd.Timestamp('2000-01-01')).days.to_numpy(dtype=float)
+    return pd.DataFrame({x: base * (factors or {}).get(x, 1.0) for x in tickers}, index=index)
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = open_price_cache(str(tmp_path))
+    yield conn
+    conn.close()
+
+
+def get_coverage(conn) -> dict:
+    return {t: (s, e) for t, s, e in conn.execute('SELECT ticker, start, end FROM coverage')}
+
+
+def test_coverage_stops_at_settled_before(conn):
+    store_prices(conn, make_closes(['A', 'B'], '2020-01-01', '2020-02-01'), '2020-01-01', '2020-02-01', '2020-01-20')
+
+    assert get_coverage(conn) == {'A': ('2020-01-01', '2020-01-20'), 'B': ('2020-01-01', '2020-01-20')}
+    # the closes past settled_before are kept all the same, to be read until they are fetched again
+    assert len(read_cached_prices(conn, ['A'], '2020-01-20', '2020-02-01')) == 10
+
+
+def test_coverage_grows_and_skips_tickers_without_closes(conn):
+    closes = make_closes(['A', 'B'], '2020-01-01', '2020-02-01')
+    closes['B'] = np.nan
+    store_prices(conn, closes, '2020-01-01', '2020-02-01', '2021-01-01')
+    store_prices(conn, make_closes(['A'], '2019-12-01', '2020-01-01'), '2019-12-01', '2020-01-01', '2021-01-01')
+    store_prices(conn, make_closes(['A'], '2020-02-01', '2020-03-01'), '2020-02-01', '2020-03-01', '2021-01-01')
+
+    assert get_coverage(conn) == {'A': ('2019-12-01', '2020-03-01')}
+
+
+def test_missing_ranges(conn):
+    store_prices(conn, make_closes(['A'], '2020-01-01', '2020-02-01'), '2020-01-01', '2020-02-01', '2021-01-01')
+    store_prices(conn, make_closes(['B'], '2019-06-01', '2020-06-01'), '2019-06-01', '2020-06-01', '2021-01-01')
+
+    missing_ranges = get_missing_ranges(conn, ['A', 'B', 'C'], '2019-12-01', '2020-03-01')
+
+    assert missing_ranges == {
+        ('2019-12-01', '2020-01-01'): ['A'],
+        ('2020-02-01', '2020-03-01'): ['A'],
+        ('2019-12-01', '2020-03-01'): ['C'],
+    }
+
+
+def test_age_eviction_shrinks_the_coverage(conn, tmp_path):
+    today = datetime.today()
+    start = (today - timedelta(100)).strftime('%Y-%m-%d')
+    end = (today - timedelta(10)).strftime('%Y-%m-%d')
+    store_prices(conn, make_closes(['A'], start, end), start, end, end)
+    old_end = (today - timedelta(60)).strftime('%Y-%m-%d')
+    store_prices(conn, make_closes(['B'], start, old_end), start, old_end, old_end)
+
+    evict_price_cache(conn, str(tmp_path), max_age_days=50)
+
+    cutoff = (today - timedelta(50)).strftime('%Y-%m-%d')
+    assert get_coverage(conn) == {'A': (cutoff, end)}
+    assert conn.execute('SELECT MIN(date) FROM prices').fetchone()[0] >= cutoff
+
+
+def test_size_eviction_drops_the_least_recently_used_tickers(conn, tmp_path):
+    tickers = ['A', 'B', 'C', 'D']
+    store_prices(conn, make_closes(tickers, '2010-01-01', '2020-01-01'), '2010-01-01', '2020-01-01', '2021-01-01')
+    conn.executemany('UPDATE coverage SET last_used = ? WHERE ticker = ?', [(i, x) for i, x in enumerate(tickers)])
+    conn.commit()
+    file_size = os.path.getsize(os.path.join(str(tmp_path), PRICE_CACHE_FILE))
+
+    evict_price_cache(conn, str(tmp_path), max_size_mb=file_size * 0.6 / 1e6)
+
+    assert sorted(get_coverage(conn)) == ['C', 'D']
+    assert {x for x, in conn.execute('SELECT DISTINCT ticker FROM prices')} == {'C', 'D'}
+
+
+def test_cache_is_dropped_when_the_adjusted_closes_change(tmp_path, monkeypatch):
+    factors = {'A': 1.0, 'B': 1.0}
+    downloads = []
+
+    def download(tickers, start, end, download_config=None):
+        downloads.append((tuple(tickers), start, end))
+        return make_closes(tickers, start, end, factors)
+
+    monkeypatch.setattr(price_cache, 'download_adj_close_chunked', download)
+    config = {'enabled': True, 'cache_dir': str(tmp_path), 'adjustment_check_days': 7}
+    get_adj_close_prices(['A', 'B'], '2020-01-01', '2020-03-01', config)
+
+    # a split of A after the first run halves all its adjusted closes
+    factors['A'] = 0.5
+    downloads.clear()
+    closes = get_adj_close_prices(['A', 'B'], '2020-01-01', '2020-04-01', config)
+
+    assert downloads == [(('A', 'B'), '2020-02-23', '2020-04-08'), (('A',), '2019-12-25', '2020-03-08')]
+    pd.testing.assert_frame_equal(closes, make_closes(['A', 'B'], '2020-01-01', '2020-04-01', factors),
+                                  check_freq=False)
+
+
+def test_cache_is_kept_when_the_adjusted_closes_are_the_same(tmp_path, monkeypatch):
+    downloads = []
+
+    def download(tickers, start, end, download_config=None):
+        downloads.append((tuple(tickers), start, end))
+        return make_closes(tickers, start, end)
+
+    monkeypatch.setattr(price_cache, 'download_adj_close_chunked', download)
+    config = {'enabled': True, 'cache_dir': str(tmp_path), 'adjustment_check_days': 7}
+    get_adj_close_prices(['A'], '2020-01-01', '2020-03-01', config)
+    downloads.clear()
+    closes = get_adj_close_prices(['A'], '2019-12-01', '2020-04-01', config)
+
+    assert sorted(downloads) == [(('A',), '2019-11-24', '2020-01-08'), (('A',), '2020-02-23', '2020-04-08')]
+    assert closes.index.min() == pd.Timestamp('2019-12-02') and closes.index.max() == pd.Timestamp('2020-03-31')
+
+
+DOWNLOAD_CONFIG = {'chunk_size': 2, 'retries': 2, 'backoff_seconds': 0, 'requests_per_second': 1e6, 'burst': 100,
+                   'max_workers': 1}
+
+
+class FakeDownload:
+    # a download function for download_in_chunks that raises for the chunks holding a ticker of raise_for, reports
+    # the tickers of errors_for to yfinance as errors, and leaves the tickers of no_closes_for without a close, each
+    # for as many calls as its count
+
+    def __init__(
+            self,
+            raise_for: dict = None,
+            errors_for: dict = None,
+            no_closes_for: set = ()
+    ):
+        self.raise_for = dict(raise_for or {})
+        self.errors_for = dict(errors_for or {})
+        self.no_closes_for = set(no_closes_for)
+        self.calls = []
+
+    def __call__(self, tickers, start, end):
+        self.calls.append(list(tickers))
+        for ticker in tickers:
+            if self.raise_for.get(ticker, 0) > 0:
+                self.raise_for[ticker] -= 1
+                raise ConnectionError('connection reset')
+        closes = make_closes(tickers, start, end)
+        for ticker in tickers:
+            if self.errors_for.get(ticker, 0) > 0:
+                self.errors_for[ticker] -= 1
+                yf.shared._ERRORS[ticker] = 'YFTzMissingError()'
+                closes[ticker] = np.nan
+            if ticker in self.no_closes_for:
+                closes[ticker] = np.nan
+        return closes
+
+
+@pytest.fixture
+def download(monkeypatch):
+    monkeypatch.setattr(yf.shared, '_ERRORS', {})
+    return FakeDownload()
+
+
+def test_chunks_that_raised_are_retried(download, capsys):
+    download.raise_for = {'C': 1}
+
+    closes = download_in_chunks(download, ['A', 'B', 'C', 'D'], ('2020-01-01', '2020-02-01'), DOWNLOAD_CONFIG)
+
+    assert download.calls == [['A', 'B'], ['C', 'D'], ['C', 'D']]
+    pd.testing.assert_frame_equal(closes, make_closes(['A', 'B', 'C', 'D'], '2020-01-01', '2020-02-01'),
+                                  check_freq=False)
+    assert capsys.readouterr().out.splitlines() == [' - Downloading 2 tickers failed: connection reset',
+                                                    ' - Retrying 2 tickers']
+
+
+def test_tickers_with_errors_are_retried_on_their_own(download):
+    download.errors_for = {'B': 1}
+
+    closes = download_in_chunks(download, ['A', 'B', 'C'], ('2020-01-01', '2020-02-01'), DOWNLOAD_CONFIG)
+
+    assert download.calls == [['A', 'B'], ['C'], ['B']]
+    pd.testing.assert_frame_equal(closes, make_closes(['A', 'B', 'C'], '2020-01-01', '2020-02-01'), check_freq=False)
+
+
+def test_tickers_with_errors_are_not_retried_without_retry_errors(download):
+    download.errors_for = {'B': 1}
+
+    closes = download_in_chunks(download, ['A', 'B'], ('2020-01-01', '2020-02-01'), DOWNLOAD_CONFIG,
+                                retry_errors=False)
+
+    assert download.calls == [['A', 'B']]
+    assert closes['A'].notna().all() and closes['B'].isna().all()
+
+
+def test_tickers_still_failing_are_reported_missing(download, capsys):
+    download.errors_for = {'B': 3}
+
+    closes = download_in_chunks(download, ['A', 'B'], ('2020-01-01', '2020-02-01'), DOWNLOAD_CONFIG)
+
+    assert download.calls == [['A', 'B'], ['B'], ['B']]
+    assert list(closes.columns) == ['A', 'B'] and closes['B'].isna().all()
+    assert capsys.readouterr().out.splitlines()[-1] == " - No prices for 1 of 2 tickers: ['B']"
+
+
+def test_tickers_without_closes_are_data(download, monkeypatch):
+    download.no_closes_for = {'B'}
+    monkeypatch.setattr(price_cache, 'download_adj_close', download)
+
+    closes = download_adj_close_chunked(['A', 'B'], '2020-01-01', '2020-02-01', DOWNLOAD_CONFIG)
+
+    assert download.calls == [['A', 'B']]
+    assert closes.index.name == 'Date' and len(closes) == 23
+    assert closes['A'].notna().all() and closes['B'].isna().all()
+
+
+def test_resident_closes_follow_the_file(tmp_path, monkeypatch):
+    factors = {}
+
+    def download(tickers, start, end, download_config=None):
+        return make_closes(tickers, start, end, factors)
+
+    monkeypatch.setattr(price_cache, 'download_adj_close_chunked', download)
+    config = {'enabled': True, 'cache_dir': str(tmp_path / 'resident'), 'resident': True}
+    file_config = {'enabled': True, 'cache_dir': str(tmp_path / 'file')}
+
+    # held, grown on both sides with a new ticker, then dropped and downloaded again after a split
+    for tickers, start, end, split in [(['A', 'B'], '2020-01-01', '2020-03-01', False),
+                                       (['A', 'B', 'C'], '2019-12-01', '2020-04-01', False),
+                                       (['A', 'C'], '2020-02-01', '2020-05-01', True)]:
+        factors['A'] = 0.5 if split else 1.0
+        closes = get_adj_close_prices(tickers, start, end, config)
+
+        pd.testing.assert_frame_equal(closes, get_adj_close_prices(tickers, start, end, file_config))
+    held = price_cache.get_resident_prices(str(tmp_path / 'resident'))
+    assert held.ranges == {'A': ('2020-02-01', '2020-05-01'), 'B': ('2019-12-01', '2020-04-01'),
+                           'C': ('2019-12-01', '2020-05-01')}
+
+
+def test_resident_closes_are_read_again_when_the_file_changed(tmp_path, monkeypatch):
+    monkeypatch.setattr(price_cache, 'download_adj_close_chunked',
+                        lambda tickers, start, end, download_config=None: make_closes(tickers, start, end))
+    config = {'enabled': True, 'cache_dir': str(tmp_path), 'resident': True}
+    get_adj_close_prices(['A'], '2020-01-01', '2020-02-01', config)
+
+    # what is held is what is served, as long as nothing else wrote to the file
+    held = price_cache.get_resident_prices(str(tmp_path))
+    held.closes['A'] = held.closes['A'] * 2
+    closes = get_adj_close_prices(['A'], '2020-01-06', '2020-01-11', config)
+    assert closes['A'].tolist() == [2 * x for x in make_closes(['A'], '2020-01-06', '2020-01-11')['A']]
+
+    conn = open_price_cache(str(tmp_path))
+    conn.execute("UPDATE prices SET adj_close = 1.0 WHERE date = '2020-01-06'")
+    conn.commit()
+    conn.close()
+    closes = get_adj_close_prices(['A'], '2020-01-06', '2020-01-11', config)
+    assert closes['A'].tolist() == [1.0] + make_closes(['A'], '2020-01-07', '2020-01-11')['A'].tolist()
+
+
+def test_resident_closes_follow_the_eviction(tmp_path, monkeypatch):
+    monkeypatch.setattr(price_cache, 'download_adj_close_chunked',
+                        lambda tickers, start, end, download_config=None: make_closes(tickers, start, end))
+    today = datetime.today()
+    start = (today - timedelta(100)).strftime('%Y-%m-%d')
+    end = (today - timedelta(10)).strftime('%Y-%m-%d')
+    config = {'enabled': True, 'cache_dir': str(tmp_path), 'resident': True}
+    get_adj_close_prices(['A'], start, end, config)
+
+    closes = get_adj_close_prices(['A'], start, end, dict(config, max_age_days=50))
+
+    # the closes read before the eviction are returned, and only the ones left in the file are held after it
+    cutoff = (today - timedelta(50)).strftime('%Y-%m-%d')
+    assert closes.index.min() < pd.Timestamp(cutoff)
+    held = price_cache.get_resident_prices(str(tmp_path))
+    assert held.ranges == {'A': (cutoff, end)} and held.closes['A'].index.min() >= pd.Timestamp(cutoff)
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from risk import (RISK_AMOUNT_KPIS, RISK_PCT_KPIS, RollingCovariance, get_covariance, get_daily_returns,
+                  get_portfolio_risk, get_portfolio_risk_over_dates)
+
+
+def make_returns(n_days: int, n_assets: int, seed: int = 0) -> pd.DataFrame:
+    # shifted off zero, where the sums of the rolling covariance lose the most to rounding
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(rng.normal(0.0005, 0.01, (n_days, n_assets)) + 0.01,
+                        index=pd.bdate_range('2020-01-01', periods=n_days), columns=[f'T{x}' for x in range(n_assets)])
+
+
+def test_covariance_matches_numpy():
+    returns = make_returns(50, 4).to_numpy()
+
+    np.testing.assert_allclose(get_covariance(returns), np.cov(returns, rowvar=False), rtol=1e-12)
+
+
+@pytest.mark.parametrize('recompute_every', [None, 7, 1000])
+def test_rolling_covariance_matches_numpy_over_the_window(recompute_every):
+    returns = make_returns(400, 5).to_numpy()
+    window = 60
+    rolling = RollingCovariance(returns.shape[1], window, recompute_every)
+
+    for day, row in enumerate(returns):
+        rolling.update(row)
+        in_window = returns[max(0, day + 1 - window):day + 1]
+        np.testing.assert_array_equal(rolling.get_returns(), in_window)
+        if len(in_window) < 2:
+            assert np.isnan(rolling.get_covariance()).all()
+        else:
+            np.testing.assert_allclose(rolling.get_covariance(), np.cov(in_window, rowvar=False),
+                                       rtol=1e-8, atol=1e-15)
+
+
+def test_risk_over_dates_matches_risk_at_each_date():
+    returns = make_returns(300, 6)
+    dates = returns.index[[0, 1, 40, 41, 150, 299]].append(pd.DatetimeIndex(['2030-01-01']))
+    values = np.random.default_rng(1).uniform(0, 1000, (len(dates), returns.shape[1]))
+    window = 100
+
+    risk = get_portfolio_risk_over_dates(values, returns, dates, window)
+
+    for date, date_values in zip(dates, values):
+        in_window = returns.loc[:date].to_numpy()[-window:]
+        expected = get_portfolio_risk(date_values, in_window)
+        for kpi in RISK_PCT_KPIS + RISK_AMOUNT_KPIS:
+            assert risk.loc[date, kpi] == pytest.approx(expected[kpi], rel=1e-8, nan_ok=True), (date, kpi)
+
+
+def test_daily_returns_take_missing_closes_as_unchanged():
+    panel = pd.DataFrame({'A': [10.0, 11.0, np.nan, 12.1], 'B': [np.nan, 5.0, 5.5, np.nan]},
+                         index=pd.bdate_range('2020-01-01', periods=4))
+
+    returns = get_daily_returns(panel)
+
+    np.testing.assert_allclose(returns['A'], [0.1, 0.0, 0.1])
+    np.testing.assert_allclose(returns['B'], [0.0, 0.1, 0.0])
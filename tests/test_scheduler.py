@@ -0,0 +1,123 @@
+import json
+import urllib.error
+import urllib.request
+from datetime import datetime
+
+import pytest
+
+from scheduler import TRIGGER_TOKEN_HEADER, get_next_run, parse_cron, parse_cron_field, serve_jobs, \
+    start_trigger_server
+
+
+def get_next_runs(expression: str, after: datetime, n_runs: int) -> list:
+    cron = parse_cron(expression)
+    runs = []
+    for _ in range(n_runs):
+        after = get_next_run(cron, after)
+        runs.append(after)
+    return runs
+
+
+@pytest.mark.parametrize('field, low, high, expected', [
+    ('*/15', 0, 59, {0, 15, 30, 45}),
+    ('5/15', 0, 59, {5, 20, 35, 50}),
+    ('1-10/3', 1, 31, {1, 4, 7, 10}),
+    ('1-5,10,20-22', 1, 31, {1, 2, 3, 4, 5, 10, 20, 21, 22}),
+    ('*', 1, 12, set(range(1, 13))),
+])
+def test_cron_fields(field, low, high, expected):
+    assert parse_cron_field(field, low, high) == expected
+
+
+@pytest.mark.parametrize('expression', ['0 24 * * *', '60 0 * * *', '0 0 0 * *', '0 0 5-1 * *', '* * * *'])
+def test_invalid_cron_expressions(expression):
+    with pytest.raises(ValueError):
+        parse_cron(expression)
+
+
+def test_minute_step():
+    assert get_next_runs('*/20 9 * * *', datetime(2021, 3, 1, 9, 5), 3) == [
+        datetime(2021, 3, 1, 9, 20), datetime(2021, 3, 1, 9, 40), datetime(2021, 3, 2, 9, 0)]
+
+
+def test_weekday_range():
+    # 2021-03-05 is a friday
+    assert get_next_runs('0 18 * * 1-5', datetime(2021, 3, 5, 18, 0), 2) == [
+        datetime(2021, 3, 8, 18, 0), datetime(2021, 3, 9, 18, 0)]
+
+
+def test_restricted_day_and_weekday_match_either():
+    # the 13th of the month or any friday
+    assert get_next_runs('0 0 13 * 5', datetime(2021, 8, 1), 4) == [
+        datetime(2021, 8, 6), datetime(2021, 8, 13), datetime(2021, 8, 20), datetime(2021, 8, 27)]
+
+
+def test_stepped_day_is_not_a_restriction():
+    # */2 is not restricted, so the days have to be odd and mondays too rather than odd or mondays
+    assert get_next_runs('0 0 */2 * 1', datetime(2021, 3, 1), 3) == [
+        datetime(2021, 3, 15), datetime(2021, 3, 29), datetime(2021, 4, 5)]
+
+
+def test_stepped_weekday_is_not_a_restriction():
+    # */2 on weekdays is sunday, tuesday, thursday and saturday, that the first of the month has to fall on
+    assert get_next_runs('0 0 1 * */2', datetime(2021, 3, 1), 3) == [
+        datetime(2021, 4, 1), datetime(2021, 5, 1), datetime(2021, 6, 1)]
+
+
+def test_sunday_is_0_and_7():
+    assert parse_cron('0 0 * * 7')['weekday'] == parse_cron('0 0 * * 0')['weekday'] == {0}
+    assert get_next_run(parse_cron('0 0 * * 7'), datetime(2021, 3, 1)) == datetime(2021, 3, 7)
+
+
+def test_february_29():
+    assert get_next_runs('30 6 29 2 *', datetime(2021, 3, 1), 2) == [
+        datetime(2024, 2, 29, 6, 30), datetime(2028, 2, 29, 6, 30)]
+
+
+def test_never_matching_expression():
+    with pytest.raises(ValueError, match='never matches'):
+        get_next_run(parse_cron('0 0 31 2 *'), datetime(2021, 3, 1))
+
+
+@pytest.fixture
+def trigger_server():
+    jobs = {'daily': {'schedule': '0 18 * * 1-5', 'next_run': None}}
+    server = start_trigger_server(jobs, '127.0.0.1', 0, trigger_token='secret')
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def post(server, path: str, token: str = None) -> tuple:
+    request = urllib.request.Request(f'http://127.0.0.1:{server.server_port}{path}', method='POST')
+    if token is not None:
+        request.add_header(TRIGGER_TOKEN_HEADER, token)
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_trigger_without_token_is_unauthorized(trigger_server):
+    assert post(trigger_server, '/run/daily')[0] == 401
+    assert trigger_server.triggers.empty()
+
+
+def test_trigger_with_wrong_token_is_forbidden(trigger_server):
+    assert post(trigger_server, '/run/daily', 'wrong')[0] == 403
+    assert trigger_server.triggers.empty()
+
+
+def test_trigger_with_token_is_queued(trigger_server):
+    assert post(trigger_server, '/run/daily', 'secret') == (202, {'queued': 'daily'})
+    assert trigger_server.triggers.get_nowait() == 'daily'
+
+
+def test_trigger_of_unknown_job(trigger_server):
+    assert post(trigger_server, '/run/weekly', 'secret')[0] == 404
+
+
+def test_non_loopback_host_needs_a_token():
+    with pytest.raises(ValueError, match='needs a trigger token'):
+        serve_jobs([{'name': 'daily', 'schedule': '0 18 * * 1-5'}], lambda name: None, host='0.0.0.0', port=0)
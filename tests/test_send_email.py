@@ -0,0 +1,86 @@
+import email
+import gzip
+import smtplib
+
+import pytest
+
+from send_email import create_email_message, send_email_message_oauth, send_email_messages_oauth
+from stand_ins import start_smtp_stand_in
+
+SENDER_EMAIL = 'sender@example.com'
+REPORTS = {
+    'portfolio_global_kpis.html': '<table><tr><td>global kpis</td></tr></table>',
+    'portfolio_indirect_positions.html': '<table><tr><td>indirect positions</td></tr></table>',
+    'portfolio_with_kpis.html': '<table>' + '<tr><td>position</td></tr>' * 200 + '</table>',
+}
+
+
+def get_messages(receiver_emails):
+    return [(create_email_message(SENDER_EMAIL, x, '2021-02-26', reports=REPORTS, compress_attachments_over_kb=1), x)
+            for x in receiver_emails]
+
+
+def send(server, port, receiver_emails):
+    refused = send_email_messages_oauth(get_messages(receiver_emails), SENDER_EMAIL, 'client-id', 'auth-string',
+                                        port=port, smtp_server='127.0.0.1', starttls=False)
+    server.shutdown()
+    server.server_close()
+    return refused
+
+
+def test_messages_go_out_over_one_session():
+    server, port = start_smtp_stand_in()
+    receiver_emails = ['a@example.com', 'b@example.com', 'c@example.com']
+
+    assert send(server, port, receiver_emails) == {}
+    assert server.sessions == 1
+    assert [x['recipients'] for x in server.messages] == [[f'<{x}>'] for x in receiver_emails]
+
+    message = email.message_from_bytes(server.messages[0]['data'])
+    attachment = [x for x in message.walk() if x.get_filename() is not None][0]
+    assert attachment.get_filename() == 'portfolio_with_kpis.html.gz'
+    assert attachment.get_content_type() == 'application/gzip'
+    assert gzip.decompress(attachment.get_payload(decode=True)).decode() == REPORTS['portfolio_with_kpis.html']
+
+
+def test_refused_message_does_not_stop_the_others():
+    server, port = start_smtp_stand_in(refused_recipients=['b@example.com'])
+
+    refused = send(server, port, ['a@example.com', 'b@example.com', 'c@example.com'])
+
+    assert list(refused) == ['b@example.com']
+    assert refused['b@example.com']['b@example.com'][0] == 550
+    assert server.sessions == 1
+    assert [x['recipients'] for x in server.messages] == [['<a@example.com>'], ['<c@example.com>']]
+
+
+def test_single_email_refused_by_its_recipient_raises():
+    server, port = start_smtp_stand_in(refused_recipients=['a@example.com'])
+    (message, receiver_email), = get_messages(['a@example.com'])
+
+    try:
+        with pytest.raises(smtplib.SMTPRecipientsRefused) as e:
+            send_email_message_oauth(message, SENDER_EMAIL, receiver_email, 'client-id', 'auth-string', port=port,
+                                     smtp_server='127.0.0.1', starttls=False)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert e.value.recipients['a@example.com'][0] == 550
+    assert server.messages == []
+
+
+def test_single_email_partly_refused_returns_the_refused_recipients():
+    server, port = start_smtp_stand_in(refused_recipients=['b@example.com'])
+    receiver_emails = ['a@example.com', 'b@example.com']
+    message = create_email_message(SENDER_EMAIL, ', '.join(receiver_emails), '2021-02-26', reports=REPORTS)
+
+    try:
+        refused = send_email_message_oauth(message, SENDER_EMAIL, receiver_emails, 'client-id', 'auth-string',
+                                           port=port, smtp_server='127.0.0.1', starttls=False)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert list(refused) == ['b@example.com']
+    assert [x['recipients'] for x in server.messages] == [['<a@example.com>']]